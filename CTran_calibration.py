@@ -1,3 +1,4 @@
+import os
 import random
 import sys
 import time
@@ -16,10 +17,12 @@ import torch.backends.cudnn as cudnn
 from model.SSGRL import SSGRL, update_feature_ddp, compute_prototype_ddp
 from model.CTran import CTranModel, custom_replace
 from loss import InstanceContrastiveLoss, PrototypeContrastiveLoss
+from calibration.pipeline import LossPipeline
 from calibration.Calibration import MDCA, FocalLoss, FLSD, DCA, MbLS, DWBL
 
 from utils.dataloader import get_graph_and_word_file, get_data_loader
-from utils.metrics import AverageMeter, AveragePrecisionMeter, Compute_mAP_VOC2012
+from utils.metrics import AverageMeter, ValidationMeter
+from utils.logits_store import LogitsStore
 from utils.checkpoint import save_checkpoint
 from utils.label_smoothing import label_smoothing_tradition, label_smoothing_dynamic
 
@@ -100,6 +103,7 @@ def main(cfg: DictConfig):
                  'MbLS': MbLS().cuda(),
                  'DWBL': DWBL().cuda(),
                  }
+    lossPipeline = LossPipeline(cfg, criterion, instance_methods=('instance', 'prototype'))
 
     for p in aux_model.parameters():
         p.requires_grad = False
@@ -122,7 +126,7 @@ def main(cfg: DictConfig):
 
     for epoch in range(cfg.start_epoch, cfg.start_epoch + cfg.epochs):
 
-        Train(train_loader, aux_model, model, criterion, optimizer, writer, epoch, cfg)
+        Train(train_loader, aux_model, model, lossPipeline, optimizer, writer, epoch, cfg)
         mAP, ACE, ECE, MCE = Validate(test_loader, aux_model, model, criterion, epoch, cfg)
 
         writer.add_scalar('mAP', mAP, epoch)
@@ -138,7 +142,7 @@ def main(cfg: DictConfig):
 
     writer.close()
 
-def Train(train_loader, aux_model, ctran_model, criterion, optimizer, writer, epoch, cfg):
+def Train(train_loader, aux_model, ctran_model, lossPipeline, optimizer, writer, epoch, cfg):
     ctran_model.train()
 
     loss, loss_base, loss_plus, loss_calibration = AverageMeter(), AverageMeter(), AverageMeter(), AverageMeter()
@@ -173,8 +177,8 @@ def Train(train_loader, aux_model, ctran_model, criterion, optimizer, writer, ep
 
         elif cfg.model.method == 'DPCAR':
             update_feature_ddp(aux_model, aux_feature, target, cfg.model.inter_example_nums)
-            target_instance = label_smoothing_dynamic(cfg, full_label, aux_model.pos_feature, aux_feature, epoch, 10)
-            target_prototype = label_smoothing_dynamic(cfg, full_label, aux_model.prototype, aux_feature, epoch, 10)
+            target_ = (label_smoothing_dynamic(cfg, full_label, aux_model.pos_feature, aux_feature, epoch, 10),
+                       label_smoothing_dynamic(cfg, full_label, aux_model.prototype, aux_feature, epoch, 10))
 
         else:
             # Non Label Smoothing
@@ -182,81 +186,17 @@ def Train(train_loader, aux_model, ctran_model, criterion, optimizer, writer, ep
             target_[target_ < 0] = 0
 
         # Loss
-        if cfg.model.method == 'DPCAR':
-            loss_instance = criterion['BCEWithLogitsLoss'](outputs, target_instance)
-            loss_prototype = criterion['BCEWithLogitsLoss'](outputs, target_prototype)
-            loss_base_ = (loss_instance + loss_prototype) / 2
+        warmup = 1.0 if epoch >= 1 else batch_index / float(len(train_loader))
+        losses = lossPipeline(outputs, target_, aux_feature, target, warmup)
 
-            loss_plus_ = torch.tensor(0.0).cuda()
+        losses['base'] = torch.sum(unk_mask.cuda() * losses['base'])
 
-            loss_calibration_ = torch.tensor(0.0).cuda()
-
-        elif cfg.model.method == 'instance' or cfg.model.method == 'prototype':
-            loss_base_ = criterion['BCEWithLogitsLoss'](outputs, target_)
-
-            loss_plus_ = cfg.model.inter_distance_weight * criterion['InterInstanceDistanceLoss'](aux_feature, target) if epoch >= 1 else \
-                     cfg.model.inter_distance_weight * criterion['InterInstanceDistanceLoss'](aux_feature, target) * batch_index / float(len(train_loader))
-
-            loss_calibration_ = torch.tensor(0.0).cuda()
-
-        elif cfg.model.method == 'FL':
-            loss_base_ = criterion['FocalLoss'](outputs, target_)
-
-            loss_plus_ = torch.tensor(0.0).cuda()
-
-            loss_calibration_ = torch.tensor(0.0).cuda()
-        
-        elif cfg.model.method == 'FLSD':
-            loss_base_ = criterion['FLSD'](outputs, target_)
-
-            loss_plus_ = torch.tensor(0.0).cuda()
-
-            loss_calibration_ = torch.tensor(0.0).cuda()
-
-        elif cfg.model.method == 'MDCA':
-            loss_base_ = criterion['BCEWithLogitsLoss'](outputs, target_)
-
-            loss_plus_ = torch.tensor(0.0).cuda()
-
-            loss_calibration_ = criterion['MDCA'](outputs, target_)
-        
-        elif cfg.model.method == 'DCA':
-            loss_base_ = criterion['BCEWithLogitsLoss'](outputs, target_)
-
-            loss_plus_ = torch.tensor(0.0).cuda()
-
-            loss_calibration_ = criterion['DCA'](outputs, target_)
-        
-        elif cfg.model.method == 'MbLS':
-            loss_base_ = criterion['BCEWithLogitsLoss'](outputs, target_)
-
-            loss_plus_ = torch.tensor(0.0).cuda()
-
-            loss_calibration_ = criterion['MbLS'](outputs, target_)
-
-        
-        elif cfg.model.method == 'DWBL':
-            loss_base_ = criterion['DWBL'](outputs, target_)
-
-            loss_plus_ = torch.tensor(0.0).cuda()
-
-            loss_calibration_ = torch.tensor(0.0).cuda()
-
-        else:
-            loss_base_ = criterion['BCEWithLogitsLoss'](outputs, target_)
-
-            loss_plus_ = torch.tensor(0.0).cuda()
-
-            loss_calibration_ = torch.tensor(0.0).cuda()
-
-        loss_base_ = torch.sum(unk_mask.cuda() * loss_base_)
-
-        loss_ = loss_base_ + loss_plus_ + loss_calibration_
+        loss_ = sum(losses.values())
 
         loss.update(loss_.item(), input.size(0))
-        loss_base.update(loss_base_.item(), input.size(0))
-        loss_plus.update(loss_plus_.item(), input.size(0))
-        loss_calibration.update(loss_calibration_.item(), input.size(0))
+        loss_base.update(losses['base'].item(), input.size(0))
+        loss_plus.update(float(losses.get('plus', 0)), input.size(0))
+        loss_calibration.update(float(losses.get('calibration', 0)), input.size(0))
 
         # Backward
         loss_.backward()
@@ -284,8 +224,10 @@ def Train(train_loader, aux_model, ctran_model, criterion, optimizer, writer, ep
 def Validate(val_loader, model, ctran_model, criterion, epoch, cfg):
     ctran_model.eval()
 
-    apMeter = AveragePrecisionMeter()
-    pred, loss, batch_time, data_time = [], AverageMeter(), AverageMeter(), AverageMeter()
+    loss, batch_time, data_time = AverageMeter(), AverageMeter(), AverageMeter()
+    validationMeter = ValidationMeter(cfg.dataset.class_nums, keep_scores=cfg.exact_validation)
+    logitsWriter = LogitsStore(os.path.join(cfg.logits_path, cfg.post)).writer(epoch, cfg.dataset.class_nums, model=cfg.model.name, dataset=cfg.dataset.name) \
+                   if cfg.save_logits else None
     logger.info("=========================================")
 
     end = time.time()
@@ -310,8 +252,9 @@ def Validate(val_loader, model, ctran_model, criterion, epoch, cfg):
         # Change target to [0, 1]
         # target[target < 0] = 0
 
-        apMeter.add(outputs, target)
-        pred.append(torch.cat((outputs, (target > 0).float()), 1))
+        validationMeter.add(outputs, target)
+        if logitsWriter is not None:
+            logitsWriter.add(outputs, groundTruth, sample_index)
 
         # Log time of batch
         batch_time.update(time.time() - end)
@@ -327,20 +270,23 @@ def Validate(val_loader, model, ctran_model, criterion, epoch, cfg):
                 loss=loss))
             sys.stdout.flush()
 
-    pred = torch.cat(pred, 0).cpu().clone().numpy()
-    mAP = Compute_mAP_VOC2012(pred, cfg.dataset.class_nums)
+    if logitsWriter is not None:
+        logitsWriter.close()
+
+    res = validationMeter.value()
+    mAP, averageAP = res['mAP'], res['averageAP']
 
-    averageAP = apMeter.value().mean()
-    OP, OR, OF1, CP, CR, CF1 = apMeter.overall()
-    OP_K, OR_K, OF1_K, CP_K, CR_K, CF1_K = apMeter.overall_topk(3)
-    ACE, ECE, MCE = apMeter.calibration()
-    mACE, mECE, mMCE = apMeter.compute_classwise()
+    OP, OR, OF1, CP, CR, CF1 = [res[key] for key in ('OP', 'OR', 'OF1', 'CP', 'CR', 'CF1')]
+    OP_K, OR_K, OF1_K, CP_K, CR_K, CF1_K = [res[key] for key in ('OP_K', 'OR_K', 'OF1_K', 'CP_K', 'CR_K', 'CF1_K')]
+    ACE, ECE, MCE = res['ACE'], res['ECE'], res['MCE']
+    mACE, mECE, mMCE = res['mACE'], res['mECE'], res['mMCE']
+    pairECE = res['pair_ECE']
 
     logger.info(f'[Test] mAP: {mAP:.3f}, averageAP: {averageAP:.3f}\n'
                 f'\t\t\t\t(Compute with all label) OP: {OP:.3f}, OR: {OR:.3f}, OF1: {OF1:.3f}, CP: {CP:.3f}, CR: {CR:.3f}, CF1:{CF1:.3f}\n'
                 f'\t\t\t\t(Compute with top-3 label) OP: {OP_K:.3f}, OR: {OR_K:.3f}, OF1: {OF1_K:.3f}, CP: {CP_K:.3f}, CR: {CR_K:.3f}, CF1: {CF1_K:.3f}\n'
                 f'\t\t\t\tACE:{ACE:.6f}, ECE:{ECE:.6f}, MCE:{MCE:.6f}\n'
-                f'\t\t\t\tmACE:{mACE:.6f}, mECE:{mECE:.6f}, mMCE:{mMCE:.6f}')
+                f'\t\t\t\tmACE:{mACE:.6f}, mECE:{mECE:.6f}, mMCE:{mMCE:.6f}, pair-ECE:{pairECE:.6f}')
 
     return mAP, ACE, ECE, MCE
 
@@ -18,10 +18,12 @@ import torch.optim.lr_scheduler as lr_scheduler
 
 from model.SSGRL import SSGRL, update_feature, compute_prototype
 from loss import InstanceContrastiveLoss, PrototypeContrastiveLoss
+from calibration.pipeline import LossPipeline
 from calibration.Calibration import MDCA, FocalLoss, FLSD, DCA, MbLS, DWBL, MMCE
 
 from utils.dataloader import get_graph_and_word_file, get_data_loader
-from utils.metrics import AverageMeter, AveragePrecisionMeter, Compute_mAP_VOC2012
+from utils.metrics import AverageMeter, ValidationMeter
+from utils.logits_store import LogitsStore
 from utils.checkpoint import save_checkpoint
 from utils.label_smoothing import label_smoothing_tradition, label_smoothing_dynamic
 
@@ -101,6 +103,7 @@ def main(cfg: DictConfig):
                  'DWBL': DWBL().to(device),
                  'MMCE': MMCE().to(device),
                  }
+    lossPipeline = LossPipeline(cfg, criterion, instance_methods=('DPCAR', 'DPCAR_AUX', 'instance', 'PROTOTYPE'))
 
     optimizer = torch.optim.Adam(filter(lambda p : p.requires_grad, model.parameters()), lr=cfg.lr)
     scheduler = lr_scheduler.StepLR(optimizer, step_size=cfg.step_epoch, gamma=0.1)
@@ -124,7 +127,7 @@ def main(cfg: DictConfig):
                 compute_prototype(model, train_loader, cfg)
                 logger.info('Done!\n')
 
-        Train(cfg, train_loader, model, teacher_model, criterion, optimizer, writer, epoch)
+        Train(cfg, train_loader, model, teacher_model, lossPipeline, optimizer, writer, epoch)
         mAP, ACE, ECE, MCE = Validate(test_loader, model, criterion, epoch, cfg)
 
         scheduler.step()
@@ -142,7 +145,7 @@ def main(cfg: DictConfig):
 
     writer.close()
 
-def Train(cfg, train_loader, model, teacher_model, criterion, optimizer, writer, epoch):
+def Train(cfg, train_loader, model, teacher_model, lossPipeline, optimizer, writer, epoch):
     optimizer.zero_grad()
     model.train()
 
@@ -176,14 +179,14 @@ def Train(cfg, train_loader, model, teacher_model, criterion, optimizer, writer,
 
         elif cfg.model.method == 'DPCAR':
             update_feature(model, semantic_feature, target, cfg.model.inter_example_nums)
-            target_instance = label_smoothing_dynamic(cfg, full_labels, model.pos_feature, semantic_feature, epoch, 10)
-            target_prototype = label_smoothing_dynamic(cfg, full_labels, model.prototype, semantic_feature, epoch, 10)
+            target_ = (label_smoothing_dynamic(cfg, full_labels, model.pos_feature, semantic_feature, epoch, 10),
+                       label_smoothing_dynamic(cfg, full_labels, model.prototype, semantic_feature, epoch, 10))
         
         elif cfg.model.method == 'DPCAR_AUX':
             update_feature(model, semantic_feature, target, cfg.model.inter_example_nums)
             update_feature(teacher_model, aux_feature, target, cfg.model.inter_example_nums)
-            target_instance = label_smoothing_dynamic(cfg, full_labels, teacher_model.pos_feature, aux_feature, epoch, 10)
-            target_prototype = label_smoothing_dynamic(cfg, full_labels, teacher_model.prototype, aux_feature, epoch, 10)
+            target_ = (label_smoothing_dynamic(cfg, full_labels, teacher_model.pos_feature, aux_feature, epoch, 10),
+                       label_smoothing_dynamic(cfg, full_labels, teacher_model.prototype, aux_feature, epoch, 10))
 
         else:
             # Non Label Smoothing
@@ -191,100 +194,15 @@ def Train(cfg, train_loader, model, teacher_model, criterion, optimizer, writer,
             target_[target_ < 0] = 0
 
         # Loss
-        if cfg.model.method == 'DPCAR':
-            loss_instance = criterion['BCEWithLogitsLoss'](outputs, target_instance)
-            loss_prototype = criterion['BCEWithLogitsLoss'](outputs, target_prototype)
-            loss_base_ = (loss_instance + loss_prototype) / 2
+        warmup = 1.0 if epoch >= 1 else batch_index / float(len(train_loader))
+        losses = lossPipeline(outputs, target_, semantic_feature, target, warmup)
 
-            # warm up
-            loss_plus_ = cfg.model.inter_distance_weight * criterion['InterInstanceDistanceLoss'](semantic_feature, target) if epoch >= 1 else \
-                    cfg.model.inter_distance_weight * criterion['InterInstanceDistanceLoss'](semantic_feature, target) * batch_index / float(len(train_loader))
-
-            loss_calibration_ = torch.tensor(0.0).to(device)
-
-        elif cfg.model.method == 'DPCAR_AUX':
-            loss_instance = criterion['BCEWithLogitsLoss'](outputs, target_instance)
-            loss_prototype = criterion['BCEWithLogitsLoss'](outputs, target_prototype)
-            loss_base_ = (loss_instance + loss_prototype) / 2
-
-            loss_plus_ = cfg.model.inter_distance_weight * criterion['InterInstanceDistanceLoss'](semantic_feature, target) if epoch >= 1 else \
-                    cfg.model.inter_distance_weight * criterion['InterInstanceDistanceLoss'](semantic_feature, target) * batch_index / float(len(train_loader))
-
-            loss_calibration_ = torch.tensor(0.0).to(device)
-
-        elif cfg.model.method == 'instance' or cfg.model.method == 'PROTOTYPE':
-            loss_base_ = criterion['BCEWithLogitsLoss'](outputs, target_)
-
-            loss_plus_ = cfg.model.inter_distance_weight * criterion['InterInstanceDistanceLoss'](semantic_feature, target) if epoch >= 1 else \
-                     cfg.model.inter_distance_weight * criterion['InterInstanceDistanceLoss'](semantic_feature, target) * batch_index / float(len(train_loader))
-
-            loss_calibration_ = torch.tensor(0.0).to(device)
-
-        elif cfg.model.method == 'FL':
-            loss_base_ = criterion['FocalLoss'](outputs, target_)
-
-            loss_plus_ = torch.tensor(0.0).to(device)
-
-            loss_calibration_ = torch.tensor(0.0).to(device)
-        
-        elif cfg.model.method == 'FLSD':
-            loss_base_ = criterion['FLSD'](outputs, target_)
-
-            loss_plus_ = torch.tensor(0.0).to(device)
-
-            loss_calibration_ = torch.tensor(0.0).to(device)
-
-        elif cfg.model.method == 'MDCA':
-            loss_base_ = criterion['BCEWithLogitsLoss'](outputs, target_)
-
-            loss_plus_ = torch.tensor(0.0).to(device)
-
-            loss_calibration_ = criterion['MDCA'](outputs, target_)
-        
-        elif cfg.model.method == 'DCA':
-            loss_base_ = criterion['BCEWithLogitsLoss'](outputs, target_)
-
-            loss_plus_ = torch.tensor(0.0).to(device)
-
-            loss_calibration_ = criterion['DCA'](outputs, target_)
-        
-        elif cfg.model.method == 'MbLS':
-            loss_base_ = criterion['BCEWithLogitsLoss'](outputs, target_)
-
-            loss_plus_ = torch.tensor(0.0).to(device)
-
-            loss_calibration_ = criterion['MbLS'](outputs, target_)
-        
-        elif cfg.model.method == 'DWBL':
-            loss_base_ = criterion['DWBL'](outputs, target_)
-
-            loss_plus_ = torch.tensor(0.0).to(device)
-
-            loss_calibration_ = torch.tensor(0.0).to(device)
-        
-        elif cfg.model.method == 'MMCE':
-            loss_base_ = criterion['BCEWithLogitsLoss'](outputs, target_)
-
-            loss_plus_ = torch.tensor(0.0).to(device)
-
-            loss_calibration_ = criterion['MMCE'](outputs, target_)
-
-        else:
-            loss_base_ = criterion['BCEWithLogitsLoss'](outputs, target_)
-
-            # loss_plus_ = args.interDistanceWeight * criterion['InterInstanceDistanceLoss'](semantic_feature, target) if epoch >= 1 else \
-            #          args.interDistanceWeight * criterion['InterInstanceDistanceLoss'](semantic_feature, target) * batchIndex / float(len(train_loader))
-
-            loss_plus_ = torch.tensor(0.0).to(device)
-
-            loss_calibration_ = torch.tensor(0.0).to(device)
-            
-        loss_ = loss_base_ + loss_plus_ + loss_calibration_
+        loss_ = sum(losses.values())
 
         loss.update(loss_.item(), input.size(0))
-        loss_base.update(loss_base_.item(), input.size(0))
-        loss_plus.update(loss_plus_.item(), input.size(0))
-        loss_calibration.update(loss_calibration_.item(), input.size(0))
+        loss_base.update(losses['base'].item(), input.size(0))
+        loss_plus.update(float(losses.get('plus', 0)), input.size(0))
+        loss_calibration.update(float(losses.get('calibration', 0)), input.size(0))
 
         # Backward
         loss_.backward()
@@ -313,8 +231,10 @@ def Validate(val_loader, model, criterion, epoch, cfg):
 
     model.eval()
 
-    apMeter = AveragePrecisionMeter()
-    pred, loss, batch_time, data_time = [], AverageMeter(), AverageMeter(), AverageMeter()
+    loss, batch_time, data_time = AverageMeter(), AverageMeter(), AverageMeter()
+    validationMeter = ValidationMeter(cfg.dataset.class_nums, keep_scores=cfg.exact_validation)
+    logitsWriter = LogitsStore(os.path.join(cfg.logits_path, cfg.post)).writer(epoch, cfg.dataset.class_nums, model=cfg.model.name, dataset=cfg.dataset.name) \
+                   if cfg.save_logits else None
     logger.info("=========================================")
 
     end = time.time()
@@ -334,8 +254,9 @@ def Validate(val_loader, model, criterion, epoch, cfg):
         loss_ = criterion['BCEWithLogitsLoss'](output, target)
         loss.update(loss_.item(), input.size(0))
 
-        apMeter.add(output, target)
-        pred.append(torch.cat((output, (target > 0).float()), 1))
+        validationMeter.add(output, target)
+        if logitsWriter is not None:
+            logitsWriter.add(output, batch['full_labels'], batch['index'])
 
         # Log time of batch
         batch_time.update(time.time() - end)
@@ -351,20 +272,23 @@ def Validate(val_loader, model, criterion, epoch, cfg):
                 loss=loss))
             sys.stdout.flush()
 
-    pred = torch.cat(pred, 0).cpu().clone().numpy()
-    mAP = Compute_mAP_VOC2012(pred, cfg.dataset.class_nums)
+    if logitsWriter is not None:
+        logitsWriter.close()
+
+    res = validationMeter.value()
+    mAP, averageAP = res['mAP'], res['averageAP']
 
-    averageAP = apMeter.value().mean()
-    OP, OR, OF1, CP, CR, CF1 = apMeter.overall()
-    OP_K, OR_K, OF1_K, CP_K, CR_K, CF1_K = apMeter.overall_topk(3)
-    ACE, ECE, MCE = apMeter.calibration()
-    mACE, mECE, mMCE = apMeter.compute_classwise()
+    OP, OR, OF1, CP, CR, CF1 = [res[key] for key in ('OP', 'OR', 'OF1', 'CP', 'CR', 'CF1')]
+    OP_K, OR_K, OF1_K, CP_K, CR_K, CF1_K = [res[key] for key in ('OP_K', 'OR_K', 'OF1_K', 'CP_K', 'CR_K', 'CF1_K')]
+    ACE, ECE, MCE = res['ACE'], res['ECE'], res['MCE']
+    mACE, mECE, mMCE = res['mACE'], res['mECE'], res['mMCE']
+    pairECE = res['pair_ECE']
 
     logger.info(f'[Test]mAP: {mAP:.3f}, averageAP: {averageAP:.3f}\n'
                 f'(Compute with all label) OP: {OP:.3f}, OR: {OR:.3f}, OF1: {OF1:.3f}, CP: {CP:.3f}, CR: {CR:.3f}, CF1:{CF1:.3f}\n'
                 f'(Compute with top-3 label) OP: {OP_K:.3f}, OR: {OR_K:.3f}, OF1: {OF1_K:.3f}, CP: {CP_K:.3f}, CR: {CR_K:.3f}, CF1: {CF1_K:.3f}\n'
                 f'ACE:{ACE:.6f}, ECE:{ECE:.6f}, MCE:{MCE:.6f}\n'
-                f'mACE:{mACE:.6f}, mECE:{mECE:.6f}, mMCE:{mMCE:.6f}')
+                f'mACE:{mACE:.6f}, mECE:{mECE:.6f}, mMCE:{mMCE:.6f}, pair-ECE:{pairECE:.6f}')
 
     return mAP, ACE, ECE, MCE
 
@@ -17,10 +17,12 @@ import torch.optim.lr_scheduler as lr_scheduler
 
 from model.SSGRL import SSGRL, update_feature_ddp, compute_prototype_ddp
 from loss import InstanceContrastiveLoss, PrototypeContrastiveLoss
+from calibration.pipeline import LossPipeline
 from calibration.Calibration import MDCA, FocalLoss, FLSD, DCA, MbLS, DWBL, MMCE
 
-from utils.dataloader import get_graph_and_word_file, get_data_loader
-from utils.metrics import AverageMeter, AveragePrecisionMeter, Compute_mAP_VOC2012
+from utils.dataloader import get_graph_and_word_file, get_data_loader, get_shard_loader
+from utils.metrics import AverageMeter, ValidationMeter
+from utils.logits_store import LogitsStore
 from utils.checkpoint import save_checkpoint
 from utils.label_smoothing import label_smoothing_tradition, label_smoothing_dynamic
 
@@ -68,6 +70,7 @@ def main(cfg: DictConfig):
     if rank == 0:
         logger.info("==> Creating dataloader...")
     train_loader, test_loader = get_data_loader(cfg)
+    test_loader = get_shard_loader(test_loader, rank, dist.get_world_size())
     if rank == 0:
         logger.info("==> Done!\n")
 
@@ -113,6 +116,7 @@ def main(cfg: DictConfig):
                  'DWBL': DWBL().cuda(),
                  'MMCE': MMCE().cuda(),
                  }
+    lossPipeline = LossPipeline(cfg, criterion, instance_methods=('DPCAR', 'instance', 'PROTOTYPE'))
 
     optimizer = torch.optim.Adam(filter(lambda p : p.requires_grad, model.parameters()), lr=cfg.lr)
     scheduler = lr_scheduler.StepLR(optimizer, step_size=cfg.step_epoch, gamma=0.1)
@@ -140,9 +144,10 @@ def main(cfg: DictConfig):
         #     compute_prototype(teacher_model, train_loader, cfg)
         #     logger.info('Done!\n')
 
-        Train(cfg, train_loader, model, teacher_model, criterion, optimizer, epoch)
+        Train(cfg, train_loader, model, teacher_model, lossPipeline, optimizer, epoch)
+        res = Validate(test_loader, model, criterion, epoch, cfg)
         if rank == 0:
-            mAP, ACE, ECE, MCE = Validate(test_loader, model, criterion, epoch, cfg)
+            mAP, ACE, ECE, MCE = res
             isBest, best_prec = mAP > best_prec, max(mAP, best_prec)
             save_checkpoint(cfg, {'epoch':epoch, 'state_dict': model.module.state_dict(), 'best_mAP': mAP}, isBest)
             if isBest:
@@ -154,7 +159,7 @@ def main(cfg: DictConfig):
         scheduler.step()
             
 
-def Train(cfg, train_loader, model, teacher_model, criterion, optimizer, epoch):
+def Train(cfg, train_loader, model, teacher_model, lossPipeline, optimizer, epoch):
     optimizer.zero_grad()
     model.train()
 
@@ -190,13 +195,13 @@ def Train(cfg, train_loader, model, teacher_model, criterion, optimizer, epoch):
 
         elif cfg.model.method == 'DPCAR':
             update_feature_ddp(model, semantic_feature, target, cfg.model.inter_example_nums)
-            target_instance = label_smoothing_dynamic(cfg, full_labels, model.module.pos_feature, semantic_feature, epoch, 10)
-            target_prototype = label_smoothing_dynamic(cfg, full_labels, model.module.prototype, semantic_feature, epoch, 10)
+            target_ = (label_smoothing_dynamic(cfg, full_labels, model.module.pos_feature, semantic_feature, epoch, 10),
+                       label_smoothing_dynamic(cfg, full_labels, model.module.prototype, semantic_feature, epoch, 10))
         
         elif cfg.model.method == 'DPCAR_AUX':
             update_feature_ddp(teacher_model, aux_feature, target, cfg.model.inter_example_nums)
-            target_instance = label_smoothing_dynamic(cfg, full_labels, teacher_model.pos_feature, aux_feature, epoch, 10)
-            target_prototype = label_smoothing_dynamic(cfg, full_labels, teacher_model.prototype, aux_feature, epoch, 10)
+            target_ = (label_smoothing_dynamic(cfg, full_labels, teacher_model.pos_feature, aux_feature, epoch, 10),
+                       label_smoothing_dynamic(cfg, full_labels, teacher_model.prototype, aux_feature, epoch, 10))
 
         else:
             # Non Label Smoothing
@@ -204,99 +209,15 @@ def Train(cfg, train_loader, model, teacher_model, criterion, optimizer, epoch):
             target_[target_ < 0] = 0
 
         # Loss
-        if cfg.model.method == 'DPCAR':
-            loss_instance = criterion['BCEWithLogitsLoss'](outputs, target_instance)
-            loss_prototype = criterion['BCEWithLogitsLoss'](outputs, target_prototype)
-            loss_base_ = (loss_instance + loss_prototype) / 2
+        warmup = 1.0 if epoch >= 1 else batch_index / float(len(train_loader))
+        losses = lossPipeline(outputs, target_, semantic_feature, target, warmup)
 
-            # warm up
-            loss_plus_ = cfg.model.inter_distance_weight * criterion['InterInstanceDistanceLoss'](semantic_feature, target) if epoch >= 1 else \
-                    cfg.model.inter_distance_weight * criterion['InterInstanceDistanceLoss'](semantic_feature, target) * batch_index / float(len(train_loader))
-
-            loss_calibration_ = torch.tensor(0.0).cuda()
-
-        elif cfg.model.method == 'DPCAR_AUX':
-            loss_instance = criterion['BCEWithLogitsLoss'](outputs, target_instance)
-            loss_prototype = criterion['BCEWithLogitsLoss'](outputs, target_prototype)
-            loss_base_ = (loss_instance + loss_prototype) / 2
-
-            loss_plus_ = torch.tensor(0.0).cuda()
-
-            loss_calibration_ = torch.tensor(0.0).cuda()
-
-        elif cfg.model.method == 'instance' or cfg.model.method == 'PROTOTYPE':
-            loss_base_ = criterion['BCEWithLogitsLoss'](outputs, target_)
-
-            loss_plus_ = cfg.model.inter_distance_weight * criterion['InterInstanceDistanceLoss'](semantic_feature, target) if epoch >= 1 else \
-                     cfg.model.inter_distance_weight * criterion['InterInstanceDistanceLoss'](semantic_feature, target) * batch_index / float(len(train_loader))
-
-            loss_calibration_ = torch.tensor(0.0).cuda()
-
-        elif cfg.model.method == 'FL':
-            loss_base_ = criterion['FocalLoss'](outputs, target_)
-
-            loss_plus_ = torch.tensor(0.0).cuda()
-
-            loss_calibration_ = torch.tensor(0.0).cuda()
-        
-        elif cfg.model.method == 'FLSD':
-            loss_base_ = criterion['FLSD'](outputs, target_)
-
-            loss_plus_ = torch.tensor(0.0).cuda()
-
-            loss_calibration_ = torch.tensor(0.0).cuda()
-
-        elif cfg.model.method == 'MDCA':
-            loss_base_ = criterion['BCEWithLogitsLoss'](outputs, target_)
-
-            loss_plus_ = torch.tensor(0.0).cuda()
-
-            loss_calibration_ = criterion['MDCA'](outputs, target_)
-        
-        elif cfg.model.method == 'DCA':
-            loss_base_ = criterion['BCEWithLogitsLoss'](outputs, target_)
-
-            loss_plus_ = torch.tensor(0.0).cuda()
-
-            loss_calibration_ = criterion['DCA'](outputs, target_)
-        
-        elif cfg.model.method == 'MbLS':
-            loss_base_ = criterion['BCEWithLogitsLoss'](outputs, target_)
-
-            loss_plus_ = torch.tensor(0.0).cuda()
-
-            loss_calibration_ = criterion['MbLS'](outputs, target_)
-        
-        elif cfg.model.method == 'DWBL':
-            loss_base_ = criterion['DWBL'](outputs, target_)
-
-            loss_plus_ = torch.tensor(0.0).cuda()
-
-            loss_calibration_ = torch.tensor(0.0).cuda()
-        
-        elif cfg.model.method == 'MMCE':
-            loss_base_ = criterion['BCEWithLogitsLoss'](outputs, target_)
-
-            loss_plus_ = torch.tensor(0.0).cuda()
-
-            loss_calibration_ = criterion['MMCE'](outputs, target_)
-
-        else:
-            loss_base_ = criterion['BCEWithLogitsLoss'](outputs, target_)
-
-            # loss_plus_ = args.interDistanceWeight * criterion['InterInstanceDistanceLoss'](semantic_feature, target) if epoch >= 1 else \
-            #          args.interDistanceWeight * criterion['InterInstanceDistanceLoss'](semantic_feature, target) * batchIndex / float(len(train_loader))
-
-            loss_plus_ = torch.tensor(0.0).cuda()
-
-            loss_calibration_ = torch.tensor(0.0).cuda()
-            
-        loss_ = loss_base_ + loss_plus_ + loss_calibration_
+        loss_ = sum(losses.values())
 
         loss.update(loss_.item(), input.size(0))
-        loss_base.update(loss_base_.item(), input.size(0))
-        loss_plus.update(loss_plus_.item(), input.size(0))
-        loss_calibration.update(loss_calibration_.item(), input.size(0))
+        loss_base.update(losses['base'].item(), input.size(0))
+        loss_plus.update(float(losses.get('plus', 0)), input.size(0))
+        loss_calibration.update(float(losses.get('calibration', 0)), input.size(0))
 
         # Backward
         loss_.backward()
@@ -317,12 +238,25 @@ def Train(cfg, train_loader, model, teacher_model, criterion, optimizer, epoch):
             sys.stdout.flush()
 
 def Validate(val_loader, model, criterion, epoch, cfg):
+    """
+    Sharded validation, every rank runs `val_loader` (its shard, see
+    `get_shard_loader`) and the outputs are gathered to rank 0, which replays
+    them in the original batch order, so metrics are the ones of a single
+    process over the full test loader. Without `cfg.exact_validation` only the
+    streamed ValidationMeter of every rank is gathered, not the outputs.
+    Returns None on the other ranks.
+    """
 
     model.eval()
+    # Plain module: DDP forward syncs buffers and would hang on shards of different lengths
+    module = model.module if hasattr(model, 'module') else model
 
-    apMeter = AveragePrecisionMeter()
-    pred, loss, batch_time, data_time = [], AverageMeter(), AverageMeter(), AverageMeter()
-    logger.info("=========================================")
+    batches, losses, batch_time, data_time = [], [], AverageMeter(), AverageMeter()
+    # Outputs are only gathered when rank 0 needs them, otherwise every rank streams its shard
+    keep_batches = cfg.exact_validation or cfg.save_logits
+    validationMeter = None if cfg.exact_validation else ValidationMeter(cfg.dataset.class_nums, keep_scores=False)
+    if comm.is_main_process():
+        logger.info("=========================================")
 
     end = time.time()
     for batch_index, batch in enumerate(val_loader):
@@ -337,48 +271,76 @@ def Validate(val_loader, model, criterion, epoch, cfg):
 
         # Forward
         with torch.no_grad():
-            output, semantic_feature = model(input)
+            output, semantic_feature = module(input)
 
         target[target < 0] = 0
 
         # Compute loss and prediction
         loss_ = criterion['BCEWithLogitsLoss'](output, target)
-        loss.update(loss_.item(), input.size(0))
 
         # Change target to [0, 1]
         # target[target < 0] = 0
 
-        apMeter.add(output, target)
-        pred.append(torch.cat((output, (target > 0).float()), 1))
+        losses.append((loss_.item(), output.size(0)))
+        if validationMeter is not None:
+            validationMeter.add(output, target)
+        if keep_batches:
+            batches.append((output.cpu(), target.cpu(), batch['full_labels'], batch['index']))
 
         # Log time of batch
         batch_time.update(time.time() - end)
         end = time.time()
 
         # logger.info information of current batch        
-        if batch_index % cfg.print_freq == 0:
+        if batch_index % cfg.print_freq == 0 and comm.is_main_process():
             logger.info('[Test] [Epoch {0}]: [{1:04d}/{2}] '
-                        'Batch Time {batch_time.avg:.3f} Data Time {data_time.avg:.3f} '
-                        'Loss {loss.val:.4f} ({loss.avg:.4f})'.format(
+                        'Batch Time {batch_time.avg:.3f} Data Time {data_time.avg:.3f}'.format(
                 epoch, batch_index, len(val_loader),
-                batch_time=batch_time, data_time=data_time,
-                loss=loss))
+                batch_time=batch_time, data_time=data_time))
             sys.stdout.flush()
 
-    pred = torch.cat(pred, 0).cpu().clone().numpy()
-    mAP = Compute_mAP_VOC2012(pred, cfg.dataset.class_nums)
-
-    averageAP = apMeter.value().mean()
-    OP, OR, OF1, CP, CR, CF1 = apMeter.overall()
-    OP_K, OR_K, OF1_K, CP_K, CR_K, CF1_K = apMeter.overall_topk(3)
-    ACE, ECE, MCE = apMeter.calibration()
-    mACE, mECE, mMCE = apMeter.compute_classwise()
-
-    logger.info(f'[Test]mAP: {mAP:.3f}, averageAP: {averageAP:.3f}\n'
+    # One gather over the default (cached) gloo group, shards in rank order are the batches of the full test loader
+    shards = comm.gather((losses, batches, validationMeter), group=None)
+    if not comm.is_main_process():
+        return None
+
+    losses = [loss_ for shard in shards for loss_ in shard[0]]
+    batches = [batch for shard in shards for batch in shard[1]]
+    meters = [shard[2] for shard in shards]
+
+    loss = AverageMeter()
+    for loss_, num in losses:
+        loss.update(loss_, num)
+
+    if cfg.exact_validation:
+        validationMeter = ValidationMeter(cfg.dataset.class_nums)
+        for output, target, _, _ in batches:
+            validationMeter.add(output, target)
+    else:
+        validationMeter = meters[0]
+        for meter in meters[1:]:
+            validationMeter.merge(meter)
+
+    if cfg.save_logits:
+        logitsWriter = LogitsStore(os.path.join(cfg.logits_path, cfg.post)).writer(epoch, cfg.dataset.class_nums, model=cfg.model.name, dataset=cfg.dataset.name)
+        for output, _, full_labels, index in batches:
+            logitsWriter.add(output, full_labels, index)
+        logitsWriter.close()
+
+    res = validationMeter.value()
+    mAP, averageAP = res['mAP'], res['averageAP']
+
+    OP, OR, OF1, CP, CR, CF1 = [res[key] for key in ('OP', 'OR', 'OF1', 'CP', 'CR', 'CF1')]
+    OP_K, OR_K, OF1_K, CP_K, CR_K, CF1_K = [res[key] for key in ('OP_K', 'OR_K', 'OF1_K', 'CP_K', 'CR_K', 'CF1_K')]
+    ACE, ECE, MCE = res['ACE'], res['ECE'], res['MCE']
+    mACE, mECE, mMCE = res['mACE'], res['mECE'], res['mMCE']
+    pairECE = res['pair_ECE']
+
+    logger.info(f'[Test]mAP: {mAP:.3f}, averageAP: {averageAP:.3f}, Loss: {loss.avg:.4f}\n'
                 f'(Compute with all label) OP: {OP:.3f}, OR: {OR:.3f}, OF1: {OF1:.3f}, CP: {CP:.3f}, CR: {CR:.3f}, CF1:{CF1:.3f}\n'
                 f'(Compute with top-3 label) OP: {OP_K:.3f}, OR: {OR_K:.3f}, OF1: {OF1_K:.3f}, CP: {CP_K:.3f}, CR: {CR_K:.3f}, CF1: {CF1_K:.3f}\n'
                 f'ACE:{ACE:.6f}, ECE:{ECE:.6f}, MCE:{MCE:.6f}\n'
-                f'mACE:{mACE:.6f}, mECE:{mECE:.6f}, mMCE:{mMCE:.6f}')
+                f'mACE:{mACE:.6f}, mECE:{mECE:.6f}, mMCE:{mMCE:.6f}, pair-ECE:{pairECE:.6f}')
 
     return mAP, ACE, ECE, MCE
 
@@ -0,0 +1,203 @@
+"""
+CPU micro-benchmark of the metrics and calibration functions.
+Runs every function on synthetic scores/labels at COCO (40k x 80) and VG
+(100k x 200) scale, and writes wall time and peak memory to a JSON file.
+No dataset or GPU is needed.
+
+    python benchmark_metrics.py --output benchmark.json
+    python benchmark_metrics.py --scales COCO --functions mAP_VOC2012 ace_multi --compare benchmark.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import multiprocessing
+import queue as queue_module
+
+import numpy as np
+
+import torch
+
+# Rows, classes and mean positives per image
+_Scales = {'COCO': (40000, 80, 2.9),
+           'VG': (100000, 200, 5.0),
+          }
+
+_Functions = ['mAP_VOC2012', 'APMeter_value', 'APMeter_overall', 'APMeter_overall_topk',
+              'ace_multi', 'classwise_ace_multi', 'classwise_ece_multi', 'classwise_mce_multi',
+              'EvaluationReport']
+
+def make_data(rowNum, classNum, positiveNum, seed=0):
+    """
+    Synthetic logits and {0, 1} labels with a long-tailed class frequency
+    (Zipf-like, `positiveNum` positives per image on average) and logits
+    that separate positives from negatives imperfectly.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    frequency = 1.0 / np.arange(1, classNum + 1) ** 0.8
+    frequency = np.clip(frequency * positiveNum / frequency.sum(), 1e-3, 0.9)
+    labels = (rng.random((rowNum, classNum)) < frequency[rng.permutation(classNum)]).astype(np.int64)
+
+    logits = rng.normal(-3.0, 1.5, (rowNum, classNum)) + 4.0 * labels
+    return torch.from_numpy(logits.astype(np.float32)), torch.from_numpy(labels)
+
+def get_function(name, logits, labels):
+    """Zero-argument callable running `name` on the data"""
+
+    from utils import metrics
+
+    if name == 'mAP_VOC2012':
+        prediction = np.concatenate((logits.numpy(), labels.numpy()), axis=1)
+        return lambda: metrics.Compute_mAP_VOC2012(prediction, logits.size(1))
+    if name.startswith('APMeter'):
+        meter = metrics.AveragePrecisionMeter(difficult_examples=False)
+        meter.add(logits, labels)
+        return {'APMeter_value': meter.value,
+                'APMeter_overall': meter.overall,
+                'APMeter_overall_topk': lambda: meter.overall_topk(3)}[name]
+    if name == 'EvaluationReport':
+        def report():
+            report = metrics.EvaluationReport(logits, labels)
+            return report.mAP(), report.averageAP(), report.overall(), report.overall_topk(3), report.calibration(), report.classwise()
+        return report
+
+    # The compute_* calibration functions take probabilities, as in AveragePrecisionMeter.compute_calibration_error
+    function, probs = getattr(metrics, 'compute_' + name), torch.sigmoid(logits)
+    return lambda: function(probs, labels)
+
+def read_proc_status(key):
+    """Value of /proc/self/status `key` in kB, None where not available"""
+
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def reset_peak_memory():
+    """Reset VmHWM to the current RSS (Linux >= 4.0), returns whether it worked"""
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def run_case(scale, name, repeat, seed, queue):
+    """Benchmark one function in a fresh process, so that peak memory is its own"""
+
+    try:
+        logits, labels = make_data(*_Scales[scale], seed=seed)
+        function = get_function(name, logits, labels)
+
+        before = read_proc_status('VmRSS')
+        exact = reset_peak_memory()
+
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+
+        if exact and before is not None:
+            peak = read_proc_status('VmHWM') - before
+        else:
+            # Peak of the whole process, data generation included
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        queue.put({'times': times, 'peak_memory_mb': peak / 1024.0, 'peak_memory_exact': exact})
+    except Exception as e:
+        queue.put({'error': '{}: {}'.format(type(e).__name__, e)})
+
+def wait_result(process, queue):
+    """Result of a case, or an error if its process died (e.g. killed when out of memory)"""
+
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except queue_module.Empty:
+            if not process.is_alive():
+                return {'error': 'process exited with code {}'.format(process.exitcode)}
+
+def benchmark(scales, functions, repeat, seed):
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+
+    for scale in scales:
+        rowNum, classNum, _ = _Scales[scale]
+        for name in functions:
+            queue = context.Queue()
+            process = context.Process(target=run_case, args=(scale, name, repeat, seed, queue))
+            process.start()
+            res = wait_result(process, queue)
+            process.join()
+
+            res.update({'scale': scale, 'function': name, 'rows': rowNum, 'classes': classNum})
+            if 'times' in res:
+                res['median_s'], res['min_s'] = float(np.median(res['times'])), float(np.min(res['times']))
+                print('[{}] {:<22s} median {:8.3f}s  min {:8.3f}s  peak {:9.1f}MB'.format(scale, name, res['median_s'], res['min_s'], res['peak_memory_mb']))
+            else:
+                print('[{}] {:<22s} {}'.format(scale, name, res['error']))
+            sys.stdout.flush()
+
+            results.append(res)
+
+    return results
+
+def compare(results, path):
+    """Print the median time and peak memory ratio against a previous run"""
+
+    with open(path, 'r') as f:
+        previous = {(res['scale'], res['function']): res for res in json.load(f)['results'] if 'times' in res}
+
+    print('\nCompared with {}:'.format(path))
+    for res in results:
+        old = previous.get((res['scale'], res['function']))
+        if old is None or 'times' not in res:
+            continue
+        print('[{}] {:<22s} time x{:6.2f}  memory x{:6.2f}'.format(res['scale'], res['function'],
+              res['median_s'] / max(old['median_s'], 1e-9), res['peak_memory_mb'] / max(old['peak_memory_mb'], 1e-9)))
+
+def main():
+
+    parser = argparse.ArgumentParser(description='CPU benchmark of utils/metrics.py')
+    parser.add_argument('--scales', type=str, nargs='+', default=list(_Scales), choices=list(_Scales))
+    parser.add_argument('--functions', type=str, nargs='+', default=_Functions, choices=_Functions)
+    parser.add_argument('--repeat', type=int, default=3, help='timed calls per function')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='benchmark_metrics.json')
+    parser.add_argument('--compare', type=str, default=None, help='previous output to compare with')
+    args = parser.parse_args()
+
+    results = benchmark(args.scales, args.functions, args.repeat, args.seed)
+
+    meta = {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'torch_threads': torch.get_num_threads(),
+            'repeat': args.repeat,
+            'seed': args.seed}
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+    with open(args.output, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2)
+    print('Results saved to {}'.format(args.output))
+
+if __name__ == '__main__':
+    main()
@@ -2,8 +2,9 @@ import torch
 import torch.nn as nn
 import logging
 
-from .MMCE import MMCE_weighted
+from .MMCE import MMCE_weighted_sorted
 from .FLSD import FocalLossAdaptive
+from .focal import focal_loss, dwbl_loss
 from torch.nn import functional as F
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -14,17 +15,8 @@ class FocalLoss(nn.Module):
 
         self.gamma = 0.5
 
-    def forward(self, input, target):
-        pos_input = F.logsigmoid(input)
-        neg_input = F.logsigmoid(-input)
-        sigmoid_input = torch.sigmoid(input)
-
-        pt = torch.where(target == 1, sigmoid_input, 1 - sigmoid_input)
-        pt = torch.clamp(pt, 0.001, 0.999)
-        log_pt = torch.where(target == 1, pos_input, neg_input)
-        loss = -1 * (1 - pt) ** self.gamma * log_pt
-
-        return loss.mean()
+    def forward(self, input, target, probs=None, log_probs=None):
+        return focal_loss(input, target, self.gamma, probs, log_probs)
 
 class CrossEntropy(nn.Module):
     def __init__(self) -> None:
@@ -55,8 +47,8 @@ class MDCA(torch.nn.Module):
     def __init__(self):
         super(MDCA,self).__init__()
 
-    def forward(self, output, target):
-        output = torch.sigmoid(output)
+    def forward(self, output, target, probs=None):
+        output = torch.sigmoid(output) if probs is None else probs
         avg_count = torch.mean(target, dim=0)
         avg_conf = torch.mean(output, dim=0)
         loss = torch.abs(avg_conf - avg_count)
@@ -86,20 +78,10 @@ class DWBL(nn.Module):
                     1339,  1185,  821,  2202,  1062,  2080,  8949,  3169,  3084,  2539,
                     8378,  2316, 3191,  2474,  1290,  2179,  1471,  3321,  1088,  2002,
                     151,   3288, 1671,  3732,  3158,  2530,   673,  1510,   128,   700,]
-        self.weight = torch.log(torch.tensor(max(weight)) / torch.tensor(weight)).cuda() + 1
-
-    def forward(self, input, target):
-
-        pos_input = F.logsigmoid(input)
-        neg_input = F.logsigmoid(-input)
-        sigmoid_input = torch.sigmoid(input)
+        self.register_buffer('weight', torch.log(torch.tensor(max(weight)) / torch.tensor(weight)) + 1)
 
-        pt = torch.where(target == 1, sigmoid_input, 1 - sigmoid_input)
-        pt = torch.clamp(pt, 0.001, 0.999)
-        log_pt = torch.where(target == 1, pos_input, neg_input)
-        loss = -1 * self.weight **  (1 - pt) * log_pt - 0.5 * pt * (1 - pt)
-
-        return loss.mean()
+    def forward(self, input, target, probs=None, log_probs=None):
+        return dwbl_loss(input, target, self.weight.to(input.dtype), probs, log_probs)
 
 
 class ClassficationAndMDCA(nn.Module):
@@ -143,8 +125,8 @@ class DCA(nn.Module):
     def __init__(self, beta=1.0, **kwargs):
         super().__init__()
 
-    def forward(self, output, target):
-        conf = torch.sigmoid(output)
+    def forward(self, output, target, probs=None):
+        conf = torch.sigmoid(output) if probs is None else probs
         calib_loss = torch.abs(conf.mean() - target.mean())
         return 0.05 * calib_loss
 
@@ -152,7 +134,7 @@ class MMCE(nn.Module):
     def __init__(self, beta=2.0, **kwargs):
         super().__init__()
         self.beta = 0.1
-        self.mmce = MMCE_weighted()
+        self.mmce = MMCE_weighted_sorted()
         # self.cls_loss = nn.CrossEntropyLoss()
 
     def forward(self, logits, targets):
@@ -166,8 +148,8 @@ class FLSD(nn.Module):
         self.gamma = gamma
         self.criterion = FocalLossAdaptive(gamma=self.gamma)
 
-    def forward(self, logits, targets):
-        return self.criterion.forward(logits, targets)
+    def forward(self, logits, targets, probs=None):
+        return self.criterion.forward(logits, targets, probs)
 
 
 loss_dict = {
@@ -6,6 +6,8 @@ from torch.autograd import Variable
 from scipy.special import lambertw
 import numpy as np
 
+from .focal import flsd_loss
+
 
 def get_gamma(p=0.2):
     '''
@@ -21,18 +23,5 @@ class FocalLossAdaptive(nn.Module):
         super(FocalLossAdaptive, self).__init__()
         self.gamma = 1
 
-    def get_gamma_list(self, pt):
-        gamma = torch.full([pt.size(0), pt.size(1)], self.gamma, device=pt.device)
-        gamma[pt > 0.2] = 0.5
-        return gamma
-
-    def forward(self, input, target):
-        input = torch.sigmoid(input)
-        
-        neg_input = 1 - input
-        pt = torch.where(target == 1, input, neg_input)
-        pt = torch.clamp(pt, 0.001, 0.999)
-        gamma = self.get_gamma_list(pt)
-        loss = -1 * (1 - pt) ** gamma * torch.log(pt)
-        
-        return loss.mean()
+    def forward(self, input, target, probs=None):
+        return flsd_loss(input, target, self.gamma, gamma_low=0.5, threshold=0.2, probs=probs)
@@ -0,0 +1,72 @@
+import torch
+from torch.nn import functional as F
+
+
+class FocalFamilyFunction(torch.autograd.Function):
+    """
+    Mean focal-family loss of sigmoid outputs, with its gradient computed in
+    the forward pass: only the gradient (one tensor of the input size) is
+    kept for backward instead of the sigmoid / logsigmoid / where / clamp /
+    pow intermediates of autograd.
+    With z = input if target == 1 else -input, pt = clamp(sigmoid(z), 0.001, 0.999):
+        focal: -(1 - pt) ** gamma * logsigmoid(z)
+        dwbl:  -weight ** (1 - pt) * logsigmoid(z) - 0.5 * pt * (1 - pt), weight per class
+        flsd:  -(1 - pt) ** gamma * log(pt), gamma = gamma_low if pt > threshold else gamma
+    pt gets no gradient outside the clamp range, as with torch.clamp.
+    `probs` = sigmoid(input) and `log_probs` = (logsigmoid(input), logsigmoid(-input))
+    are optional, computed once per step and shared by several losses (LossPipeline).
+    """
+
+    @staticmethod
+    def forward(ctx, input, target, loss_type, gamma, weight, gamma_low, threshold, probs=None, log_probs=None):
+
+        # Tensor operands of torch.where, scalars need torch >= 1.12
+        sign = torch.where(target == 1, input.new_tensor(1.0), input.new_tensor(-1.0))
+        z = input * sign
+
+        sigmoid_z = torch.sigmoid(z) if probs is None else torch.where(target == 1, probs, 1 - probs)
+        pt = torch.clamp(sigmoid_z, 0.001, 0.999)
+        # d pt / d z, zero where pt is clamped
+        dpt = torch.where((sigmoid_z >= 0.001) & (sigmoid_z <= 0.999), sigmoid_z * (1 - sigmoid_z), torch.zeros_like(sigmoid_z))
+
+        if loss_type in ('focal', 'dwbl'):
+            log_pt = F.logsigmoid(z) if log_probs is None else torch.where(target == 1, log_probs[0], log_probs[1])
+
+        if loss_type == 'focal':
+            factor = (1 - pt) ** gamma
+            loss = -factor * log_pt
+            grad = gamma * factor / (1 - pt) * log_pt * dpt - factor * (1 - sigmoid_z)
+
+        elif loss_type == 'dwbl':
+            factor = weight ** (1 - pt)
+            loss = -factor * log_pt - 0.5 * pt * (1 - pt)
+            grad = (torch.log(weight) * factor * log_pt - 0.5 * (1 - 2 * pt)) * dpt - factor * (1 - sigmoid_z)
+
+        elif loss_type == 'flsd':
+            log_pt = torch.log(pt)
+            gamma = torch.where(pt > threshold, pt.new_tensor(gamma_low), pt.new_tensor(gamma))
+            factor = (1 - pt) ** gamma
+            loss = -factor * log_pt
+            grad = (gamma * factor / (1 - pt) * log_pt - factor / pt) * dpt
+
+        else:
+            raise ValueError('Unknown focal loss {}'.format(loss_type))
+
+        if ctx.needs_input_grad[0]:
+            ctx.save_for_backward(grad * sign / input.numel())
+        return loss.mean()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad, = ctx.saved_tensors
+        return grad * grad_output, None, None, None, None, None, None, None, None
+
+
+def focal_loss(input, target, gamma=0.5, probs=None, log_probs=None):
+    return FocalFamilyFunction.apply(input, target, 'focal', gamma, None, None, None, probs, log_probs)
+
+def dwbl_loss(input, target, weight, probs=None, log_probs=None):
+    return FocalFamilyFunction.apply(input, target, 'dwbl', None, weight, None, None, probs, log_probs)
+
+def flsd_loss(input, target, gamma=1.0, gamma_low=0.5, threshold=0.2, probs=None):
+    return FocalFamilyFunction.apply(input, target, 'flsd', gamma, None, gamma_low, threshold, probs, None)
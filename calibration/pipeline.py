@@ -0,0 +1,111 @@
+import torch
+from torch.nn import functional as F
+
+from .Calibration import MDCA, FocalLoss, FLSD, DCA, MbLS, DWBL, MMCE
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+# cfg.model.method -> (criterion key, class) of the base loss replacing BCE
+base_loss_dict = {
+    'FL': ('FocalLoss', FocalLoss),
+    'FLSD': ('FLSD', FLSD),
+    'DWBL': ('DWBL', DWBL),
+}
+
+# cfg.model.method -> (criterion key, class) of the calibration term added to the base loss
+calibration_loss_dict = {
+    'MDCA': ('MDCA', MDCA),
+    'DCA': ('DCA', DCA),
+    'MbLS': ('MbLS', MbLS),
+    'MMCE': ('MMCE', MMCE),
+}
+
+# Shared intermediates every term takes as keyword arguments:
+#     probs: sigmoid(outputs)
+#     log_probs: (logsigmoid(outputs), logsigmoid(-outputs))
+shared_inputs = {
+    FocalLoss: ('probs', 'log_probs'),
+    DWBL: ('probs', 'log_probs'),
+    FLSD: ('probs',),
+    MDCA: ('probs',),
+    DCA: ('probs',),
+}
+
+class LossPipeline(object):
+    """
+    Training loss of `cfg.model.method`, resolved once instead of at every step:
+        base: criterion 'BCEWithLogitsLoss', or the base loss of base_loss_dict,
+            averaged over the targets when several are given (DPCAR)
+        plus: inter-instance distance loss of the features, for `instance_methods`
+        calibration: the term of calibration_loss_dict
+    Modules are read from `criterion` when it has them, built from the
+    registries otherwise, so a new term only needs a registry entry. The
+    intermediates of shared_inputs are computed once per step and passed to
+    every term taking them, the base loss of each DPCAR target included. The
+    features have a single consumer, the instance loss, which normalizes them.
+    """
+
+    def __init__(self, cfg, criterion, instance_methods=('DPCAR', 'DPCAR_AUX', 'instance', 'PROTOTYPE')):
+        """
+        Args:
+            cfg: experiment config, uses cfg.model.method and cfg.model.inter_distance_weight
+            criterion (dict): loss modules of the training script, 'BCEWithLogitsLoss'
+                and 'InterInstanceDistanceLoss' are used as they are
+            instance_methods (tuple): methods adding the inter-instance distance loss
+        """
+
+        method = cfg.model.method
+
+        self.base = self._get(criterion, *base_loss_dict[method]) if method in base_loss_dict else criterion['BCEWithLogitsLoss']
+        self.calibration = self._get(criterion, *calibration_loss_dict[method]) if method in calibration_loss_dict else None
+
+        self.instance = criterion['InterInstanceDistanceLoss'] if method in instance_methods else None
+        self.inter_distance_weight = cfg.model.inter_distance_weight if self.instance is not None else 0
+
+        self.base_inputs = shared_inputs.get(type(self.base), ())
+        self.calibration_inputs = shared_inputs.get(type(self.calibration), ())
+
+    def _get(self, criterion, key, cls):
+        return criterion[key] if key in criterion else cls().to(device)
+
+    def terms(self):
+        """Names of the active terms"""
+
+        return ['base'] + (['plus'] if self.instance is not None else []) + (['calibration'] if self.calibration is not None else [])
+
+    def __call__(self, outputs, targets, feature=None, labels=None, warmup=1.0):
+        """
+        Args:
+            outputs (Tensor): (BatchSize, classNum) logits
+            targets (Tensor or tuple): (BatchSize, classNum) training targets, a
+                tuple of targets averages the base loss over them
+            feature (Tensor): (BatchSize, classNum, featureDim) features of the instance loss
+            labels (Tensor): (BatchSize, classNum) labels (-1, 0, 1) of the instance loss
+            warmup (float): factor of the instance loss
+
+        Return:
+            losses (dict): value of every active term
+        """
+
+        needed = set(self.base_inputs) | set(self.calibration_inputs)
+        shared = {}
+        if 'probs' in needed:
+            shared['probs'] = torch.sigmoid(outputs)
+        if 'log_probs' in needed:
+            shared['log_probs'] = (F.logsigmoid(outputs), F.logsigmoid(-outputs))
+        base_inputs = {key: shared[key] for key in self.base_inputs}
+
+        if isinstance(targets, (tuple, list)):
+            losses = {'base': sum(self.base(outputs, target, **base_inputs) for target in targets) / len(targets)}
+            target = targets[0]
+        else:
+            losses = {'base': self.base(outputs, targets, **base_inputs)}
+            target = targets
+
+        if self.instance is not None:
+            losses['plus'] = self.inter_distance_weight * self.instance(feature, labels) * warmup
+
+        if self.calibration is not None:
+            losses['calibration'] = self.calibration(outputs, target, **{key: shared[key] for key in self.calibration_inputs})
+
+        return losses
@@ -0,0 +1,253 @@
+import numpy as np
+
+import torch
+from torch.nn import functional as F
+from sklearn.isotonic import IsotonicRegression
+
+from model.element_wise_layer import ElementWiseLayer
+
+# =============================================================================
+# Post-hoc calibrators, fitted on cached validation logits (see utils/logits_store.py)
+# =============================================================================
+class TemperatureScaling(object):
+    """
+    One temperature shared by all classes, logits / T.
+    Fitted by Newton's method on the binary NLL of all (sample, class) logits.
+    """
+
+    affine = True
+
+    def __init__(self):
+        self.scale, self.bias = torch.ones(1, dtype=torch.float64), torch.zeros(1, dtype=torch.float64)
+
+    @property
+    def temperature(self):
+        return 1.0 / self.scale.item()
+
+    def fit(self, logits, labels, max_iter=100):
+        logits, labels = _prepare(logits, labels)
+        self.scale, _ = _fit_affine(logits.reshape(1, -1), labels.reshape(1, -1), fit_bias=False, max_iter=max_iter)
+        return self
+
+    def transform(self, logits):
+        """Calibrated logits"""
+        return logits * self.scale.to(logits.device, logits.dtype)
+
+    def predict_proba(self, logits):
+        return torch.sigmoid(self.transform(logits))
+
+    def state_dict(self):
+        return {'scale': self.scale, 'bias': self.bias}
+
+    def load_state_dict(self, state):
+        self.scale, self.bias = state['scale'], state['bias']
+        return self
+
+class VectorScaling(TemperatureScaling):
+    """
+    Per-class temperature and bias, logits * a_c + b_c.
+    All classes are fitted at once by a vectorized Newton's method, the
+    2x2 systems of all classes are solved in closed form.
+    """
+
+    def __init__(self, fit_bias=True):
+        super(VectorScaling, self).__init__()
+        self.fit_bias = fit_bias
+
+    @property
+    def temperature(self):
+        return 1.0 / self.scale
+
+    def fit(self, logits, labels, max_iter=100):
+        logits, labels = _prepare(logits, labels)
+        self.scale, self.bias = _fit_affine(logits.t(), labels.t(), fit_bias=self.fit_bias, max_iter=max_iter)
+        return self
+
+    def transform(self, logits):
+        return logits * self.scale.to(logits.device, logits.dtype) + self.bias.to(logits.device, logits.dtype)
+
+class HistogramBinning(object):
+    """
+    Per-class histogram binning, the calibrated probability of a bin is the
+    positive frequency of its validation samples (bin center when empty).
+    All (class, bin) frequencies come from one bincount.
+    """
+
+    affine = False
+
+    def __init__(self, bins=15):
+        self.bins = bins
+        self.values = None
+
+    def fit(self, logits, labels):
+        logits, labels = _prepare(logits, labels)
+        classNum = logits.size(1)
+
+        index = self._index(logits)
+        count = torch.bincount(index.flatten(), minlength=classNum * self.bins).double()
+        positive = torch.bincount(index.flatten(), weights=labels.flatten(), minlength=classNum * self.bins)
+
+        centers = (torch.arange(self.bins, dtype=torch.float64) + 0.5) / self.bins
+        self.values = torch.where(count > 0, positive / count.clamp(min=1), centers.repeat(classNum)).view(classNum, self.bins)
+        return self
+
+    def _index(self, logits):
+        binIndex = torch.clamp((torch.sigmoid(logits) * self.bins).long(), max=self.bins - 1)
+        return binIndex + torch.arange(logits.size(1), device=logits.device) * self.bins
+
+    def predict_proba(self, logits):
+        """Calibrated probabilities"""
+        return self.values.to(logits.device).flatten()[self._index(logits.double())].to(logits.dtype)
+
+    def state_dict(self):
+        return {'bins': self.bins, 'values': self.values}
+
+    def load_state_dict(self, state):
+        self.bins, self.values = state['bins'], state['values']
+        return self
+
+class IsotonicCalibration(object):
+    """Per-class isotonic regression of the label on the probability (sklearn)"""
+
+    affine = False
+
+    def __init__(self):
+        self.regressors = None
+
+    def fit(self, logits, labels):
+        logits, labels = _prepare(logits, labels)
+        probs, labels = torch.sigmoid(logits).numpy(), labels.numpy()
+
+        self.regressors = [IsotonicRegression(y_min=0.0, y_max=1.0, out_of_bounds='clip').fit(probs[:, classId], labels[:, classId])
+                           for classId in range(probs.shape[1])]
+        return self
+
+    def predict_proba(self, logits):
+        probs = torch.sigmoid(logits.detach().double()).cpu().numpy()
+        res = np.stack([regressor.predict(probs[:, classId]) for classId, regressor in enumerate(self.regressors)], axis=1)
+        return torch.from_numpy(res).to(logits.device, logits.dtype)
+
+    def state_dict(self):
+        return {'regressors': self.regressors}
+
+    def load_state_dict(self, state):
+        self.regressors = state['regressors']
+        return self
+
+calibrator_dict = {
+    'temperature': TemperatureScaling,
+    'vector': VectorScaling,
+    'histogram': HistogramBinning,
+    'isotonic': IsotonicCalibration,
+}
+
+def fit_calibrator(name, logits, labels, **kwargs):
+    """Fit calibrator `name` of calibrator_dict on (batch, classNum) logits and labels"""
+
+    return calibrator_dict[name](**kwargs).fit(logits, labels)
+
+# =============================================================================
+# Fold affine calibrators into the classifier
+# =============================================================================
+@torch.no_grad()
+def fold_calibrator(model, calibrator):
+    """
+    Fold a fitted affine calibrator into the last layer of the model, in place,
+    so that calibrated inference costs nothing extra.
+        SSGRL: `classifiers` (ElementWiseLayer), weight and bias of every class
+        CTran: `output_linear`, the row of every label and its bias
+        MLGCN: `gc2.weight`, the logits are linear in it, so only a global
+            temperature can be folded
+    """
+
+    if not getattr(calibrator, 'affine', False):
+        raise ValueError('Only affine calibrators (temperature, vector scaling) can be folded into a model')
+
+    model = model.module if hasattr(model, 'module') else model
+    scale, bias = calibrator.scale, calibrator.bias
+
+    if isinstance(getattr(model, 'classifiers', None), ElementWiseLayer):
+        layer = model.classifiers
+    elif isinstance(getattr(model, 'output_linear', None), torch.nn.Linear):
+        layer = model.output_linear
+    elif hasattr(model, 'gc2'):
+        if scale.numel() != 1 or torch.any(bias != 0):
+            raise ValueError('MLGCN can only fold a global temperature, not per-class scales or biases')
+        model.gc2.weight.mul_(scale.item())
+        return model
+    else:
+        raise ValueError('No known classifier to fold the calibrator into')
+
+    scale = scale.to(layer.weight.device, layer.weight.dtype).expand(layer.weight.size(0))
+    bias = bias.to(layer.weight.device, layer.weight.dtype).expand(layer.weight.size(0))
+
+    layer.weight.mul_(scale[:, None])
+    if layer.bias is not None:
+        layer.bias.mul_(scale).add_(bias)
+    elif torch.any(bias != 0):
+        raise ValueError('The classifier has no bias to fold the calibrator bias into')
+
+    return model
+
+# =============================================================================
+# Help Functions
+# =============================================================================
+def _prepare(logits, labels):
+
+    if not torch.is_tensor(logits):
+        logits = torch.from_numpy(np.asarray(logits))
+    if not torch.is_tensor(labels):
+        labels = torch.from_numpy(np.asarray(labels))
+    return logits.detach().double().cpu(), (labels.detach().cpu() > 0).double()
+
+def _fit_affine(z, y, fit_bias=True, max_iter=100, tol=1e-9, l2=1e-2):
+    """
+    Binary logistic regression y ~ sigmoid(a_k * z + b_k) of K independent rows,
+    by Newton's method with backtracking, with a small ridge towards (a, b) = (1, 0).
+    z, y: (K, N)
+
+    Return:
+        scale, bias (K,)
+    """
+
+    K = z.size(0)
+    scale, bias = torch.ones(K, dtype=torch.float64), torch.zeros(K, dtype=torch.float64)
+
+    def loss(scale, bias):
+        logit = z * scale[:, None] + bias[:, None]
+        return torch.sum(F.softplus(logit) - y * logit, dim=1) + l2 / 2 * ((scale - 1) ** 2 + bias ** 2)
+
+    current = loss(scale, bias)
+    for _ in range(max_iter):
+        prob = torch.sigmoid(z * scale[:, None] + bias[:, None])
+        residual, weight = prob - y, prob * (1 - prob)
+
+        # Gradient and Hessian of every row
+        g_a = torch.sum(residual * z, dim=1) + l2 * (scale - 1)
+        h_aa = torch.sum(weight * z * z, dim=1) + l2
+        if fit_bias:
+            g_b = torch.sum(residual, dim=1) + l2 * bias
+            h_ab, h_bb = torch.sum(weight * z, dim=1), torch.sum(weight, dim=1) + l2
+            det = h_aa * h_bb - h_ab * h_ab
+            step_a, step_b = (h_bb * g_a - h_ab * g_b) / det, (h_aa * g_b - h_ab * g_a) / det
+        else:
+            g_b = torch.zeros_like(g_a)
+            step_a, step_b = g_a / h_aa, torch.zeros_like(g_a)
+
+        # Halve the step of the rows whose loss does not decrease enough
+        t = torch.ones(K, dtype=torch.float64)
+        decrease = g_a * step_a + g_b * step_b
+        for _ in range(30):
+            new = loss(scale - t * step_a, bias - t * step_b)
+            accept = new <= current - 1e-4 * t * decrease
+            if accept.all():
+                break
+            t = torch.where(accept, t, t / 2)
+
+        scale, bias = scale - t * step_a, bias - t * step_b
+        current = loss(scale, bias)
+
+        if torch.max(torch.abs(t * step_a) + torch.abs(t * step_b)) < tol:
+            break
+
+    return scale, bias
@@ -0,0 +1,191 @@
+"""
+Evaluate many checkpoints of one run over the same pass on the test set.
+
+    python evaluate_checkpoints.py dataset=COCO model=SSGRL checkpoints=/path/to/run_dir
+    python evaluate_checkpoints.py dataset=VG model=CTran "checkpoints='/path/to/run_dir/checkpoint_epoch_1*.pth'" checkpoint_group=4
+
+Every test batch is decoded and transformed once and fed to every model, so
+the test set is read once whatever the number of checkpoints. When the models
+do not fit in memory together, `checkpoint_group` evaluates them by groups of
+that size, and the test set is then read once per group. Targets are the
+partial labels with unknown labels set to 0, as in `Validate`, so the metrics
+of a checkpoint are the ones logged when it was trained.
+"""
+
+import os
+import re
+import sys
+import glob
+import json
+import time
+from datetime import datetime
+
+from loguru import logger
+import hydra
+from omegaconf import DictConfig
+
+import torch
+
+from model.SSGRL import SSGRL
+from utils.dataloader import get_graph_and_word_file, get_data_loader
+from utils.metrics import ValidationMeter
+
+import warnings
+
+warnings.filterwarnings('ignore')
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+@hydra.main(version_base=None, config_path='./config/', config_name="config")
+def main(cfg: DictConfig):
+
+    cfg.post = f"{cfg.model.name}-{cfg.dataset.name}-evaluate".replace('.', '_')
+    cfg.post = str(datetime.now().strftime('%Y%m%d_%H%M%S'))[2:16] + '_' + cfg.post
+
+    log_format = "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | <level>{message}</level>"
+    logger.add('exp/log/{}.log'.format(cfg.post), format=log_format, level="INFO")
+
+    if cfg.checkpoints is None:
+        logger.error('Set checkpoints to a run directory or a glob of checkpoints')
+        return
+
+    checkpoints = find_checkpoints(cfg.checkpoints)
+    if len(checkpoints) == 0:
+        logger.error('No checkpoint found at {}'.format(cfg.checkpoints))
+        return
+    logger.info('==> {} checkpoints to evaluate'.format(len(checkpoints)))
+
+    logger.info("==> Creating dataloader...")
+    train_loader, test_loader = get_data_loader(cfg)
+    logger.info("==> Done!\n")
+
+    build_model = get_model_builder(cfg, train_loader)
+
+    # All checkpoints share one pass over the test set unless they are split by groups
+    groupSize = cfg.checkpoint_group or len(checkpoints)
+
+    table = []
+    for start in range(0, len(checkpoints), groupSize):
+        group = checkpoints[start:start + groupSize]
+        models = [load_model(build_model, path) for path in group]
+
+        for path, res in zip(group, Evaluate(test_loader, models, cfg)):
+            res['checkpoint'] = path
+            table.append(res)
+
+        del models
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    log_table(table)
+
+    os.makedirs('exp/eval', exist_ok=True)
+    with open('exp/eval/{}.json'.format(cfg.post), 'w') as f:
+        json.dump(table, f, indent=2)
+    logger.info('Results saved to exp/eval/{}.json'.format(cfg.post))
+
+def Evaluate(test_loader, models, cfg):
+    """Runs every model of `models` over one pass of the test set, returns one metric dict per model"""
+
+    # Without cfg.exact_validation the outputs are not kept, mAP is approximated and ACE, mACE are nan
+    validationMeters = [ValidationMeter(cfg.dataset.class_nums, keep_scores=cfg.exact_validation) for _ in models]
+
+    end = time.time()
+    for batch_index, batch in enumerate(test_loader):
+        input, target, mask = unpack_batch(batch)
+        input = input.to(device, non_blocking=True)
+
+        with torch.no_grad():
+            for modelId, model in enumerate(models):
+                output = forward(model, input, mask, cfg)
+                validationMeters[modelId].add(output, target.to(output.device))
+
+        if batch_index % cfg.print_freq == 0:
+            logger.info('[Evaluate] [{0:04d}/{1}] {2} models, {3:.3f}s per batch'.format(
+                batch_index, len(test_loader), len(models), (time.time() - end) / (batch_index + 1)))
+            sys.stdout.flush()
+
+    res = []
+    for validationMeter in validationMeters:
+        metrics = validationMeter.value()
+        res.append({key: float(metrics[key]) for key in ('mAP', 'ACE', 'ECE', 'MCE', 'mACE', 'mECE', 'mMCE')})
+    return res
+
+# =============================================================================
+# Help Functions
+# =============================================================================
+def find_checkpoints(pattern):
+    """Checkpoints of a directory (checkpoint_*.pth) or of a glob pattern, ordered by epoch"""
+
+    paths = glob.glob(os.path.join(pattern, 'checkpoint_*.pth')) if os.path.isdir(pattern) else glob.glob(pattern)
+
+    def key(path):
+        epoch = re.search(r'checkpoint_epoch_(\d+)\.pth$', path)
+        return (0, int(epoch.group(1)), path) if epoch else (1, 0, path)
+
+    return sorted(paths, key=key)
+
+def get_model_builder(cfg, train_loader):
+    """Returns a function building an empty model of `cfg.model.name`"""
+
+    if cfg.model.name == 'SSGRL':
+        graph_file, word_file = get_graph_and_word_file(cfg, train_loader.dataset.changed_labels)
+        return lambda: SSGRL(graph_file, word_file, class_nums=cfg.dataset.class_nums)
+    if cfg.model.name == 'CTran':
+        from model.CTran import CTranModel
+        return lambda: CTranModel(cfg.dataset.class_nums)
+    if cfg.model.name == 'MLGCN':
+        from model.MLGCN import gcn_resnet101
+        return lambda: gcn_resnet101(num_classes=cfg.dataset.class_nums, t=0.4, train_label=train_loader.dataset.changed_labels, cfg=cfg)
+    raise ValueError('Unknown model {}'.format(cfg.model.name))
+
+def load_model(build_model, path):
+
+    logger.info("==> Loading checkpoint {}...".format(path))
+    checkpoint = torch.load(path, map_location='cpu')
+
+    model = build_model()
+    model.load_state_dict(checkpoint['state_dict'])
+    model.to(device)
+    model.eval()
+
+    return model
+
+def unpack_batch(batch):
+    """(input, target, mask) of a COCO (dict) or VG (tuple) batch, target are the partial labels with unknown set to 0, as in Validate"""
+
+    if isinstance(batch, dict):
+        input, target, mask = batch['input'], batch['partial_labels'], batch['mask']
+    else:
+        sample_index, input, target, full_labels, mask = batch
+
+    target = target.float().clone()
+    target[target < 0] = 0
+    return input, target, mask
+
+def forward(model, input, mask, cfg):
+
+    if cfg.model.name == 'SSGRL':
+        output, _ = model(input)
+    elif cfg.model.name == 'CTran':
+        output, _, _ = model(input, mask.clone().to(device))
+    else:
+        output = model(input)
+    return output
+
+def log_table(table):
+    """Logs the comparison table, best mAP and lowest calibration errors marked with *"""
+
+    # nan values (ACE without exact_validation) are never best, columns of nan only are left out
+    values = {key: [res[key] for res in table if res[key] == res[key]] for key in ['mAP', 'ACE', 'ECE', 'MCE', 'mECE']}
+    keys = [key for key in values if values[key]]
+    best = {key: (max if key == 'mAP' else min)(values[key]) for key in keys}
+
+    lines = ['{:<40s}'.format('checkpoint') + ''.join('{:>11s}'.format(key) for key in keys)]
+    for res in table:
+        lines.append('{:<40s}'.format(os.path.basename(res['checkpoint'])[-40:]) +
+                     ''.join('{:>10.4f}{}'.format(res[key], '*' if res[key] == best[key] else ' ') for key in keys))
+
+    logger.info('[Evaluate] Checkpoint comparison\n' + '\n'.join(lines))
+
+if __name__=="__main__":
+    main()
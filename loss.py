@@ -9,18 +9,20 @@ device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 class InstanceContrastiveLoss(nn.Module):
     """
     Document: https://github.com/adambielski/siamese-triplet/blob/master/losses.py
+    Cosine similarities of every pair of images i < j of the batch, per class,
+    from one batched matmul of the normalized features. The batch size is
+    read from the input, `batchSize` is only kept for compatibility.
     """
 
-    def __init__(self, batchSize, reduce=None, size_average=None):
+    def __init__(self, batchSize=None, reduce=None, size_average=None):
         super(InstanceContrastiveLoss, self).__init__()
 
         self.batchSize = batchSize
-        self.concatIndex = self.getConcatIndex(batchSize)
 
         self.reduce = reduce
         self.size_average = size_average
 
-        self.cos = torch.nn.CosineSimilarity(dim=2, eps=1e-9)
+        self.eps = 1e-9
 
     def forward(self, input, target):
         """
@@ -28,50 +30,48 @@ class InstanceContrastiveLoss(nn.Module):
         Shape of target: (BatchSize, classNum), Value range of target: (-1, 0, 1)
         """
 
-        target_ = target.detach().clone()
-        target_[target_ != 1] = 0
-        pos2posTarget = target_[self.concatIndex[0]] * target_[self.concatIndex[1]]
+        batchSize = input.size(0)
+        triuMask = torch.ones(batchSize, batchSize, dtype=torch.bool, device=input.device).triu(diagonal=1)
 
-        pos2negTarget = 1 - pos2posTarget
-        pos2negTarget[(target[self.concatIndex[0]] == 0) | (target[self.concatIndex[1]] == 0)] = 0
-        pos2negTarget[(target[self.concatIndex[0]] == -1) & (target[self.concatIndex[1]] == -1)] = 0
+        # (classNum, BatchSize, BatchSize) cosine similarities, read at the pairs i < j as (pairNum, classNum)
+        feature = F.normalize(input, dim=2, eps=self.eps).transpose(0, 1)
+        distance = torch.bmm(feature, feature.transpose(1, 2))[:, triuMask].t()
 
-        target_ = -1 * target.detach().clone()
-        target_[target_ != 1] = 0
-        neg2negTarget = target_[self.concatIndex[0]] * target_[self.concatIndex[1]]
-
-        distance = self.cos(input[self.concatIndex[0]], input[self.concatIndex[1]])
+        # Pair targets as outer products of the labels
+        pos, neg = (target.detach() == 1).t().float(), (target.detach() == -1).t().float()
+        pos2posTarget = (pos[:, :, None] * pos[:, None, :])[:, triuMask].t()
+        pos2negTarget = (pos[:, :, None] * neg[:, None, :] + neg[:, :, None] * pos[:, None, :])[:, triuMask].t()
+        neg2negTarget = (neg[:, :, None] * neg[:, None, :])[:, triuMask].t()
 
         if self.reduce:
             pos2pos_loss = (1 - distance)[pos2posTarget == 1]
             pos2neg_loss = (1 + distance)[pos2negTarget == 1]
             neg2neg_loss = (1 + distance)[neg2negTarget == 1]
 
-            if pos2pos_loss.size(0) != 0:
+            # Negative pairs: 2 * P random ones and the P hardest, P the number of positive pairs
+            posNum = pos2pos_loss.size(0)
+            if posNum != 0:
                 if neg2neg_loss.size(0) != 0:
-                    neg2neg_loss = torch.cat((torch.index_select(neg2neg_loss, 0, torch.randperm(neg2neg_loss.size(0))[:2 * pos2pos_loss.size(0)].to(device)),
-                                              torch.sort(neg2neg_loss, descending=True)[0][:pos2pos_loss.size(0)]), 0)
+                    neg2neg_loss = torch.cat((neg2neg_loss[torch.randperm(neg2neg_loss.size(0), device=input.device)[:2 * posNum]],
+                                              torch.topk(neg2neg_loss, min(posNum, neg2neg_loss.size(0)))[0]), 0)
                 if pos2neg_loss.size(0) != 0:
-                    if pos2neg_loss.size(0) != 0:    
-                        pos2neg_loss = torch.cat((torch.index_select(pos2neg_loss, 0, torch.randperm(pos2neg_loss.size(0))[:2 * pos2pos_loss.size(0)].to(device)),
-                                                  torch.sort(pos2neg_loss, descending=True)[0][:pos2pos_loss.size(0)]), 0)
+                    pos2neg_loss = torch.cat((pos2neg_loss[torch.randperm(pos2neg_loss.size(0), device=input.device)[:2 * posNum]],
+                                              torch.topk(pos2neg_loss, min(posNum, pos2neg_loss.size(0)))[0]), 0)
 
             loss = torch.cat((pos2pos_loss, pos2neg_loss, neg2neg_loss), 0)
 
             if self.size_average:
-                return torch.mean(loss) if loss.size(0) != 0 else torch.mean(torch.zeros_like(loss).to(device))
-            return torch.sum(loss) if loss.size(0) != 0 else torch.sum(torch.zeros_like(loss).to(device))
+                return torch.mean(loss) if loss.size(0) != 0 else torch.mean(torch.zeros_like(loss))
+            return torch.sum(loss) if loss.size(0) != 0 else torch.sum(torch.zeros_like(loss))
  
         return distance
     
-    def getConcatIndex(self, classNum):
-        res = [[], []]
-        for index in range(classNum - 1):
-            res[0] += [index for i in range(classNum - index - 1)]
-            res[1] += [i for i in range(index + 1, classNum)]
-        return res
-    
 class PrototypeContrastiveLoss(nn.Module):
+    """
+    Mean cosine similarity between the feature of every (image, class) and
+    the prototypes of its class, as one einsum of the normalized features
+    and prototypes.
+    """
 
     def __init__(self, reduce=None, size_average=None):
         super(PrototypeContrastiveLoss, self).__init__()
@@ -79,7 +79,7 @@ class PrototypeContrastiveLoss(nn.Module):
         self.reduce = reduce
         self.size_average = size_average
 
-        self.cos = torch.nn.CosineSimilarity(dim=3, eps=1e-9)
+        self.eps = 1e-9
 
     def forward(self, input, target, prototype):
         """
@@ -88,15 +88,13 @@ class PrototypeContrastiveLoss(nn.Module):
         Shape of prototype: (classNum, prototypeNum, featureDim)
         """        
 
-        batchSize, prototypeNum = input.size(0), prototype.size(1)
-        input = input.unsqueeze(2).repeat(1, 1, prototypeNum, 1)
-        prototype = prototype.unsqueeze(0).repeat(batchSize, 1, 1, 1)
+        input, prototype = F.normalize(input, dim=2, eps=self.eps), F.normalize(prototype, dim=2, eps=self.eps)
 
-        distance = torch.mean(self.cos(input, prototype), 2)
+        distance = torch.einsum('bcd,cpd->bcp', input, prototype).mean(2)
         loss = distance * target.float() + 1 # -1: 1-distance, 0: 1, 1: 1+distance
 
         if self.reduce:
             if self.size_average:
                 return torch.mean(loss)
             return torch.sum(loss)
-        return loss
\ No newline at end of file
+        return loss
@@ -0,0 +1,96 @@
+"""
+Recompute metrics from the logits saved by `Validate` (save_logits=true),
+without loading a model.
+
+    python rescore.py exp/logits/<post>
+    python rescore.py exp/logits/<post> --epochs 3 7 --bins 20 --classes 0 1 2
+    python rescore.py exp/logits/<run1> exp/logits/<run2> --functions compute_calibration_sweep --output table.json
+"""
+
+import json
+import argparse
+
+import numpy as np
+
+import torch
+
+from utils import metrics
+from utils.logits_store import LogitsStore
+
+# Metrics of EvaluationReport, by name
+_Metrics = {'mAP': lambda report: report.mAP(),
+            'averageAP': lambda report: report.averageAP(),
+            'overall': lambda report: dict(zip(('OP', 'OR', 'OF1', 'CP', 'CR', 'CF1'), report.overall())),
+            'overall_top3': lambda report: dict(zip(('OP', 'OR', 'OF1', 'CP', 'CR', 'CF1'), report.overall_topk(3))),
+            'calibration': lambda report: dict(zip(('ACE', 'ECE', 'MCE'), report.calibration())),
+            'classwise': lambda report: dict(zip(('mACE', 'mECE', 'mMCE'), report.classwise())),
+            'pair_ECE': lambda report: report.cooccurrence_calibration(),
+           }
+
+# Functions of utils/metrics.py called as function(probabilities, {0, 1} labels)
+_Functions = ('compute_ace_multi', 'compute_classwise_ace_multi', 'compute_classwise_ece_multi', 'compute_classwise_mce_multi',
+              'compute_calibration_metrics', 'compute_cooccurrence_calibration', 'compute_calibration_sweep')
+
+def to_json(value):
+
+    if torch.is_tensor(value):
+        value = value.numpy()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (np.floating, np.integer)):
+        return value.item()
+    if isinstance(value, dict):
+        return {key: to_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json(item) for item in value]
+    return value
+
+def rescore(stored, metric_names, functions, bins, classes=None):
+    """Metrics of one stored epoch"""
+
+    logits, labels = torch.from_numpy(np.asarray(stored['logits'])), torch.from_numpy(np.asarray(stored['labels'])).long()
+    if classes is not None:
+        logits, labels = logits[:, classes], labels[:, classes]
+
+    res = {}
+    report = metrics.EvaluationReport(logits, labels, bins=bins)
+    for name in metric_names:
+        value = _Metrics[name](report)
+        res.update(value if isinstance(value, dict) else {name: value})
+    res = {key: float(value) if torch.is_tensor(value) and value.dim() == 0 else value for key, value in res.items()}
+
+    for name in functions:
+        assert name in _Functions, '{} is not one of the functions of _Functions'.format(name)
+        res[name] = getattr(metrics, name)(report.probs, report.targets)
+
+    return res
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Recompute metrics from a LogitsStore')
+    parser.add_argument('stores', type=str, nargs='+', help='store directories, {logits_path}/{post}')
+    parser.add_argument('--epochs', type=int, nargs='*', default=None, help='epochs to score, all by default')
+    parser.add_argument('--metrics', type=str, nargs='*', default=list(_Metrics), choices=list(_Metrics))
+    parser.add_argument('--functions', type=str, nargs='*', default=[], choices=_Functions, help='other functions of utils/metrics.py')
+    parser.add_argument('--bins', type=int, default=15)
+    parser.add_argument('--classes', type=int, nargs='*', default=None, help='class slice, all by default')
+    parser.add_argument('--output', type=str, default=None, help='json file of all results')
+    args = parser.parse_args()
+
+    table = []
+    for root in args.stores:
+        store = LogitsStore(root)
+        for epoch in (args.epochs if args.epochs is not None else store.epochs()):
+            res = rescore(store.load(epoch), args.metrics, args.functions, args.bins, args.classes)
+            table.append({'store': root, 'epoch': epoch, 'metrics': to_json(res)})
+
+            scalars = ', '.join('{}: {:.6f}'.format(key, value) for key, value in res.items() if isinstance(value, (float, np.floating)))
+            print('[{}] [Epoch {}] {}'.format(root, epoch, scalars))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(table, f, indent=2)
+        print('Results saved to {}'.format(args.output))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+import pytest
+
+from benchmark_metrics import _Functions, get_function, make_data
+
+
+def test_make_data_is_long_tailed():
+    logits, labels = make_data(2000, 20, 2.9)
+    frequency = labels.float().mean(0).sort(descending=True)[0]
+
+    assert logits.shape == labels.shape == (2000, 20)
+    assert labels.sum(1).float().mean().item() == pytest.approx(2.9, rel=0.1)
+    assert frequency[0] > 4 * frequency[-1]
+
+
+@pytest.mark.parametrize('name', _Functions)
+def test_every_function_runs(name):
+    logits, labels = make_data(300, 10, 2.0)
+    get_function(name, logits, labels)()
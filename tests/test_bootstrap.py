@@ -0,0 +1,29 @@
+import numpy as np
+import torch
+
+from utils.bootstrap import bootstrap_metrics
+from utils.metrics import Compute_mAP_VOC2012, calibration_errors_from_statistics, compute_calibration_statistics
+
+
+def test_bootstrap_matches_resampled_metrics():
+    generator = torch.Generator().manual_seed(0)
+    sampleNum, classNum, n_resamples = 300, 5, 12
+    scores = 2 * torch.randn(sampleNum, classNum, generator=generator)
+    targets = (torch.rand(sampleNum, classNum, generator=generator) < torch.sigmoid(scores)).float()
+
+    # Small chunks, so the replicates are processed over several batches
+    res = bootstrap_metrics(scores, targets, n_resamples=n_resamples, seed=3, max_elements=4 * sampleNum * classNum)
+
+    # Same draws as bootstrap_metrics
+    indices = torch.randint(sampleNum, (n_resamples, sampleNum), generator=torch.Generator().manual_seed(3), dtype=torch.int32).long()
+    for replicate, index in enumerate(indices):
+        resampled_scores, resampled_targets = scores[index], targets[index]
+        mAP = Compute_mAP_VOC2012(torch.cat((resampled_scores, resampled_targets), 1).numpy(), classNum)
+        calibration = calibration_errors_from_statistics(compute_calibration_statistics(torch.sigmoid(resampled_scores), resampled_targets))
+
+        np.testing.assert_allclose(res['mAP']['replicates'][replicate], mAP, rtol=1e-5)
+        np.testing.assert_allclose(res['ECE']['replicates'][replicate], calibration['ECE'].item(), rtol=1e-6)
+        np.testing.assert_allclose(res['MCE']['replicates'][replicate], calibration['MCE'].item(), rtol=1e-6)
+
+    mAP = Compute_mAP_VOC2012(torch.cat((scores, targets), 1).numpy(), classNum)
+    np.testing.assert_allclose(res['mAP']['value'], mAP, rtol=1e-5)
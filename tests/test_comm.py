@@ -0,0 +1,51 @@
+import os
+import tempfile
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+import comm
+
+
+def gather_shards(rank, world_size, init_file, batches):
+    dist.init_process_group('gloo', init_method='file://' + init_file, rank=rank, world_size=world_size)
+    try:
+        # Same contiguous blocks of whole batches as get_shard_loader
+        start, stop = rank * len(batches) // world_size, (rank + 1) * len(batches) // world_size
+        shards = comm.gather(batches[start:stop], group=None)
+
+        if rank == 0:
+            gathered = [batch for shard in shards for batch in shard]
+            assert len(gathered) == len(batches)
+            for (output, index), (expected_output, expected_index) in zip(gathered, batches):
+                assert torch.equal(output, expected_output) and torch.equal(index, expected_index)
+        else:
+            assert shards == []
+    finally:
+        dist.destroy_process_group()
+
+
+@pytest.mark.skipif(not dist.is_available(), reason='torch.distributed is not available')
+def test_gather_concatenates_shards_in_rank_order():
+    generator = torch.Generator().manual_seed(0)
+    batches = [(torch.randn(4, 3, generator=generator), torch.arange(4 * i, 4 * i + 4)) for i in range(7)]
+
+    with tempfile.TemporaryDirectory() as root:
+        mp.spawn(gather_shards, args=(3, os.path.join(root, 'init'), batches), nprocs=3)
+
+
+def test_single_process_gather():
+    assert comm.gather([1, 2], group=None) == [[1, 2]]
+
+
+def test_shard_loader_covers_loader():
+    pytest.importorskip('torchvision')
+    from torch.utils.data import DataLoader
+    from utils.dataloader import get_shard_loader
+
+    loader = DataLoader(list(range(23)), batch_size=4)
+    shards = [list(get_shard_loader(loader, rank, 3)) for rank in range(3)]
+
+    assert [batch.tolist() for shard in shards for batch in shard] == [batch.tolist() for batch in loader]
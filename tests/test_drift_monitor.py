@@ -0,0 +1,45 @@
+import pytest
+import torch
+
+from utils.drift_monitor import CalibrationDriftMonitor
+from utils.metrics import calibration_errors_from_statistics, compute_calibration_statistics
+
+
+def test_monitor_without_decay_matches_full_statistics():
+    generator = torch.Generator().manual_seed(0)
+    logits = 2 * torch.randn(300, 4, generator=generator)
+    targets = (torch.rand(300, 4, generator=generator) < torch.sigmoid(logits)).float()
+
+    monitor = CalibrationDriftMonitor(4, decay=1.0)
+    for start in range(0, 300, 64):
+        monitor.update(logits[start:start + 64], targets[start:start + 64])
+
+    res = calibration_errors_from_statistics(compute_calibration_statistics(torch.sigmoid(logits), targets > 0))
+    expected = (res['ECE'].item(), res['MCE'].item(), res['classwise_ECE'].mean().item(), res['classwise_MCE'].mean().item())
+    assert monitor.value() == pytest.approx(expected)
+
+
+def test_monitor_decays_older_images():
+    generator = torch.Generator().manual_seed(1)
+    old, new = torch.randn(50, 3, generator=generator), torch.randn(20, 3, generator=generator)
+    oldTargets, newTargets = (old > 0).float(), (torch.rand(20, 3, generator=generator) < 0.5).float()
+
+    monitor = CalibrationDriftMonitor(3, decay=0.9)
+    monitor.update(old, oldTargets)
+    monitor.update(new, newTargets)
+
+    previous = compute_calibration_statistics(torch.sigmoid(old), oldTargets > 0)
+    current = compute_calibration_statistics(torch.sigmoid(new), newTargets > 0)
+    for key, value in monitor.statistics.items():
+        torch.testing.assert_close(value, previous[key] * 0.9 ** 20 + current[key])
+
+
+def test_monitor_alerts_once_per_drift():
+    monitor = CalibrationDriftMonitor(2, decay=1.0, threshold=0.1, min_count=10, is_logits=False)
+    # Class 0 is confident and always wrong, class 1 is right 9 times out of 10 at confidence 0.9
+    output = torch.tensor([[0.95, 0.9]]).repeat(20, 1)
+    target = torch.stack((torch.zeros(20), (torch.arange(20) % 10 != 0).float()), 1)
+
+    assert [alert['class'] for alert in monitor.update(output, target)] == [0]
+    assert monitor.update(output, target) == []
+    assert monitor.alerted.tolist() == [True, False]
@@ -0,0 +1,71 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+pytest.importorskip('hydra')
+pytest.importorskip('torchvision')
+
+import evaluate_checkpoints
+from evaluate_checkpoints import Evaluate, device, find_checkpoints, log_table
+from utils.metrics import ValidationMeter
+
+
+class CountingLoader(object):
+    """Test batches as a loader, counting the passes over them"""
+
+    def __init__(self, batches):
+        self.batches, self.passes = batches, 0
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        self.passes += 1
+        return iter(self.batches)
+
+
+def test_find_checkpoints_orders_by_epoch(tmp_path):
+    for name in ('checkpoint_epoch_10.pth', 'checkpoint_epoch_2.pth', 'checkpoint_best.pth', 'other.pth'):
+        open(os.path.join(str(tmp_path), name), 'w').close()
+
+    names = [os.path.basename(path) for path in find_checkpoints(str(tmp_path))]
+    assert names == ['checkpoint_epoch_2.pth', 'checkpoint_epoch_10.pth', 'checkpoint_best.pth']
+
+
+@pytest.mark.parametrize('exact', [True, False])
+def test_evaluate_reads_test_set_once_for_all_models(exact):
+    generator = torch.Generator().manual_seed(0)
+    batches = [{'input': torch.randn(8, 6, generator=generator), 'partial_labels': torch.randint(-1, 2, (8, 4), generator=generator),
+                'full_labels': torch.randint(0, 2, (8, 4), generator=generator), 'mask': torch.zeros(8, 4)} for _ in range(5)]
+    loader = CountingLoader(batches)
+    models = [torch.nn.Linear(6, 4).to(device).eval() for _ in range(3)]
+    cfg = SimpleNamespace(model=SimpleNamespace(name='MLGCN'), dataset=SimpleNamespace(class_nums=4), print_freq=100, exact_validation=exact)
+
+    res = Evaluate(loader, models, cfg)
+    assert loader.passes == 1
+
+    # Same metrics as one model evaluated on its own by Validate, on the partial labels
+    for model, metrics in zip(models, res):
+        meter = ValidationMeter(4, keep_scores=exact)
+        with torch.no_grad():
+            for batch in batches:
+                output = model(batch['input'].to(device))
+                meter.add(output, batch['partial_labels'].clamp(min=0).to(output.device))
+        expected = meter.value()
+        for key, value in metrics.items():
+            assert value == pytest.approx(expected[key], nan_ok=True)
+
+
+def test_log_table_skips_nan(monkeypatch):
+    lines = []
+    monkeypatch.setattr(evaluate_checkpoints.logger, 'info', lines.append)
+    nan = float('nan')
+    log_table([{'checkpoint': 'checkpoint_epoch_1.pth', 'mAP': 0.5, 'ACE': nan, 'ECE': 0.1, 'MCE': 0.3, 'mECE': nan},
+               {'checkpoint': 'checkpoint_epoch_2.pth', 'mAP': 0.6, 'ACE': nan, 'ECE': 0.2, 'MCE': 0.2, 'mECE': 0.2}])
+
+    header, first, second = lines[0].split('\n')[1:]
+    assert 'ACE' not in header.split()
+    assert first.split()[1:] == ['0.5000', '0.1000*', '0.3000', 'nan']
+    assert second.split()[1:] == ['0.6000*', '0.2000', '0.2000*', '0.2000*']
@@ -0,0 +1,64 @@
+import pytest
+import torch
+from torch.nn import functional as F
+
+from calibration.focal import FocalFamilyFunction, dwbl_loss, flsd_loss, focal_loss
+
+
+def reference_pt(input, target):
+    sigmoid_input = torch.sigmoid(input)
+    pt = torch.clamp(torch.where(target == 1, sigmoid_input, 1 - sigmoid_input), 0.001, 0.999)
+    log_pt = torch.where(target == 1, F.logsigmoid(input), F.logsigmoid(-input))
+    return pt, log_pt
+
+
+# Loss formulas of FocalLoss, DWBL and FocalLossAdaptive before the fused Function
+def reference_focal(input, target, gamma=0.5):
+    pt, log_pt = reference_pt(input, target)
+    return (-1 * (1 - pt) ** gamma * log_pt).mean()
+
+def reference_dwbl(input, target, weight):
+    pt, log_pt = reference_pt(input, target)
+    return (-1 * weight ** (1 - pt) * log_pt - 0.5 * pt * (1 - pt)).mean()
+
+def reference_flsd(input, target, gamma=1.0):
+    pt, _ = reference_pt(input, target)
+    gamma = torch.full(pt.shape, gamma, dtype=pt.dtype)
+    gamma[pt > 0.2] = 0.5
+    return (-1 * (1 - pt) ** gamma * torch.log(pt)).mean()
+
+
+def random_batch(seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    # Wide range, so some pt are clamped
+    input = 6 * torch.randn(8, 5, generator=generator, dtype=torch.float64)
+    target = torch.randint(-1, 2, (8, 5), generator=generator).double()
+    weight = 1 + torch.rand(5, generator=generator, dtype=torch.float64)
+    return input, target, weight
+
+
+@pytest.mark.parametrize('name', ['focal', 'dwbl', 'flsd'])
+def test_fused_loss_matches_reference(name):
+    input, target, weight = random_batch()
+    fused, reference = {'focal': (lambda x: focal_loss(x, target), lambda x: reference_focal(x, target)),
+                        'dwbl': (lambda x: dwbl_loss(x, target, weight), lambda x: reference_dwbl(x, target, weight)),
+                        'flsd': (lambda x: flsd_loss(x, target), lambda x: reference_flsd(x, target))}[name]
+
+    x, y = input.clone().requires_grad_(), input.clone().requires_grad_()
+    value, expected = fused(x), reference(y)
+    value.backward()
+    expected.backward()
+
+    torch.testing.assert_close(value, expected)
+    torch.testing.assert_close(x.grad, y.grad)
+
+
+@pytest.mark.parametrize('name', ['focal', 'dwbl', 'flsd'])
+def test_fused_loss_gradcheck(name):
+    input, target, weight = random_batch(1)
+    # Inside the clamp range, where the loss is differentiable
+    input = input.clamp(-4, 4).requires_grad_()
+    args = {'focal': ('focal', 0.5, None, None, None), 'dwbl': ('dwbl', None, weight, None, None),
+            'flsd': ('flsd', 1.0, None, 0.5, 0.2)}[name]
+
+    assert torch.autograd.gradcheck(lambda x: FocalFamilyFunction.apply(x, target, *args), (input,))
@@ -0,0 +1,69 @@
+import json
+
+import numpy as np
+import pytest
+import torch
+
+from rescore import _Functions, _Metrics, rescore, to_json
+from utils.logits_store import LogitsStore
+
+
+def write_epoch(store, epoch, logits, labels, batch_size=4):
+    with store.writer(epoch, logits.size(1), model='SSGRL') as writer:
+        for start in range(0, logits.size(0), batch_size):
+            writer.add(logits[start:start + batch_size], labels[start:start + batch_size], torch.arange(start, min(start + batch_size, logits.size(0))))
+
+
+def test_store_round_trip(tmp_path):
+    logits, labels = torch.randn(10, 3), torch.randint(-1, 2, (10, 3))
+    store = LogitsStore(str(tmp_path))
+    write_epoch(store, 2, logits, labels)
+
+    assert store.epochs() == [2]
+    for mmap in (True, False):
+        res = store.load(2, mmap=mmap)
+        np.testing.assert_array_equal(res['logits'], logits.numpy())
+        np.testing.assert_array_equal(res['labels'], labels.numpy())
+        np.testing.assert_array_equal(res['image_ids'], np.arange(10))
+        assert res['meta']['num'] == 10 and res['meta']['model'] == 'SSGRL'
+
+
+def test_rewriting_epoch_does_not_duplicate_rows(tmp_path):
+    logits, labels = torch.randn(12, 3), torch.randint(-1, 2, (12, 3))
+    store = LogitsStore(str(tmp_path))
+
+    # Validate twice for the same epoch, as with cfg.evaluate or a resumed run
+    write_epoch(store, 0, torch.zeros(12, 3), labels)
+    write_epoch(store, 0, logits, labels)
+
+    res = store.load(0)
+    assert res['meta']['num'] == 12
+    np.testing.assert_array_equal(res['image_ids'], np.arange(12))
+    np.testing.assert_array_equal(res['logits'], logits.numpy())
+
+
+def test_interrupted_rewrite_is_not_listed(tmp_path):
+    logits, labels = torch.randn(6, 3), torch.randint(-1, 2, (6, 3))
+    store = LogitsStore(str(tmp_path))
+    write_epoch(store, 0, logits, labels)
+    write_epoch(store, 1, logits, labels)
+
+    writer = store.writer(1, 3)
+    writer.add(logits[:2], labels[:2], torch.arange(2))
+
+    assert store.epochs() == [0]
+    assert store.load(0)['meta']['num'] == 6
+
+
+def test_rescore_runs_only_whitelisted_functions(tmp_path):
+    generator = torch.Generator().manual_seed(0)
+    logits, labels = torch.randn(60, 4, generator=generator), torch.randint(-1, 2, (60, 4), generator=generator)
+    store = LogitsStore(str(tmp_path))
+    write_epoch(store, 1, logits, labels)
+
+    res = rescore(store.load(1), list(_Metrics), _Functions, 15)
+    assert set(_Functions) <= set(res)
+    json.dumps(to_json(res))
+
+    with pytest.raises(AssertionError):
+        rescore(store.load(1), [], ['getTriuMask'], 15)
@@ -0,0 +1,90 @@
+import pytest
+import torch
+
+from loss import InstanceContrastiveLoss, PrototypeContrastiveLoss
+
+
+def reference_instance_loss(input, target, reduce):
+    """InstanceContrastiveLoss before the batched matmul, from gathered pairs and CosineSimilarity"""
+
+    batchSize = input.size(0)
+    concatIndex = [[i for i in range(batchSize) for _ in range(i + 1, batchSize)],
+                   [j for i in range(batchSize) for j in range(i + 1, batchSize)]]
+
+    target_ = target.detach().clone()
+    target_[target_ != 1] = 0
+    pos2posTarget = target_[concatIndex[0]] * target_[concatIndex[1]]
+
+    pos2negTarget = 1 - pos2posTarget
+    pos2negTarget[(target[concatIndex[0]] == 0) | (target[concatIndex[1]] == 0)] = 0
+    pos2negTarget[(target[concatIndex[0]] == -1) & (target[concatIndex[1]] == -1)] = 0
+
+    target_ = -1 * target.detach().clone()
+    target_[target_ != 1] = 0
+    neg2negTarget = target_[concatIndex[0]] * target_[concatIndex[1]]
+
+    distance = torch.nn.CosineSimilarity(dim=2, eps=1e-9)(input[concatIndex[0]], input[concatIndex[1]])
+    if not reduce:
+        return distance
+
+    pos2pos_loss = (1 - distance)[pos2posTarget == 1]
+    pos2neg_loss = (1 + distance)[pos2negTarget == 1]
+    neg2neg_loss = (1 + distance)[neg2negTarget == 1]
+
+    if pos2pos_loss.size(0) != 0:
+        if neg2neg_loss.size(0) != 0:
+            neg2neg_loss = torch.cat((torch.index_select(neg2neg_loss, 0, torch.randperm(neg2neg_loss.size(0))[:2 * pos2pos_loss.size(0)]),
+                                      torch.sort(neg2neg_loss, descending=True)[0][:pos2pos_loss.size(0)]), 0)
+        if pos2neg_loss.size(0) != 0:
+            pos2neg_loss = torch.cat((torch.index_select(pos2neg_loss, 0, torch.randperm(pos2neg_loss.size(0))[:2 * pos2pos_loss.size(0)]),
+                                      torch.sort(pos2neg_loss, descending=True)[0][:pos2pos_loss.size(0)]), 0)
+
+    return torch.mean(torch.cat((pos2pos_loss, pos2neg_loss, neg2neg_loss), 0))
+
+
+def reference_prototype_loss(input, target, prototype):
+    """PrototypeContrastiveLoss before the einsum, from repeated copies and CosineSimilarity"""
+
+    batchSize, prototypeNum = input.size(0), prototype.size(1)
+    input = input.unsqueeze(2).repeat(1, 1, prototypeNum, 1)
+    prototype = prototype.unsqueeze(0).repeat(batchSize, 1, 1, 1)
+
+    distance = torch.mean(torch.nn.CosineSimilarity(dim=3, eps=1e-9)(input, prototype), 2)
+    return distance * target.float() + 1
+
+
+def features(seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    input = torch.randn(6, 4, 16, generator=generator, dtype=torch.float64)
+    target = torch.randint(-1, 2, (6, 4), generator=generator)
+    return input, target
+
+
+@pytest.mark.parametrize('reduce', [False, True])
+def test_instance_loss_matches_gathered_pairs(reduce):
+    input, target = features()
+    x, y = input.clone().requires_grad_(), input.clone().requires_grad_()
+
+    # Same random draws of negative pairs on both sides
+    torch.manual_seed(0)
+    value = InstanceContrastiveLoss(6, reduce=reduce, size_average=True)(x, target)
+    torch.manual_seed(0)
+    expected = reference_instance_loss(y, target, reduce)
+
+    torch.testing.assert_close(value, expected)
+    value.sum().backward()
+    expected.sum().backward()
+    torch.testing.assert_close(x.grad, y.grad)
+
+
+def test_prototype_loss_matches_repeated_copies():
+    input, target = features(1)
+    prototype = torch.randn(4, 3, 16, dtype=torch.float64)
+    x, y = input.clone().requires_grad_(), input.clone().requires_grad_()
+
+    value, expected = PrototypeContrastiveLoss()(x, target, prototype), reference_prototype_loss(y, target, prototype)
+
+    torch.testing.assert_close(value, expected)
+    value.sum().backward()
+    expected.sum().backward()
+    torch.testing.assert_close(x.grad, y.grad)
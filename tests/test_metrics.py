@@ -0,0 +1,429 @@
+import numpy as np
+import pytest
+import torch
+
+from utils.metrics import (AverageMeter, AveragePrecisionMeter, CalibrationMeter, Compute_AP_VOC2012_sorted, Compute_mAP_VOC2012,
+                           EvaluationReport, HistogramAPMeter, OverallMeter, ValidationMeter,
+                           calibration_errors_from_statistics, compute_ace_multi, compute_calibration_statistics,
+                           compute_calibration_sweep, compute_cooccurrence_calibration, compute_inter_feature_distance,
+                           compute_intra_cooccurrence_accuracy, compute_overall, compute_overall_topk, getConcatIndex)
+
+
+def naive_calibration_statistics(probs, labels, bins):
+    """Per-(class, bin) sums with one mask per bin"""
+
+    probs, labels = probs.double(), labels.double()
+    boundaries = torch.linspace(0, 1, bins + 1).double()
+    classNum = probs.size(1)
+
+    res = {key: torch.zeros(classNum, bins + 1, dtype=torch.float64) for key in ('count', 'conf', 'acc')}
+    res.update({key: torch.zeros(classNum, bins, dtype=torch.float64) for key in ('top_count', 'top_conf', 'top_acc')})
+
+    top_conf = torch.where(probs < 0.5, 1 - probs, probs)
+    top_acc = (torch.abs(probs - labels) <= 0.5).double()
+    for b in range(bins + 1):
+        # [lower, upper), the last bin holds probability 1
+        mask = (probs >= boundaries[b]) & (probs < boundaries[b + 1]) if b < bins else probs >= 1
+        res['count'][:, b], res['conf'][:, b], res['acc'][:, b] = mask.sum(0), (probs * mask).sum(0), (labels * mask).sum(0)
+    for b in range(bins):
+        # (lower, upper] on the probability
+        mask = (probs > boundaries[b]) & (probs <= boundaries[b + 1])
+        res['top_count'][:, b], res['top_conf'][:, b], res['top_acc'][:, b] = mask.sum(0), (top_conf * mask).sum(0), (top_acc * mask).sum(0)
+    return res
+
+
+def test_calibration_statistics_match_naive_bins():
+    torch.manual_seed(0)
+    probs = torch.rand(1000, 12)
+    probs[0, 0], probs[1, 1], probs[2, 2], probs[3, 3] = 0.0, 1.0, 0.5, 0.2
+    labels = (torch.rand(1000, 12) < 0.3).float()
+
+    reference = naive_calibration_statistics(probs, labels, 15)
+    for chunk_size in (7, 1000, 4096):
+        statistics = compute_calibration_statistics(probs, labels, 15, chunk_size=chunk_size)
+        for key, value in reference.items():
+            assert torch.allclose(statistics[key], value), key
+        assert torch.equal(statistics['num'], torch.full((12,), 1000.0, dtype=torch.float64))
+
+
+def baseline_classwise_errors(logits, labels, bins=15):
+    """compute_classwise_ece_multi and compute_classwise_mce_multi before the bincount engine, per class"""
+
+    bin_boundaries = torch.linspace(0, 1, bins + 1)
+    bin_lowers = bin_boundaries[:-1]
+    bin_uppers = bin_boundaries[1:]
+
+    classwise_ece, classwise_mce = [], []
+    for i in range(logits.shape[1]):
+        classwise_logits = logits[:,i]
+        classwise_labels = labels[:,i]
+
+        ece, mce = torch.zeros(1), torch.zeros(1)
+
+        for bin_lower, bin_upper in zip(bin_lowers, bin_uppers):
+            in_bin = classwise_logits.gt(bin_lower.item()) * classwise_logits.le(bin_upper.item())
+            prop_in_bin = in_bin.float().mean()
+
+            if prop_in_bin.item() > 0.0:
+                labels_in_bin = classwise_labels[in_bin]
+                confidence_in_bin = classwise_logits[in_bin]
+                accuracy_in_bin = (torch.abs(confidence_in_bin - labels_in_bin) <= 0.5).float().mean()
+
+                confidence_in_bin[confidence_in_bin < 0.5] = 1 - confidence_in_bin[confidence_in_bin < 0.5]
+                avg_confidence_in_bin = confidence_in_bin.mean()
+
+                ece += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
+                mce = torch.max(avg_confidence_in_bin - accuracy_in_bin, mce)
+
+        classwise_ece.append(ece.item())
+        classwise_mce.append(mce.item())
+
+    return classwise_ece, classwise_mce
+
+
+def baseline_ace(logits, labels, bins=15):
+    """compute_ace_multi before the bincount engine, one (sample, class) ranking"""
+
+    sorted_logits = logits.flatten().sort()
+
+    logits_ = sorted_logits.values
+    labels_ = labels.flatten()[sorted_logits.indices]
+
+    count = logits_.size()[0]
+    bin_size = int(count / bins)
+
+    logits_ = logits_.split(bin_size)
+    labels_ = labels_.split(bin_size)
+
+    ace = torch.zeros(1)
+
+    for labels_in_bin, confidence_in_bin in zip(labels_, logits_):
+        accuracy_in_bin = (torch.abs(confidence_in_bin - labels_in_bin) <= 0.5).float().mean()
+        confidence_in_bin[confidence_in_bin < 0.5] = 1 - confidence_in_bin[confidence_in_bin < 0.5]
+        avg_confidence_in_bin = confidence_in_bin.mean()
+
+        ace += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * labels_in_bin.size()[0] / count
+
+    return ace.item()
+
+
+@pytest.mark.parametrize('bins', [15, 10])
+def test_calibration_errors_match_torchmetrics_and_baseline_loops(bins):
+    torchmetrics = pytest.importorskip('torchmetrics.classification')
+
+    generator = torch.Generator().manual_seed(0)
+    probs = torch.rand(600, 5, generator=generator)
+    # p = 0, 1, 0.5 and every bin edge, in each class
+    edges = torch.cat((torch.linspace(0, 1, bins + 1), torch.tensor([0.5, 0.0, 1.0])))
+    probs[:len(edges)] = edges.unsqueeze(1)
+    probs[len(edges):2 * len(edges)] = edges.flip(0).unsqueeze(1)
+    labels = (torch.rand(600, 5, generator=generator) < probs).float()
+
+    res = calibration_errors_from_statistics(compute_calibration_statistics(probs, labels, bins))
+
+    # [lower, upper) bins over all predictions, as torchmetrics
+    ECE_metric = torchmetrics.BinaryCalibrationError(n_bins=bins, norm='l1')
+    MCE_metric = torchmetrics.BinaryCalibrationError(n_bins=bins, norm='max')
+    assert res['ECE'].item() == pytest.approx(ECE_metric(probs, labels.long()).item(), abs=1e-6)
+    assert res['MCE'].item() == pytest.approx(MCE_metric(probs, labels.long()).item(), abs=1e-6)
+
+    # (lower, upper] class-wise bins, as the per-class loops
+    classwise_ece, classwise_mce = baseline_classwise_errors(probs.clone(), labels, bins)
+    np.testing.assert_allclose(res['classwise_ECE'].numpy(), classwise_ece, atol=1e-6)
+    np.testing.assert_allclose(res['classwise_MCE'].numpy(), classwise_mce, atol=1e-6)
+    assert torch.mean(res['classwise_ECE']).item() == pytest.approx(np.mean(classwise_ece), abs=1e-6)
+    assert torch.mean(res['classwise_MCE']).item() == pytest.approx(np.mean(classwise_mce), abs=1e-6)
+
+    # Distinct values, so both rankings agree on the equal-mass bins
+    distinct = torch.randperm(probs.numel(), generator=generator).view_as(probs).float() / probs.numel()
+    assert compute_ace_multi(distinct, labels, bins) == pytest.approx(baseline_ace(distinct.clone(), labels, bins), abs=1e-6)
+
+
+def random_predictions(sampleNum=200, classNum=6, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    logits = 3 * torch.randn(sampleNum, classNum, generator=generator)
+    targets = (torch.rand(sampleNum, classNum, generator=generator) < torch.sigmoid(logits)).float()
+    # Some unknown labels, negative for every metric
+    targets[torch.rand(sampleNum, classNum, generator=generator) < 0.05] = -1
+    return logits, targets
+
+
+def test_overall_meter_matches_compute_overall():
+    logits, targets = random_predictions()
+    meter = OverallMeter(logits.size(1), k=3)
+    for start in range(0, logits.size(0), 32):
+        meter.add(logits[start:start + 32], targets[start:start + 32])
+
+    overall, overall_topk = meter.value()
+    np.testing.assert_allclose(overall, compute_overall(logits.numpy(), targets.numpy()))
+    np.testing.assert_allclose(overall_topk, compute_overall_topk(logits, targets.numpy(), 3))
+
+
+@pytest.mark.parametrize('scale', ['logits', 'probs'])
+def test_calibration_meter_detects_scale_as_report(scale):
+    logits, targets = random_predictions()
+    scores = logits if scale == 'logits' else torch.sigmoid(logits).clamp(1e-4, 1 - 1e-4)
+
+    meter = CalibrationMeter()
+    for start in range(0, scores.size(0), 50):
+        meter.add(scores[start:start + 50], targets[start:start + 50])
+
+    report = EvaluationReport(scores, targets)
+    assert meter.is_logits == report.is_logits == (scale == 'logits')
+    np.testing.assert_allclose(meter.value(), report.calibration()[1:] + report.classwise()[1:])
+
+
+def test_calibration_meter_rejects_logits_after_probs():
+    meter = CalibrationMeter()
+    meter.add(torch.full((2, 3), 0.5), torch.ones(2, 3))
+    with pytest.raises(ValueError):
+        meter.add(torch.full((2, 3), 2.0), torch.ones(2, 3))
+
+
+def test_validation_meter_exact_matches_report():
+    logits, targets = random_predictions()
+    meter = ValidationMeter(logits.size(1))
+    for start in range(0, logits.size(0), 32):
+        meter.add(logits[start:start + 32], targets[start:start + 32])
+    res = meter.value()
+
+    report = EvaluationReport(logits, targets)
+    assert res['mAP'] == pytest.approx(report.mAP())
+    assert res['averageAP'] == pytest.approx(float(report.averageAP()))
+    np.testing.assert_allclose([res[key] for key in ('ACE', 'ECE', 'MCE')], report.calibration())
+    np.testing.assert_allclose([res[key] for key in ('mACE', 'mECE', 'mMCE')], report.classwise())
+    np.testing.assert_allclose([res[key] for key in ('OP', 'OR', 'OF1', 'CP', 'CR', 'CF1')], report.overall())
+    np.testing.assert_allclose([res[key] for key in ('OP_K', 'OR_K', 'OF1_K', 'CP_K', 'CR_K', 'CF1_K')], report.overall_topk(3))
+    assert res['pair_ECE'] == pytest.approx(report.cooccurrence_calibration())
+
+
+def test_validation_meter_streaming_merge():
+    logits, targets = random_predictions()
+    exact, shards = ValidationMeter(logits.size(1)), [ValidationMeter(logits.size(1), keep_scores=False) for _ in range(3)]
+    for index, start in enumerate(range(0, logits.size(0), 32)):
+        exact.add(logits[start:start + 32], targets[start:start + 32])
+        shards[index % 3].add(logits[start:start + 32], targets[start:start + 32])
+    for shard in shards[1:]:
+        shards[0].merge(shard)
+    streamed, res = shards[0].value(), exact.value()
+
+    # Streamed metrics are exact, mAP is within the histogram bounds, the others need the scores
+    for key in ('ECE', 'MCE', 'mECE', 'mMCE', 'OP', 'OF1', 'CP', 'CF1', 'OP_K', 'CF1_K'):
+        assert streamed[key] == pytest.approx(res[key])
+    ap = HistogramAPMeter(logits.size(1))
+    ap.add(logits, targets)
+    lower, upper = ap.bounds()
+    assert lower.mean().item() - 1e-9 <= res['mAP'] <= upper.mean().item() + 1e-9
+    assert streamed['mAP'] == pytest.approx(ap.value().mean().item())
+    assert np.isnan(streamed['ACE']) and np.isnan(streamed['pair_ECE'])
+
+
+@pytest.mark.parametrize('keep_scores', [True, False])
+def test_validation_meter_empty_shard(keep_scores):
+    logits, targets = random_predictions()
+    empty, meter = ValidationMeter(logits.size(1), keep_scores=keep_scores), ValidationMeter(logits.size(1), keep_scores=keep_scores)
+
+    # A rank without batches reports nan calibration instead of failing
+    with np.errstate(divide='ignore', invalid='ignore'):
+        res = empty.value()
+    assert all(np.isnan(res[key]) for key in ('mAP', 'ECE', 'MCE', 'mECE', 'mMCE'))
+
+    # and leaves the metrics of the shards it is merged with unchanged
+    meter.add(logits, targets)
+    expected = meter.value()
+    meter.merge(empty)
+    empty.merge(meter)
+    for res in (meter.value(), empty.value()):
+        for key in ('mAP', 'ECE', 'MCE', 'mECE', 'mMCE', 'OF1'):
+            assert res[key] == pytest.approx(expected[key])
+
+    report = EvaluationReport(logits, targets, calibration_meter=CalibrationMeter())
+    np.testing.assert_allclose(report.calibration(), EvaluationReport(logits, targets).calibration())
+
+
+@pytest.mark.parametrize('difficult_examples', [False, True])
+def test_average_precision_batch_matches_per_class_loop(difficult_examples):
+    logits, targets = random_predictions()
+    meter = AveragePrecisionMeter(difficult_examples)
+    for start in range(0, logits.size(0), 64):
+        meter.add(logits[start:start + 64], targets[start:start + 64].long())
+
+    expected = torch.tensor([AveragePrecisionMeter.average_precision(logits[:, k], targets[:, k].long(), difficult_examples) for k in range(logits.size(1))])
+    torch.testing.assert_close(meter.value(), expected.float())
+
+
+def reference_mAP_VOC2012(prediction, classNum):
+    """Compute_mAP_VOC2012 before vectorization, one class and one sample at a time"""
+
+    Confidence, GroundTruth = prediction[:, :classNum], prediction[:, classNum:].astype(np.int32)
+    APs = []
+    for classId in range(classNum):
+        sortedLabel = [GroundTruth[index][classId] for index in np.argsort(-Confidence[:, classId])]
+        TP = np.cumsum([label > 0 for label in sortedLabel])
+        FP = np.cumsum([label <= 0 for label in sortedLabel])
+        recall, precision = TP / float(TP[-1]), TP / np.maximum(TP + FP, np.finfo(np.float64).eps)
+
+        rec, prec = np.concatenate(([0.], recall, [1.])), np.concatenate(([0.], precision, [0.]))
+        for index in range(prec.size - 1, 0, -1):
+            prec[index - 1] = np.maximum(prec[index - 1], prec[index])
+        index = np.where(rec[1:] != rec[:-1])[0]
+        APs.append(np.sum((rec[index + 1] - rec[index]) * prec[index + 1]))
+    return np.mean(APs)
+
+
+def test_mAP_VOC2012_matches_per_class_loop():
+    logits, targets = random_predictions()
+    prediction = torch.cat((logits, targets), 1).double().numpy()
+
+    assert Compute_mAP_VOC2012(prediction, logits.size(1)) == pytest.approx(reference_mAP_VOC2012(prediction, logits.size(1)), rel=1e-12)
+
+
+def reference_evaluation(scores_, targets_):
+    """AveragePrecisionMeter.evaluation before vectorization, one class at a time"""
+
+    sampleNum, classNum = scores_.shape
+    Nc, Np, Ng = np.zeros(classNum), np.zeros(classNum), np.zeros(classNum)
+    for index in range(classNum):
+        scores, targets = scores_[:, index], targets_[:, index].copy()
+        targets[targets == -1] = 0
+        Ng[index], Np[index], Nc[index] = np.sum(targets == 1), np.sum(scores >= 0), np.sum(targets * (scores >= 0))
+    Np[Np == 0] = 1
+
+    OP, OR = np.sum(Nc) / np.sum(Np), np.sum(Nc) / np.sum(Ng)
+    CP, CR = np.sum(Nc / Np) / classNum, np.sum(Nc / Ng) / classNum
+    return OP, OR, (2 * OP * OR) / (OP + OR), CP, CR, (2 * CP * CR) / (CP + CR)
+
+
+def test_overall_matches_per_sample_loop():
+    logits, targets = random_predictions()
+    scores, labels = logits.numpy(), targets.numpy()
+
+    # Top-k of AveragePrecisionMeter.overall_topk before vectorization, one sample at a time
+    topk = np.zeros(scores.shape) - 1
+    for indexSample, indexs in enumerate(logits.topk(3, 1, True, True)[1].numpy()):
+        for indexClass in indexs:
+            topk[indexSample, indexClass] = 1 if scores[indexSample, indexClass] >= 0 else -1
+
+    np.testing.assert_allclose(compute_overall(scores, labels), reference_evaluation(scores, labels))
+    np.testing.assert_allclose(compute_overall_topk(logits, labels, 3), reference_evaluation(topk, labels))
+    for k, res in zip((1, 3), compute_overall_topk(logits, labels, [1, 3])):
+        np.testing.assert_allclose(res, compute_overall_topk(logits, labels, k))
+
+
+def test_report_matches_separate_metrics():
+    logits, targets = random_predictions()
+    report = EvaluationReport(logits, targets)
+
+    # Metrics of the AveragePrecisionMeter Validate used before EvaluationReport
+    meter = AveragePrecisionMeter()
+    meter.add(logits, targets.long())
+    prediction = torch.cat((logits, (targets > 0).float()), 1).numpy()
+
+    assert report.mAP() == pytest.approx(Compute_mAP_VOC2012(prediction, logits.size(1)))
+    np.testing.assert_allclose(report.overall(), meter.overall())
+    np.testing.assert_allclose(report.overall_topk(3), meter.overall_topk(3))
+    np.testing.assert_allclose(report.calibration(), [float(value) for value in meter.calibration()], rtol=1e-6)
+    np.testing.assert_allclose(report.classwise(), [float(value) for value in meter.compute_classwise()], rtol=1e-6)
+
+
+@pytest.mark.parametrize('space', ['prob', 'logit'])
+@pytest.mark.parametrize('bins', [16, 4096])
+def test_histogram_ap_bounds_contain_exact_ap(space, bins):
+    logits, targets = random_predictions(sampleNum=500)
+    shards = [HistogramAPMeter(logits.size(1), bins, space) for _ in range(2)]
+    for index, start in enumerate(range(0, logits.size(0), 50)):
+        shards[index % 2].add(logits[start:start + 50], targets[start:start + 50])
+    shards[0].merge(shards[1])
+
+    sortedLabel = targets.gather(0, torch.sort(logits, dim=0, descending=True)[1]).numpy()
+    exact = torch.from_numpy(Compute_AP_VOC2012_sorted(sortedLabel))
+
+    lower, upper = shards[0].bounds()
+    assert torch.all(lower <= exact + 1e-9) and torch.all(exact <= upper + 1e-9)
+    assert torch.all((shards[0].value() - exact).abs() <= (upper - lower) / 2 + 1e-9)
+    if bins == 4096:
+        assert (shards[0].value() - exact).abs().max() < 1e-2
+
+
+def test_calibration_sweep_matches_per_bin_count_metrics():
+    logits, targets = random_predictions()
+    probs, labels = torch.sigmoid(logits), (targets > 0).float()
+
+    for row in compute_calibration_sweep(logits, targets, bin_counts=(7, 15, 100)):
+        if row['scheme'] == 'width':
+            res = calibration_errors_from_statistics(compute_calibration_statistics(probs, labels, row['bins']))
+            assert (row['CE'], row['MCE']) == pytest.approx((res['ECE'].item(), res['MCE'].item()))
+        else:
+            assert row['CE'] == pytest.approx(compute_ace_multi(probs, labels, row['bins']), rel=1e-6)
+
+
+def test_cooccurrence_calibration_matches_per_pair_ece():
+    logits, targets = random_predictions(classNum=4)
+    probs, labels = torch.sigmoid(logits), targets > 0
+    res = compute_cooccurrence_calibration(logits, targets, chunk_size=37)
+
+    for i in range(4):
+        rows = labels[:, i]
+        np.testing.assert_array_equal(res['cooccurrence'][i].numpy(), labels[rows].sum(0).numpy())
+        for j in range(4):
+            expected = calibration_errors_from_statistics(compute_calibration_statistics(probs[rows, j:j + 1], labels[rows, j:j + 1]))['ECE']
+            assert res['pair_ECE'][i, j].item() == pytest.approx(expected.item())
+
+
+def reference_inter_feature_distance(meter, feature, target):
+    """compute_inter_feature_distance before the matmul version, from gathered pairs"""
+
+    concatIndex = getConcatIndex(target.size(0))
+    first, second = target[concatIndex[0]], target[concatIndex[1]]
+
+    pos2posTarget = ((first == 1) & (second == 1)).long()
+    neg2negTarget = ((first == -1) & (second == -1)).long()
+    pos2negTarget = 1 - pos2posTarget
+    pos2negTarget[(first == 0) | (second == 0)] = 0
+    pos2negTarget[(first == -1) & (second == -1)] = 0
+
+    distance = torch.nn.CosineSimilarity(dim=2, eps=1e-9)(feature[concatIndex[0]], feature[concatIndex[1]])
+    for key, mask in (('pos2pos', pos2posTarget), ('pos2neg', pos2negTarget), ('neg2neg', neg2negTarget)):
+        if torch.sum(mask) > 0:
+            meter[key].update(torch.mean(distance[mask == 1]).item())
+
+
+def reference_intra_cooccurrence_accuracy(meter, coOccurrence, target):
+    """compute_intra_cooccurrence_accuracy before vectorization"""
+
+    coOccurrence, target = (torch.sigmoid(coOccurrence).numpy() >= 0.5).astype(float), target.numpy()
+    concatIndex = getConcatIndex(target.shape[1])
+    target1, target2 = (target[:, concatIndex[0]] > 0).astype(float), (target[:, concatIndex[1]] > 0).astype(float)
+    target = target1 * target2
+
+    totalNum = 1.0 * coOccurrence.shape[0] * coOccurrence.shape[1]
+    meter['accuracy'].update(np.sum(coOccurrence == target), target.shape[0] * target.shape[1])
+    meter['precision'].update(np.sum((coOccurrence == 1) * (target == 1)), np.sum(coOccurrence == 1))
+    meter['recall'].update(np.sum((coOccurrence == 1) * (target == 1)), np.sum(target == 1))
+    meter['TP'].update(np.sum((coOccurrence == 1) * (target == 1)), totalNum)
+    meter['TN'].update(np.sum((coOccurrence == 0) * (target == 0)), totalNum)
+    meter['FP'].update(np.sum((coOccurrence == 1) * (target == 0)), totalNum)
+    meter['FN'].update(np.sum((coOccurrence == 0) * (target == 1)), totalNum)
+    meter['FP_oneExist'].update(np.sum((coOccurrence == 1) * (target1 == 1) * (target2 == 0)) + np.sum((coOccurrence == 1) * (target1 == 0) * (target2 == 1)), totalNum)
+    meter['FP_noneExist'].update(np.sum((coOccurrence == 1) * (target1 == 0) * (target2 == 0)), totalNum)
+
+
+def test_pairwise_diagnostics_match_gathered_pairs():
+    generator = torch.Generator().manual_seed(0)
+    feature = torch.randn(7, 5, 8, generator=generator)
+    target = torch.randint(-1, 2, (7, 5), generator=generator)
+    coOccurrence = torch.randn(7, 10, generator=generator)
+
+    keys = ('pos2pos', 'pos2neg', 'neg2neg')
+    meter, expected = {key: AverageMeter() for key in keys}, {key: AverageMeter() for key in keys}
+    compute_inter_feature_distance(meter, feature, target)
+    reference_inter_feature_distance(expected, feature, target)
+    for key in keys:
+        assert meter[key].avg == pytest.approx(expected[key].avg, rel=1e-5)
+
+    keys = ('accuracy', 'precision', 'recall', 'TP', 'TN', 'FP', 'FN', 'FP_oneExist', 'FP_noneExist')
+    meter, expected = {key: AverageMeter() for key in keys}, {key: AverageMeter() for key in keys}
+    compute_intra_cooccurrence_accuracy(meter, coOccurrence, target)
+    reference_intra_cooccurrence_accuracy(expected, coOccurrence, target)
+    for key in keys:
+        assert (meter[key].sum, meter[key].count) == pytest.approx((expected[key].sum, expected[key].count))
@@ -0,0 +1,47 @@
+import pytest
+import torch
+
+from calibration.MMCE import MMCE_weighted, MMCE_weighted_sorted, laplacian_kernel_sum
+
+
+def naive_kernel_sum(x, a, y, b, bandwidth=0.4):
+    return torch.sum(a[:, None] * b[None, :] * torch.exp(-torch.abs(x[:, None] - y[None, :]) / bandwidth))
+
+
+def test_kernel_sum_matches_pairs_with_ties():
+    generator = torch.Generator().manual_seed(0)
+    # Quantized values, so x and y share many values
+    x = (torch.rand(40, generator=generator, dtype=torch.float64) * 10).round() / 10
+    y = torch.cat((x[:10], (torch.rand(30, generator=generator, dtype=torch.float64) * 10).round() / 10))
+    a, b = torch.rand(40, generator=generator, dtype=torch.float64), torch.rand(40, generator=generator, dtype=torch.float64)
+
+    inputs = [tensor.clone().requires_grad_() for tensor in (x, a, y, b)]
+    expected = [tensor.clone().requires_grad_() for tensor in (x, a, y, b)]
+
+    value, naive = laplacian_kernel_sum(*inputs), naive_kernel_sum(*expected)
+    value.backward()
+    naive.backward()
+
+    assert value.item() == pytest.approx(naive.item(), rel=1e-12)
+    for tensor, reference in zip(inputs, expected):
+        torch.testing.assert_close(tensor.grad, reference.grad)
+
+
+@pytest.mark.parametrize('tied', [False, True])
+def test_sorted_mmce_matches_pairs(tied):
+    generator = torch.Generator().manual_seed(1)
+    probs = torch.rand(16, 5, generator=generator, dtype=torch.float64)
+    if tied:
+        # Correct and incorrect predictions with the same confidence
+        probs = (probs * 8).round() / 8
+        probs[0, :2], probs[1, :2] = 0.75, 0.25
+    target = (torch.rand(16, 5, generator=generator) < 0.5).long()
+    target[0, :2], target[1, :2] = torch.tensor([1, 0]), torch.tensor([0, 0])
+
+    input, reference = probs.clone().requires_grad_(), probs.clone().float().requires_grad_()
+    value, expected = MMCE_weighted_sorted()(input, target), MMCE_weighted()(reference, target)
+    value.backward()
+    expected.backward()
+
+    assert value.item() == pytest.approx(expected.item(), rel=1e-5)
+    torch.testing.assert_close(input.grad.float(), reference.grad, rtol=1e-4, atol=1e-6)
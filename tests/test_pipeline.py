@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from calibration.pipeline import LossPipeline, base_loss_dict, calibration_loss_dict
+
+
+def make_cfg(method):
+    return SimpleNamespace(model=SimpleNamespace(method=method, inter_distance_weight=1.0))
+
+
+def unshared_losses(pipeline, outputs, targets):
+    """Every term called on its own, recomputing its intermediates"""
+
+    targets = targets if isinstance(targets, tuple) else (targets,)
+    losses = {'base': sum(pipeline.base(outputs, target) for target in targets) / len(targets)}
+    if pipeline.calibration is not None:
+        losses['calibration'] = pipeline.calibration(outputs, targets[0])
+    return losses
+
+
+@pytest.mark.parametrize('method', sorted(base_loss_dict) + sorted(calibration_loss_dict) + ['BCE'])
+@pytest.mark.parametrize('dpcar', [False, True])
+def test_pipeline_matches_unshared_terms(method, dpcar):
+    generator = torch.Generator().manual_seed(0)
+    # DWBL has one weight per COCO class
+    outputs = 4 * torch.randn(6, 80, generator=generator)
+    target = (torch.rand(6, 80, generator=generator) < 0.3).float()
+    # Smoothed second target, as label_smoothing_dynamic gives
+    targets = (target, 0.89 * target + 0.01) if dpcar else target
+
+    pipeline = LossPipeline(make_cfg(method), {'BCEWithLogitsLoss': torch.nn.BCEWithLogitsLoss()})
+
+    shared, expected = outputs.clone().requires_grad_(), outputs.clone().requires_grad_()
+    losses, reference = pipeline(shared, targets), unshared_losses(pipeline, expected, targets)
+
+    assert sorted(losses) == sorted(reference) == sorted(pipeline.terms())
+    for key in losses:
+        torch.testing.assert_close(losses[key], reference[key])
+
+    sum(losses.values()).backward()
+    sum(reference.values()).backward()
+    torch.testing.assert_close(shared.grad, expected.grad)
@@ -0,0 +1,112 @@
+import pytest
+import torch
+from torch.nn import functional as F
+
+from calibration.posthoc import HistogramBinning, TemperatureScaling, VectorScaling, fit_calibrator, fold_calibrator
+from model.element_wise_layer import ElementWiseLayer
+
+
+def miscalibrated(sampleNum=400, classNum=4, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    logits = 3 * torch.randn(sampleNum, classNum, generator=generator, dtype=torch.float64)
+    # Over-confident logits, the true probability is sigmoid(logits / 2 - 0.3)
+    labels = (torch.rand(sampleNum, classNum, generator=generator, dtype=torch.float64) < torch.sigmoid(logits / 2 - 0.3)).double()
+    return logits, labels
+
+
+def minimize_nll(logits, labels, fit_bias, l2=1e-2):
+    """Same penalized NLL as _fit_affine, minimized by autograd and LBFGS"""
+
+    scale, bias = torch.ones(logits.size(1), dtype=torch.float64, requires_grad=True), torch.zeros(logits.size(1), dtype=torch.float64, requires_grad=fit_bias)
+    optimizer = torch.optim.LBFGS([scale, bias] if fit_bias else [scale], max_iter=500, tolerance_grad=1e-12, tolerance_change=1e-14, line_search_fn='strong_wolfe')
+
+    def closure():
+        optimizer.zero_grad()
+        logit = logits * scale + bias
+        loss = torch.sum(F.softplus(logit) - labels * logit) + l2 / 2 * torch.sum((scale - 1) ** 2 + bias ** 2)
+        loss.backward()
+        return loss
+
+    optimizer.step(closure)
+    return scale.detach(), bias.detach()
+
+
+@pytest.mark.parametrize('fit_bias', [False, True])
+def test_vector_scaling_matches_autograd_fit(fit_bias):
+    logits, labels = miscalibrated()
+    calibrator = VectorScaling(fit_bias=fit_bias).fit(logits, labels)
+    scale, bias = minimize_nll(logits, labels, fit_bias)
+
+    torch.testing.assert_close(calibrator.scale, scale, rtol=1e-6, atol=1e-6)
+    torch.testing.assert_close(calibrator.bias, bias, rtol=1e-6, atol=1e-6)
+
+
+def test_temperature_scaling_matches_autograd_fit():
+    logits, labels = miscalibrated()
+    calibrator = TemperatureScaling().fit(logits, labels)
+    scale, _ = minimize_nll(logits.reshape(-1, 1), labels.reshape(-1, 1), False)
+
+    torch.testing.assert_close(calibrator.scale, scale, rtol=1e-6, atol=1e-6)
+    assert calibrator.temperature == pytest.approx(1 / scale.item())
+
+
+def test_histogram_binning_matches_per_bin_frequencies():
+    logits, labels = miscalibrated()
+    calibrator = HistogramBinning(bins=10).fit(logits, labels)
+
+    probs, expected = torch.sigmoid(logits), torch.zeros(logits.size(1), 10, dtype=torch.float64)
+    for c in range(logits.size(1)):
+        for b in range(10):
+            mask = (probs[:, c] >= b / 10) & ((probs[:, c] < (b + 1) / 10) | (b == 9))
+            expected[c, b] = labels[mask, c].mean() if mask.any() else (b + 0.5) / 10
+    torch.testing.assert_close(calibrator.values, expected)
+
+    predicted = calibrator.predict_proba(logits)
+    binIndex = torch.clamp((probs * 10).long(), max=9)
+    torch.testing.assert_close(predicted, expected.gather(1, binIndex.t()).t())
+
+
+def test_isotonic_calibration_is_monotone():
+    logits, labels = miscalibrated()
+    calibrator = fit_calibrator('isotonic', logits, labels)
+
+    order = torch.argsort(logits, dim=0)
+    predicted = calibrator.predict_proba(logits).gather(0, order)
+    assert torch.all(predicted[1:] >= predicted[:-1]) and torch.all((predicted >= 0) & (predicted <= 1))
+
+
+class ElementWiseModel(torch.nn.Module):
+    def __init__(self, classNum, dim):
+        super(ElementWiseModel, self).__init__()
+        self.classifiers = ElementWiseLayer(classNum, dim)
+
+    def forward(self, input):
+        return self.classifiers(input)
+
+
+class LinearModel(torch.nn.Module):
+    def __init__(self, classNum, dim):
+        super(LinearModel, self).__init__()
+        self.output_linear = torch.nn.Linear(dim, classNum)
+
+    def forward(self, input):
+        return self.output_linear(input)
+
+
+@pytest.mark.parametrize('model, shape', [(ElementWiseModel, (5, 4, 8)), (LinearModel, (5, 8))])
+@pytest.mark.parametrize('name', ['temperature', 'vector'])
+def test_folded_model_gives_calibrated_logits(model, shape, name):
+    logits, labels = miscalibrated()
+    calibrator = fit_calibrator(name, logits, labels)
+
+    torch.manual_seed(0)
+    model, input = model(4, 8).double(), torch.randn(*shape, dtype=torch.float64)
+    expected = calibrator.transform(model(input))
+
+    torch.testing.assert_close(fold_calibrator(model, calibrator)(input), expected)
+
+
+def test_fold_rejects_non_affine_calibrator():
+    logits, labels = miscalibrated()
+    with pytest.raises(ValueError):
+        fold_calibrator(LinearModel(4, 8), HistogramBinning().fit(logits, labels))
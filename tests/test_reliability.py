@@ -0,0 +1,34 @@
+import os
+
+import numpy as np
+import torch
+
+from utils.reliability import compute_reliability_statistics, plot_reliability_diagrams
+
+
+def test_reliability_statistics_match_per_bin_masks():
+    generator = torch.Generator().manual_seed(0)
+    logits = 3 * torch.randn(200, 4, generator=generator)
+    labels = (torch.rand(200, 4, generator=generator) < torch.sigmoid(logits)).float()
+    res = compute_reliability_statistics(logits, labels, bins=10)
+
+    # Masks of compute_confidence_cruve_backup, (lower, upper]
+    probs = torch.sigmoid(logits).double()
+    for c in range(4):
+        for b in range(10):
+            in_bin = (probs[:, c] > b / 10) & (probs[:, c] <= (b + 1) / 10)
+            assert res['count'][c, b] == in_bin.sum()
+            if in_bin.any():
+                np.testing.assert_allclose(res['confidence'][c, b], probs[in_bin, c].mean().item())
+                np.testing.assert_allclose(res['accuracy'][c, b], labels[in_bin, c].mean().item())
+
+
+def test_plot_reliability_diagrams(tmp_path):
+    logits, labels = torch.randn(50, 3), (torch.rand(50, 3) < 0.5).float()
+
+    paths = plot_reliability_diagrams(logits, labels, class_names=['a', 'b/c', 'd'], output_dir=str(tmp_path), workers=2)
+    assert [os.path.basename(path) for path in paths] == ['confidence_a.jpg', 'confidence_b_c.jpg', 'confidence_d.jpg']
+    assert all(os.path.isfile(path) for path in paths)
+
+    path, = plot_reliability_diagrams(logits, labels, output_dir=str(tmp_path), single_figure=True)
+    assert os.path.isfile(path)
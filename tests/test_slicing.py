@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+import torch
+
+from utils.metrics import Compute_AP_VOC2012_sorted, calibration_errors_from_statistics, compute_calibration_statistics
+from utils.slicing import cardinality_groups, compute_sliced_metrics, frequency_groups
+
+
+def slice_metrics(scores, targets, rows, classes):
+    """mAP, ECE and MCE recomputed on the materialized slice"""
+
+    scores, labels = scores[rows][:, classes], (targets[rows][:, classes] > 0).float()
+    present = labels.sum(0) > 0
+
+    sortedLabel = labels.gather(0, torch.sort(scores, dim=0, descending=True)[1])[:, present].numpy()
+    mAP = np.mean(Compute_AP_VOC2012_sorted(sortedLabel))
+
+    res = calibration_errors_from_statistics(compute_calibration_statistics(torch.sigmoid(scores), labels > 0))
+    return mAP, res['ECE'].item(), res['MCE'].item()
+
+
+def test_sliced_metrics_match_materialized_slices():
+    generator = torch.Generator().manual_seed(0)
+    scores = 2 * torch.randn(400, 9, generator=generator)
+    targets = (torch.rand(400, 9, generator=generator) < 0.25).float()
+    targets[torch.rand(400, 9, generator=generator) < 0.05] = -1
+
+    row_groups, row_names = cardinality_groups(targets)
+    col_groups, col_names = frequency_groups(torch.randint(1, 1000, (9,), generator=generator).numpy())
+    table = compute_sliced_metrics(scores, targets, row_groups, row_names, col_groups, col_names)
+
+    assert len(table) == (len(row_names) + 1) * (len(col_names) + 1)
+    for res in table:
+        rows = row_groups == row_names.index(res['rows']) if res['rows'] != 'all' else torch.ones(400, dtype=torch.bool)
+        classes = col_groups == col_names.index(res['classes']) if res['classes'] != 'all' else torch.ones(9, dtype=torch.bool)
+        assert (res['images'], res['classNum']) == (int(rows.sum()), int(classes.sum()))
+        assert (res['mAP'], res['ECE'], res['MCE']) == pytest.approx(slice_metrics(scores, targets, rows, classes), rel=1e-5)
+
+
+def test_cardinality_groups():
+    targets = torch.tensor([[0, 0, 0, 0, 0], [1, 0, 0, 0, 0], [1, 1, -1, 0, 0], [1, 1, 1, 0, 0], [1, 1, 1, 1, 1]])
+    groups, names = cardinality_groups(targets)
+
+    assert names == ['1', '2-3', '4+']
+    assert groups.tolist() == [-1, 0, 1, 1, 2]
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import torch
+
+from utils.threshold import apply_thresholds, load_thresholds, save_thresholds, search_thresholds
+
+
+def random_scores(seed=0):
+    rng = np.random.RandomState(seed)
+    scores = np.round(rng.randn(120, 6), 1)  # rounded, so many scores are tied
+    targets = (rng.rand(120, 6) < 1 / (1 + np.exp(-2 * scores))).astype(np.int64)
+    targets[rng.rand(120, 6) < 0.05] = -1
+    return scores, targets
+
+
+def brute_force(scores, targets, target_precision=None):
+    """Best F1 (or highest recall at target_precision) of every class over every distinct threshold"""
+
+    labels = targets > 0
+    res = []
+    for k in range(scores.shape[1]):
+        best = 0.0
+        for threshold in np.unique(scores[:, k]):
+            predict = scores[:, k] >= threshold
+            TP = np.sum(predict & labels[:, k])
+            precision, recall = TP / predict.sum(), TP / max(labels[:, k].sum(), 1)
+            if target_precision is None:
+                best = max(best, 2 * TP / (predict.sum() + labels[:, k].sum()))
+            elif precision >= target_precision:
+                best = max(best, recall)
+        res.append(best)
+    return np.array(res)
+
+
+def test_search_thresholds_reaches_best_f1():
+    scores, targets = random_scores()
+    res = search_thresholds(torch.from_numpy(scores), targets)
+
+    np.testing.assert_allclose(res['F1'], brute_force(scores, targets))
+
+    # The thresholds give the F1 they report
+    predict, labels = apply_thresholds(scores, res['thresholds']), targets > 0
+    np.testing.assert_allclose(2 * np.sum(predict & labels, 0) / (predict.sum(0) + labels.sum(0)), res['F1'])
+
+
+def test_search_thresholds_at_target_precision():
+    scores, targets = random_scores(1)
+    res = search_thresholds(scores, targets, target_precision=0.8)
+
+    np.testing.assert_allclose(res['recall'], brute_force(scores, targets, 0.8))
+    assert np.all(res['precision'][np.isfinite(res['thresholds'])] >= 0.8)
+
+
+@pytest.mark.parametrize('suffix', ['.npy', '.json'])
+def test_thresholds_round_trip(tmp_path, suffix):
+    thresholds = np.array([0.5, -1.25, np.inf])
+    save_thresholds(str(tmp_path / ('thresholds' + suffix)), thresholds)
+    np.testing.assert_array_equal(load_thresholds(str(tmp_path / ('thresholds' + suffix))), thresholds)
@@ -0,0 +1,123 @@
+import numpy as np
+
+import torch
+
+def bootstrap_metrics(scores, targets, n_resamples=1000, bins=15, alpha=0.05, seed=0, max_elements=2 ** 25):
+    """
+    Bootstrap confidence intervals of mAP, ECE and MCE.
+    All resample indices are drawn up front. A resample is represented by how
+    many times it draws each image, so every replicate reuses the statistics of
+    the full set instead of re-running the metrics on a copied subset:
+        ECE / MCE: per-image bin statistics are computed once and reduced for
+            all resamples with one matmul.
+        mAP: the full set is sorted once per class, a resample keeps the same
+            ranking with its draw counts as weights, so VOC AP follows from
+            weighted cumulative sums read at the positives only, resamples are
+            processed in chunks of at most `max_elements` (resample, image,
+            class) entries.
+    scores: (batch, classNum), logits or probabilities
+    targets: (batch, classNum), values > 0 are positive
+
+    Return:
+        res (dict): for 'mAP', 'ECE' and 'MCE' a dict with the 'value' on the
+            full set, the 'mean', 'std', the (alpha/2, 1-alpha/2) percentile
+            interval 'low', 'high' and all 'replicates'
+    """
+
+    if not torch.is_tensor(scores):
+        scores = torch.from_numpy(scores)
+    if not torch.is_tensor(targets):
+        targets = torch.from_numpy(targets)
+
+    scores, labels = scores.detach().float().cpu(), (targets.detach().cpu() > 0).float()
+    probs = torch.sigmoid(scores) if scores.max() >= 1 or scores.min() <= 0 else scores
+    sampleNum, classNum = scores.shape
+
+    generator = torch.Generator().manual_seed(seed)
+    indices = torch.randint(sampleNum, (n_resamples, sampleNum), generator=generator, dtype=torch.int32)
+
+    # Full set counts as one extra replicate with weight one on every image
+    full = torch.ones(1, sampleNum)
+
+    ece, mce = _bootstrap_calibration(probs, labels, indices, full, bins)
+    mAP = _bootstrap_mAP(scores, labels, indices, full, max(1, max_elements // (sampleNum * classNum)))
+
+    res = {}
+    for key, values in (('mAP', mAP), ('ECE', ece), ('MCE', mce)):
+        value, replicates = values[0], values[1:].numpy()
+        res[key] = {'value': value.item(),
+                    'mean': float(np.mean(replicates)),
+                    'std': float(np.std(replicates)),
+                    'low': float(np.percentile(replicates, 100 * alpha / 2)),
+                    'high': float(np.percentile(replicates, 100 * (1 - alpha / 2))),
+                    'replicates': replicates}
+    return res
+
+def _resample_weights(indices, sampleNum):
+    """(resamples, sampleNum) number of times every image is drawn"""
+
+    weights = torch.zeros(indices.size(0), sampleNum)
+    return weights.scatter_add_(1, indices.long(), torch.ones(indices.shape))
+
+def _bootstrap_calibration(probs, labels, indices, full, bins):
+    """ECE / MCE of every resample, with the binning of `compute_calibration_error`"""
+
+    sampleNum = probs.size(0)
+
+    # Per-image count, confidence and label sums of every bin, [lower, upper) like torchmetrics
+    bin_boundaries = torch.linspace(0, 1, bins + 1, dtype=torch.float64)
+    binIndex = torch.bucketize(probs.double(), bin_boundaries, right=True) - 1
+    statistics = torch.zeros(3, sampleNum, bins + 1, dtype=torch.float64)
+    for i, src in enumerate((torch.ones_like(probs), probs, labels)):
+        statistics[i].scatter_add_(1, binIndex, src.double())
+
+    ece, mce = [], []
+    for chunk in [full] + [_resample_weights(chunk, sampleNum) for chunk in indices.split(256)]:
+        count, conf, acc = torch.matmul(chunk.double(), statistics)
+        gap = torch.abs(torch.nan_to_num(acc / count) - torch.nan_to_num(conf / count))
+        ece.append(torch.sum(gap * count, dim=1) / count.sum(1))
+        mce.append(torch.max(gap, dim=1)[0])
+
+    return torch.cat(ece), torch.cat(mce)
+
+def _bootstrap_mAP(scores, labels, indices, full, chunk_size):
+    """
+    VOC2012 mAP of every resample, from one sort of the full set. The
+    interpolated precision only needs to be read at the positives, where it
+    peaks, so beside one cumulative sum of the draw counts over every ranked
+    image all the work is done on the (classNum, maxPositiveNum) positives.
+    """
+
+    sampleNum, classNum = scores.shape
+
+    # (classNum, sampleNum) so that the cumulative sums run over contiguous memory
+    sorted_indices = torch.sort(scores.t(), dim=1, descending=True)[1]
+    sorted_labels = labels.t().gather(1, sorted_indices)
+
+    # Ranks of the positives of every class in ranking order, padded with the last rank
+    positiveNum = int(sorted_labels.sum(1).max().item())
+    positive_ranks = torch.sort(sorted_labels, dim=1, descending=True, stable=True)[1][:, :max(1, positiveNum)]
+    valid = sorted_labels.gather(1, positive_ranks)
+    positive_ranks = torch.where(valid > 0, positive_ranks, torch.full_like(positive_ranks, sampleNum - 1))
+    positive_images = sorted_indices.gather(1, positive_ranks)
+
+    mAP = []
+    for chunk in [full] + list(indices.split(chunk_size)):
+        weights = chunk if chunk is full else _resample_weights(chunk, sampleNum)
+
+        # (resamples, classNum, sampleNum) -> (resamples, classNum, positiveNum), draws ranked up to every positive
+        D = torch.cumsum(weights[:, sorted_indices.flatten()].view(-1, classNum, sampleNum), dim=2)
+        D = D.gather(2, positive_ranks.expand(D.size(0), -1, -1))
+
+        # Draw count of every positive, padding weighs nothing
+        hits = weights[:, positive_images.flatten()].view(-1, classNum, positive_ranks.size(1)) * valid
+        TP = torch.cumsum(hits, dim=2)
+        precision = TP / D.clamp(min=np.finfo(np.float32).eps)
+
+        # Copies of one image share its score, precision grows along them, so the envelope at the last copy holds for all
+        envelope = torch.cummax(precision.flip(2), dim=2)[0].flip(2)
+        APs = torch.sum(hits * envelope, dim=2) / TP[:, :, -1]
+
+        mAP.append(torch.nanmean(APs, dim=1))
+
+    return torch.cat(mAP)
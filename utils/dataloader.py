@@ -3,7 +3,7 @@ import PIL
 import numpy as np
 import torch
 
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 import torchvision.transforms as transforms
 
 from datasets.vg import VG
@@ -101,3 +101,23 @@ def get_data_loader(cfg):
                              )
 
     return train_loader, test_loader
+
+def get_shard_loader(loader, rank, world_size):
+    """
+    Loader over the shard of one rank: a contiguous block of the batches of
+    `loader` (sequential sampler), last incomplete batch dropped as `loader`
+    does. Ranks get whole batches, never padded or duplicated samples, so the
+    shards concatenated in rank order give exactly the batches of `loader`.
+    """
+
+    batchNum = len(loader)
+    start, stop = rank * batchNum // world_size, (rank + 1) * batchNum // world_size
+    indices = list(range(start * loader.batch_size, min(stop * loader.batch_size, len(loader.dataset))))
+
+    return DataLoader(dataset=Subset(loader.dataset, indices),
+                      num_workers=loader.num_workers,
+                      batch_size=loader.batch_size,
+                      collate_fn=loader.collate_fn,
+                      pin_memory=loader.pin_memory,
+                      drop_last=False,
+                      )
@@ -0,0 +1,145 @@
+import torch
+
+from loguru import logger
+
+from utils.metrics import compute_calibration_statistics, calibration_errors_from_statistics
+
+class CalibrationDriftMonitor(object):
+    """
+    Online calibration monitor of an inference stream.
+    Keeps exponentially decayed per-(class, bin) statistics of
+    `compute_calibration_statistics` (the binning of `compute_calibration_error`),
+    so memory is O(classNum * bins) however long the stream. Every image
+    multiplies the older statistics by `decay`, the effective window is about
+    1 / (1 - decay) images.
+    Predictions update the per-class confidence histograms, labels (possibly
+    delayed) update the calibration statistics, a warning is logged when the
+    ECE of a class goes above `threshold` and when it recovers.
+    """
+
+    def __init__(self, classNum, bins=15, decay=0.999, threshold=0.1, min_count=500, is_logits=True, class_names=None):
+        """
+        Args:
+            classNum (int): number of classes
+            bins (int): number of bins
+            decay (float): decay factor per image
+            threshold (float): class-wise ECE above which a class is reported
+            min_count (float): decayed number of labelled images needed before a class is checked,
+                ECE of a few hundred images is biased upwards, keep it below 1 / (1 - decay)
+            is_logits (bool): whether the monitor receives logits or probabilities
+            class_names (list): names used in the alerts, label index by default
+        """
+
+        super(CalibrationDriftMonitor, self).__init__()
+        self.classNum, self.bins, self.decay = classNum, bins, decay
+        self.threshold, self.min_count, self.is_logits = threshold, min_count, is_logits
+        self.class_names = class_names if class_names is not None else [str(classId) for classId in range(classNum)]
+        self.reset()
+
+    def reset(self):
+        """Resets the monitor with empty statistics"""
+
+        self.statistics = None
+        self.histogram = torch.zeros(self.classNum, self.bins + 1, dtype=torch.float64)
+        self.alerted = torch.zeros(self.classNum, dtype=torch.bool)
+
+    def update(self, output, target=None):
+        """
+        Args:
+            output (Tensor): NxK tensor of logits (or probabilities)
+            target (Tensor): NxK labels, values > 0 are positive, None when not available yet
+
+        Return:
+            alerts (list): see `check`
+        """
+
+        self.observe(output)
+        if target is None:
+            return []
+        return self.label(output, target)
+
+    def observe(self, output):
+        """Adds predictions without labels to the confidence histograms"""
+
+        probs = self._probs(output)
+
+        binIndex = torch.bucketize(probs.double(), torch.linspace(0, 1, self.bins + 1, dtype=torch.float64, device=probs.device), right=True) - 1
+        histogram = torch.zeros(self.classNum, self.bins + 1, dtype=torch.float64, device=probs.device)
+        histogram.scatter_add_(1, binIndex.t(), torch.ones_like(binIndex.t(), dtype=torch.float64))
+
+        self.histogram = self.histogram.to(probs.device) * self.decay ** probs.size(0) + histogram
+
+    def label(self, output, target):
+        """
+        Adds labelled predictions (e.g. delayed labels of predictions already
+        observed) to the calibration statistics.
+
+        Return:
+            alerts (list): see `check`
+        """
+
+        probs = self._probs(output)
+        statistics = compute_calibration_statistics(probs, target.detach().to(probs.device) > 0, self.bins)
+
+        if self.statistics is None:
+            self.statistics = statistics
+        else:
+            factor = self.decay ** probs.size(0)
+            for key, value in statistics.items():
+                self.statistics[key] = self.statistics[key].to(value.device) * factor + value
+
+        return self.check()
+
+    def value(self):
+        """Returns the rolling ECE, MCE, mECE, mMCE"""
+
+        if self.statistics is None:
+            return 0
+
+        res = calibration_errors_from_statistics(self.statistics)
+        return res['ECE'].item(), res['MCE'].item(), torch.mean(res['classwise_ECE']).item(), torch.mean(res['classwise_MCE']).item()
+
+    def classwise(self):
+        """Returns the rolling ECE of every class and its decayed number of labelled images"""
+
+        res = calibration_errors_from_statistics(self.statistics)
+        return res['classwise_ECE'], self.statistics['num']
+
+    def histograms(self):
+        """Returns the (classNum, bins + 1) confidence histograms, normalized per class"""
+
+        return self.histogram / self.histogram.sum(1, keepdim=True).clamp(min=1e-12)
+
+    def check(self):
+        """
+        Logs a warning for every class whose rolling ECE went above the
+        threshold since the last check, and when it goes back below.
+
+        Return:
+            alerts (list): dicts with 'class', 'name', 'ECE', 'count' of the
+                classes above the threshold for the first time
+        """
+
+        if self.statistics is None:
+            return []
+
+        classwise_ECE, count = self.classwise()
+        above = (classwise_ECE > self.threshold) & (count >= self.min_count)
+        above, classwise_ECE, count = above.cpu(), classwise_ECE.cpu(), count.cpu()
+
+        alerts = []
+        for classId in torch.nonzero(above & ~self.alerted).flatten().tolist():
+            alerts.append({'class': classId, 'name': self.class_names[classId], 'ECE': classwise_ECE[classId].item(), 'count': count[classId].item()})
+            logger.warning('[Calibration Drift] Class {} ({}): ECE {:.4f} above {:.4f} over the last ~{:.0f} images'.format(
+                classId, self.class_names[classId], classwise_ECE[classId].item(), self.threshold, count[classId].item()))
+        for classId in torch.nonzero(~above & self.alerted & (count >= self.min_count)).flatten().tolist():
+            logger.info('[Calibration Drift] Class {} ({}): ECE back to {:.4f}'.format(classId, self.class_names[classId], classwise_ECE[classId].item()))
+
+        self.alerted = above | (self.alerted & (count < self.min_count))
+        return alerts
+
+    def _probs(self, output):
+
+        output = output.detach().float()
+        assert output.dim() == 2 and output.size(1) == self.classNum, 'Wrong output size (should be NxK with K = classNum)'
+        return torch.sigmoid(output) if self.is_logits else output
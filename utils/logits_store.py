@@ -0,0 +1,108 @@
+import os
+import json
+
+import numpy as np
+
+import torch
+
+class LogitsStore(object):
+    """
+    On-disk store of validation outputs, one directory per epoch:
+        {root}/epoch_{epoch:03d}/logits.bin     float32 (num, classNum)
+                                 labels.bin     int8    (num, classNum), full labels (1 / 0 / -1)
+                                 image_ids.bin  int64   (num,), dataset index of every row
+                                 meta.json      num, classNum and run information
+    The .bin files are raw arrays, appended batch by batch and read back with
+    `np.memmap`, meta.json is written last so that an interrupted epoch is not
+    listed. Reopening an epoch overwrites it, so validating the same epoch
+    again (evaluate, resumed runs) never duplicates rows.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def epoch_dir(self, epoch):
+        return os.path.join(self.root, 'epoch_{:03d}'.format(epoch))
+
+    def epochs(self):
+        """Sorted epochs with a complete meta.json"""
+
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(int(name[len('epoch_'):]) for name in os.listdir(self.root)
+                      if name.startswith('epoch_') and os.path.isfile(os.path.join(self.root, name, 'meta.json')))
+
+    def writer(self, epoch, classNum, **meta):
+        """LogitsWriter of `epoch`, replacing what was stored, extra keyword arguments are saved in meta.json"""
+
+        return LogitsWriter(self.epoch_dir(epoch), classNum, dict(meta, epoch=epoch))
+
+    def load(self, epoch, mmap=True):
+        """
+        Return:
+            res (dict): 'logits', 'labels', 'image_ids' (copy-on-write memmaps, or
+                arrays in memory with mmap=False) and 'meta'
+        """
+
+        path = self.epoch_dir(epoch)
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+        res = {'meta': meta}
+        for key, shape in (('logits', (meta['num'], meta['classNum'])), ('labels', (meta['num'], meta['classNum'])), ('image_ids', (meta['num'],))):
+            dtype = np.dtype(meta['dtypes'][key])
+            if meta['num'] == 0:
+                res[key] = np.zeros(shape, dtype=dtype)
+            elif mmap:
+                res[key] = np.memmap(os.path.join(path, key + '.bin'), dtype=dtype, mode='c', shape=shape)
+            else:
+                res[key] = np.fromfile(os.path.join(path, key + '.bin'), dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+        return res
+
+class LogitsWriter(object):
+    """Writes batches of (logits, full labels, image ids) to one epoch of a LogitsStore, replacing its content"""
+
+    dtypes = {'logits': 'float32', 'labels': 'int8', 'image_ids': 'int64'}
+
+    def __init__(self, path, classNum, meta):
+        os.makedirs(path, exist_ok=True)
+
+        self.path, self.classNum, self.meta = path, classNum, meta
+        self.num = 0
+
+        # Unlist the previous content of the epoch before truncating it
+        metaPath = os.path.join(path, 'meta.json')
+        if os.path.isfile(metaPath):
+            os.remove(metaPath)
+
+        self.files = {key: open(os.path.join(path, key + '.bin'), 'wb') for key in self.dtypes}
+
+    def add(self, output, target, image_ids):
+        """
+        Args:
+            output (Tensor): NxK logits
+            target (Tensor): NxK full labels
+            image_ids (Tensor): N dataset indices
+        """
+
+        for key, value in (('logits', output), ('labels', target), ('image_ids', image_ids)):
+            if torch.is_tensor(value):
+                value = value.detach().cpu().numpy()
+            self.files[key].write(np.ascontiguousarray(value, dtype=self.dtypes[key]).tobytes())
+
+        self.num += len(image_ids)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+        meta = dict(self.meta, num=self.num, classNum=self.classNum, dtypes=self.dtypes)
+        with open(os.path.join(self.path, 'meta.json.tmp'), 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(os.path.join(self.path, 'meta.json.tmp'), os.path.join(self.path, 'meta.json'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,8 +1,8 @@
 import math
+import functools
 import numpy as np
 
 import torch
-from torchmetrics.classification import BinaryCalibrationError
 import matplotlib.pyplot as plt
 
 class AverageMeter(object):
@@ -102,19 +102,7 @@ class AveragePrecisionMeter(object):
         if self.scores.numel() == 0:
             return 0
 
-        ap = torch.zeros(self.scores.size(1))
-        rg = torch.arange(1, self.scores.size(0)).float()
-
-        # Compute average precision for each class
-        for k in range(self.scores.size(1)):
-            # Sort scores
-            scores = self.scores[:, k]
-            targets = self.targets[:, k]
-
-            # Compute average precision
-            ap[k] = AveragePrecisionMeter.average_precision(scores, targets, self.difficult_examples)
-
-        return ap
+        return AveragePrecisionMeter.average_precision_batch(self.scores, self.targets, self.difficult_examples)
 
     @staticmethod
     def average_precision(output, target, difficult_examples=True):
@@ -138,57 +126,52 @@ class AveragePrecisionMeter(object):
 
         return avgPrecision/posCount
 
-    def overall(self):
-
-        if self.scores.numel() == 0:
-            return 0
-
-        scores, targets = self.scores.cpu().numpy(), self.targets.cpu().numpy()
-        targets[targets == -1] = 0
-
-        return self.evaluation(scores, targets)
-
-    def overall_topk(self, k):
+    @staticmethod
+    def average_precision_batch(output, target, difficult_examples=True):
+        """
+        Batched version of `average_precision`, every column of the NxK
+        `output` is sorted with one `torch.sort` and prec@i is read off
+        cumulative sums instead of walking the ranking in Python.
+        Return:
+            ap (FloatTensor): 1xK tensor, with avg precision for each class k
+        """
 
-        targets = self.targets.cpu().numpy()
-        targets[targets == -1] = 0
+        # Sort examples of every class at once
+        sorted, indices = torch.sort(output, dim=0, descending=True)
 
-        sampleNum, classNum = self.scores.size()
-        scores = np.zeros((sampleNum, classNum)) - 1
-        indexs = self.scores.topk(k, 1, True, True)[1].cpu().numpy()
+        return AveragePrecisionMeter.average_precision_sorted(target.gather(0, indices), difficult_examples)
 
-        tmp = self.scores.cpu().numpy()
-        for indexSample in range(sampleNum):
-            for indexClass in indexs[indexSample]:
-                scores[indexSample, indexClass] = 1 if tmp[indexSample, indexClass] >= 0 else -1
+    @staticmethod
+    def average_precision_sorted(target, difficult_examples=True):
+        """
+        Average precision of every column of an NxK `target` that is already
+        ranked by descending score.
+        """
 
-        return self.evaluation(scores, targets)
+        # Difficult examples (target == 0) are skipped, they neither count as hit nor as retrieved
+        positive = (target == 1).double()
+        retrieved = (target != 0).double() if difficult_examples else torch.ones_like(positive)
 
-    def evaluation(self, scores_, targets_):
+        # Computes prec@i at every hit
+        posCount, totalCount = torch.cumsum(positive, dim=0), torch.cumsum(retrieved, dim=0)
+        avgPrecision = torch.sum(positive * posCount / totalCount.clamp(min=1), dim=0)
 
-        sampleNum, classNum = scores_.shape
-        Nc, Np, Ng = np.zeros(classNum), np.zeros(classNum), np.zeros(classNum)
+        return (avgPrecision / posCount[-1]).float()
 
-        for index in range(classNum):
+    def overall(self):
 
-            scores, targets = scores_[:, index], targets_[:, index]
-            targets[targets == -1] = 0
+        if self.scores.numel() == 0:
+            return 0
 
-            Ng[index] = np.sum(targets == 1)
-            Np[index] = np.sum(scores >= 0)
-            Nc[index] = np.sum(targets * (scores >= 0))
+        return compute_overall(self.scores.cpu().numpy(), self.targets.cpu().numpy())
 
-        Np[Np == 0] = 1 
+    def overall_topk(self, k):
 
-        OP = np.sum(Nc) / np.sum(Np)
-        OR = np.sum(Nc) / np.sum(Ng)
-        OF1 = (2 * OP * OR) / (OP + OR)
+        return compute_overall_topk(self.scores.cpu().numpy(), self.targets.cpu().numpy(), k)
 
-        CP = np.sum(Nc / Np) / classNum
-        CR = np.sum(Nc / Ng) / classNum
-        CF1 = (2 * CP * CR) / (CP + CR)
+    def evaluation(self, scores_, targets_):
 
-        return OP, OR, OF1, CP, CR, CF1
+        return evaluation(scores_, targets_)
 
     def accuary(self):
         from torchmetrics.classification import MultilabelAccuracy
@@ -226,26 +209,449 @@ class AveragePrecisionMeter(object):
         # print(scores.shape, targets.shape)
         targets[targets == -1] = 0
 
-        if logits.max() >= 1 or logits.min() <= 0:
-            logits = torch.sigmoid(logits)
-
-        mACE = compute_classwise_ace_multi(logits, targets)
-        mECE = compute_classwise_ece_multi(logits, targets)
-        mMCE = compute_classwise_mce_multi(logits, targets)
-        return mACE, mECE, mMCE
+        res = compute_calibration_metrics(logits, targets)
+        return res['mACE'], res['mECE'], res['mMCE']
 
     def compute_calibration_error(self, logits, labels):
         if logits.max() >= 1 or logits.min() <= 0:
             logits = torch.sigmoid(logits)
 
-        ECE_metric = BinaryCalibrationError(n_bins=15, norm='l1')
-        MCE_metric = BinaryCalibrationError(n_bins=15, norm='max')
-
         ace = compute_ace_multi(logits, labels)
-        ece = ECE_metric(logits, labels)
-        mce = MCE_metric(logits, labels)
+        res = calibration_errors_from_statistics(compute_calibration_statistics(logits, labels))
+
+        return ace, res['ECE'], res['MCE']
+
+class CalibrationMeter(object):
+    """
+    Streaming ECE, MCE and class-wise ECE, MCE. Only the per-(class, bin)
+    statistics of `compute_calibration_statistics` are kept and updated batch
+    by batch, so memory is O(classNum * bins) whatever the number of evaluated
+    images. Meters of several loaders, workers or ranks are combined with
+    `merge`. ACE needs the sorted predictions and is not available here.
+    """
+
+    def __init__(self, bins=15, is_logits=None):
+        """
+        Args:
+            bins (int): number of bins
+            is_logits (bool): whether `add` receives logits or probabilities, None
+                detects it as EvaluationReport does (logits when some value is
+                >= 1 or <= 0), from the first batch
+        """
+
+        super(CalibrationMeter, self).__init__()
+        self.bins = bins
+        self.detect = is_logits is None
+        self.is_logits = is_logits
+        self.reset()
+
+    def reset(self):
+        """Resets the meter with empty statistics"""
+
+        self.statistics = None
+        if self.detect:
+            self.is_logits = None
+
+    def add(self, output, target):
+        """
+        Args:
+            output (Tensor): NxK tensor of logits (or probabilities)
+            target (Tensor): NxK tensor, values > 0 are positive, 0 and -1 negative
+        """
+
+        output = output.detach().float()
+        if self.detect:
+            is_logits = bool(output.max() >= 1 or output.min() <= 0)
+            if self.is_logits is None:
+                self.is_logits = is_logits
+            elif is_logits and not self.is_logits:
+                raise ValueError('CalibrationMeter took the first batch for probabilities but later got logits, pass is_logits=True')
+        probs = torch.sigmoid(output) if self.is_logits else output
+
+        self.merge(compute_calibration_statistics(probs, target.detach() > 0, self.bins))
+
+    def merge(self, other):
+        """Adds the statistics of another meter (or of `compute_calibration_statistics`)"""
+
+        if isinstance(other, CalibrationMeter):
+            if self.is_logits is None:
+                self.is_logits = other.is_logits
+            assert other.is_logits is None or other.is_logits == self.is_logits, 'Meters of logits and of probabilities'
+
+        statistics = other.statistics if isinstance(other, CalibrationMeter) else other
+        if statistics is None:
+            return
+
+        # Kept on the CPU, so meters of different devices or ranks can be merged
+        if self.statistics is None:
+            self.statistics = {key: value.cpu().clone() for key, value in statistics.items()}
+            return
+
+        assert statistics['count'].shape == self.statistics['count'].shape, 'Statistics of different class or bin numbers'
+        for key, value in statistics.items():
+            self.statistics[key] += value.cpu()
+
+    def value(self):
+        """Returns ECE, MCE, mECE, mMCE"""
+
+        if self.statistics is None:
+            nan = float('nan')
+            return nan, nan, nan, nan
+
+        res = calibration_errors_from_statistics(self.statistics)
+        return res['ECE'].item(), res['MCE'].item(), torch.mean(res['classwise_ECE']).item(), torch.mean(res['classwise_MCE']).item()
+
+class HistogramAPMeter(object):
+    """
+    Approximate VOC AP of every class from fixed-resolution score histograms.
+    Only the number of positive and negative predictions falling into each of
+    `bins` equal-width score bins is kept per class, so memory is
+    O(classNum * bins) and meters of several workers or ranks are merged by
+    adding their histograms.
+
+    Error bound: inside a bin the order of positives and negatives is unknown.
+    Ranking the negatives of every bin first gives the lowest VOC AP any
+    ordering consistent with the histogram can have, ranking the positives
+    first gives the highest one. The exact AP of `Compute_mAP_VOC2012` (for
+    any tie order) lies between them, `bounds()` returns both and `value()`
+    their midpoint, so |value() - exact| <= (upper - lower) / 2 per class.
+    The gap only comes from bins that hold both positives and negatives and
+    shrinks as the resolution grows. In 'prob' space scores are binned after
+    the sigmoid, which saturates above ~17 in float32; use 'logit' space when
+    many confident predictions have to be told apart.
+    """
+
+    def __init__(self, classNum, bins=4096, space='prob', logit_range=(-16.0, 16.0)):
+        """
+        Args:
+            classNum (int): number of classes
+            bins (int): number of histogram bins
+            space (str): 'prob' bins sigmoid(output) over [0, 1], 'logit'
+                bins the raw output over `logit_range`, clamping outside
+            logit_range (tuple): score range covered in 'logit' space
+        """
 
-        return ace, ece, mce
+        super(HistogramAPMeter, self).__init__()
+        assert space in ('prob', 'logit'), 'Space of HistogramAPMeter should be prob or logit'
+
+        self.classNum = classNum
+        self.bins = bins
+        self.space = space
+        self.logit_range = logit_range
+        self.reset()
+
+    def reset(self):
+        """Resets the meter with empty histograms"""
+
+        self.pos_hist = torch.zeros(self.classNum, self.bins, dtype=torch.long)
+        self.neg_hist = torch.zeros(self.classNum, self.bins, dtype=torch.long)
+
+    def add(self, output, target):
+        """
+        Args:
+            output (Tensor): NxK tensor of logits
+            target (Tensor): NxK tensor, values > 0 are positive, 0 and -1 negative
+        """
+
+        output = output.detach().float()
+        if self.space == 'prob':
+            position = torch.sigmoid(output)
+        else:
+            low, high = self.logit_range
+            position = (output.clamp(low, high) - low) / (high - low)
+
+        binIndex = (position * self.bins).long().clamp(0, self.bins - 1)
+        binIndex = binIndex + torch.arange(self.classNum, device=binIndex.device) * self.bins
+        binIndex = binIndex + (target.detach() <= 0).long() * self.classNum * self.bins
+
+        hist = torch.bincount(binIndex.flatten(), minlength=2 * self.classNum * self.bins).cpu()
+        self.pos_hist += hist[:self.classNum * self.bins].view(self.classNum, self.bins)
+        self.neg_hist += hist[self.classNum * self.bins:].view(self.classNum, self.bins)
+
+    def merge(self, other):
+        """Adds the histograms of another meter with the same classes, bins and space"""
+
+        assert (other.classNum, other.bins, other.space) == (self.classNum, self.bins, self.space), 'Histograms are not compatible'
+        self.pos_hist += other.pos_hist
+        self.neg_hist += other.neg_hist
+
+    def all_reduce(self):
+        """Sums the histograms over all ranks of the default process group"""
+
+        if not torch.distributed.is_available() or not torch.distributed.is_initialized():
+            return
+
+        hist = torch.stack((self.pos_hist, self.neg_hist))
+        if torch.distributed.get_backend() == 'nccl':
+            hist = hist.cuda()
+        torch.distributed.all_reduce(hist)
+        self.pos_hist, self.neg_hist = hist[0].cpu(), hist[1].cpu()
+
+    def bounds(self):
+        """
+        Return:
+            lower, upper (DoubleTensor): 1xK tensors, the lowest and highest VOC AP
+                of each class over all rankings consistent with the histograms
+        """
+
+        # From the highest scores to the lowest
+        pos, neg = self.pos_hist.flip(1).double(), self.neg_hist.flip(1).double()
+        TP, D = torch.cumsum(pos, dim=1), torch.cumsum(pos + neg, dim=1)
+        objectNum = TP[:, -1:]
+
+        # Negatives of a bin ranked first: precision at its last positive is TP / D.
+        # Positives ranked first: its last positive comes right after the previous bins.
+        # Within a bin precision grows from one positive to the next, so the last positive sets the envelope.
+        precision_lower = torch.where(pos > 0, TP / D.clamp(min=1), torch.zeros_like(pos))
+        precision_upper = torch.where(pos > 0, TP / (D - neg).clamp(min=1), torch.zeros_like(pos))
+
+        res = []
+        for precision in (precision_lower, precision_upper):
+            envelope = torch.cummax(precision.flip(1), dim=1)[0].flip(1)
+            res.append(torch.sum(pos * envelope, dim=1) / objectNum.squeeze(1))
+
+        return res[0], res[1]
+
+    def value(self):
+        """
+        Return:
+            ap (DoubleTensor): 1xK tensor, the approximate VOC AP of each class
+        """
+
+        lower, upper = self.bounds()
+        return (lower + upper) / 2
+
+class OverallMeter(object):
+    """
+    Streaming OP, OR, OF1, CP, CR, CF1 of `compute_overall` (scores >= 0 are
+    positive) and `compute_overall_topk` (only the top-k of each sample). Only
+    the per-class numbers of labels, predictions and correct predictions are
+    kept, meters are combined with `merge`.
+    """
+
+    def __init__(self, classNum, k=3):
+        super(OverallMeter, self).__init__()
+        self.classNum = classNum
+        self.k = k
+        self.reset()
+
+    def reset(self):
+        """Resets the meter with empty counts"""
+
+        # Ng (classNum,), Np and Nc (2, classNum): all positive scores, then the top-k ones
+        self.Ng = torch.zeros(self.classNum, dtype=torch.long)
+        self.Np = torch.zeros(2, self.classNum, dtype=torch.long)
+        self.Nc = torch.zeros(2, self.classNum, dtype=torch.long)
+
+    def add(self, output, target):
+        """
+        Args:
+            output (Tensor): NxK tensor of scores
+            target (Tensor): NxK tensor, values > 0 are positive, 0 and -1 negative
+        """
+
+        scores, labels = output.detach().float().cpu(), target.detach().cpu() > 0
+        positive = scores >= 0
+        topk = torch.zeros_like(positive).scatter_(1, scores.topk(self.k, 1, True, True)[1], True) & positive
+        predict = torch.stack((positive, topk))
+
+        self.Ng += labels.sum(0)
+        self.Np += predict.sum(1)
+        self.Nc += (predict & labels).sum(1)
+
+    def merge(self, other):
+        """Adds the counts of another meter with the same classes and k"""
+
+        assert (other.classNum, other.k) == (self.classNum, self.k), 'Meters are not compatible'
+        self.Ng += other.Ng
+        self.Np += other.Np
+        self.Nc += other.Nc
+
+    def value(self):
+        """Returns (OP, OR, OF1, CP, CR, CF1) with all labels and with the top-k labels"""
+
+        Ng = self.Ng.double().numpy()
+        return [evaluation_from_counts(Ng, self.Np[index].double().numpy(), self.Nc[index].double().numpy()) for index in range(2)]
+
+class ValidationMeter(object):
+    """
+    Every metric logged by `Validate`, accumulated batch by batch.
+    ECE, MCE, mECE, mMCE (CalibrationMeter) and OP/OR/OF1/CP/CR/CF1, all and
+    top-k (OverallMeter), are streamed with O(classNum * bins) memory.
+    mAP, averageAP, ACE, mACE and pair-ECE need every score: with
+    `keep_scores` the outputs are kept and these are exact (EvaluationReport),
+    otherwise mAP is the HistogramAPMeter approximation and the others are nan.
+    """
+
+    def __init__(self, classNum, bins=15, keep_scores=True, k=3, ap_bins=4096):
+        """
+        Args:
+            classNum (int): number of classes
+            bins (int): number of bins of the calibration metrics
+            keep_scores (bool): keep every output for the exact mAP, averageAP, ACE, mACE and pair-ECE
+            k (int): k of the top-k overall metrics
+            ap_bins (int): histogram resolution of the approximate mAP without `keep_scores`
+        """
+
+        super(ValidationMeter, self).__init__()
+        self.classNum, self.bins, self.keep_scores, self.k, self.ap_bins = classNum, bins, keep_scores, k, ap_bins
+        self.reset()
+
+    def reset(self):
+        """Resets every meter"""
+
+        self.calibration = CalibrationMeter(self.bins)
+        self.overall = OverallMeter(self.classNum, self.k)
+        self.scores, self.targets = [], []
+        self.ap = None if self.keep_scores else HistogramAPMeter(self.classNum, self.ap_bins)
+
+    def add(self, output, target):
+        """
+        Args:
+            output (Tensor): NxK tensor of logits (or probabilities)
+            target (Tensor): NxK tensor, values > 0 are positive, 0 and -1 negative
+        """
+
+        self.calibration.add(output, target)
+        self.overall.add(output, target)
+        if self.keep_scores:
+            self.scores.append(output.detach().cpu())
+            self.targets.append(target.detach().cpu())
+        else:
+            self.ap.add(output, target)
+
+    def merge(self, other):
+        """Adds another meter, kept scores are appended after the current ones"""
+
+        assert other.keep_scores == self.keep_scores, 'Meters with and without scores'
+        self.calibration.merge(other.calibration)
+        self.overall.merge(other.overall)
+        if self.keep_scores:
+            self.scores += other.scores
+            self.targets += other.targets
+        else:
+            self.ap.merge(other.ap)
+
+    def value(self):
+        """
+        Return:
+            res (dict): 'mAP', 'averageAP', 'OP', 'OR', 'OF1', 'CP', 'CR', 'CF1',
+                the same with '_K' for top-k, 'ACE', 'ECE', 'MCE', 'mACE', 'mECE',
+                'mMCE' and 'pair_ECE'
+        """
+
+        nan = float('nan')
+        ECE, MCE, mECE, mMCE = self.calibration.value()
+        res = {'ECE': ECE, 'MCE': MCE, 'mECE': mECE, 'mMCE': mMCE}
+
+        overall, overall_topk = self.overall.value()
+        res.update(zip(('OP', 'OR', 'OF1', 'CP', 'CR', 'CF1'), overall))
+        res.update(zip(('OP_K', 'OR_K', 'OF1_K', 'CP_K', 'CR_K', 'CF1_K'), overall_topk))
+
+        if self.keep_scores and self.scores:
+            report = EvaluationReport(torch.cat(self.scores, 0), torch.cat(self.targets, 0), self.bins, calibration_meter=self.calibration)
+            res['mAP'], res['averageAP'] = report.mAP(), float(report.averageAP())
+            res['ACE'], res['mACE'] = report.ace(), report.classwise_ace()
+            res['pair_ECE'] = report.cooccurrence_calibration()
+        elif not self.keep_scores:
+            res['mAP'], res['averageAP'] = torch.mean(self.ap.value()).item(), nan
+            res['ACE'], res['mACE'], res['pair_ECE'] = nan, nan, nan
+        else:
+            # Nothing added, e.g. an empty validation shard
+            res.update(dict.fromkeys(('mAP', 'averageAP', 'ACE', 'mACE', 'pair_ECE'), nan))
+
+        return res
+
+class EvaluationReport(object):
+    """
+    Every metric reported by `Validate`, computed from one `NxK` score matrix
+    and its `NxK` target matrix. Scores are sorted once per class and passed
+    through the sigmoid once; mAP, averageAP, OP/OR/OF1/CP/CR/CF1 (all and
+    top-k), ACE/ECE/MCE and their class-wise means are all derived from these
+    shared intermediates. The inputs are never modified.
+    """
+
+    def __init__(self, scores, targets, bins=15, calibration_meter=None):
+        """
+        Args:
+            scores (Tensor): NxK tensor of model outputs (logits or probabilities)
+            target (Tensor): NxK tensor, values > 0 are positive, 0 and -1 negative
+            bins (int): number of bins of the calibration metrics
+            calibration_meter (CalibrationMeter): statistics already streamed
+                over the same predictions, ECE/MCE/mECE/mMCE are then read from
+                it instead of being recomputed
+        """
+
+        if not torch.is_tensor(scores):
+            scores = torch.from_numpy(scores)
+        if not torch.is_tensor(targets):
+            targets = torch.from_numpy(targets)
+
+        self.bins = bins
+        self.scores = scores.detach().float().cpu()
+        self.targets = (targets.detach().cpu() > 0).long()
+
+        # One sort per class, shared by mAP, averageAP and class-wise ACE
+        self.sorted_scores, indices = torch.sort(self.scores, dim=0, descending=True)
+        self.sorted_targets = self.targets.gather(0, indices)
+
+        # One sigmoid, shared by every calibration metric
+        self.is_logits = self.scores.max() >= 1 or self.scores.min() <= 0
+        self.probs = torch.sigmoid(self.scores) if self.is_logits else self.scores
+        self.sorted_probs = torch.sigmoid(self.sorted_scores) if self.is_logits else self.sorted_scores
+
+        self._calibration_statistics = None
+        if calibration_meter is not None and calibration_meter.statistics is not None:
+            assert calibration_meter.bins == bins, 'Calibration meter uses a different bin number'
+            assert calibration_meter.is_logits in (None, self.is_logits), 'Calibration meter and report disagree on logits'
+            self._calibration_statistics = {key: value.cpu() for key, value in calibration_meter.statistics.items()}
+
+    def mAP(self):
+        return np.mean(Compute_AP_VOC2012_sorted(self.sorted_targets.numpy()))
+
+    def averageAP(self):
+        return AveragePrecisionMeter.average_precision_sorted(self.sorted_targets, difficult_examples=False).mean()
+
+    def overall(self):
+        return compute_overall(self.scores.numpy(), self.targets.numpy())
+
+    def overall_topk(self, k):
+        return compute_overall_topk(self.scores.numpy(), self.targets.numpy(), k)
+
+    def calibration_statistics(self):
+        """Per-(class, bin) statistics of `compute_calibration_statistics`, computed once"""
+
+        if self._calibration_statistics is None:
+            self._calibration_statistics = compute_calibration_statistics(self.probs, self.targets, self.bins)
+        return self._calibration_statistics
+
+    def ace(self):
+        """ACE over all (sample, class) predictions"""
+
+        return compute_ace_multi(self.probs, self.targets, self.bins)
+
+    def classwise_ace(self):
+        """mACE, the adaptive calibration error averaged over classes"""
+
+        # Ascending probabilities of every class are the descending scores read backwards
+        return compute_classwise_ace_sorted(self.sorted_probs.flip(0), self.sorted_targets.flip(0), self.bins).item()
+
+    def calibration(self):
+        """Returns ACE, ECE, MCE over all (sample, class) predictions"""
+
+        res = calibration_errors_from_statistics(self.calibration_statistics())
+        return self.ace(), res['ECE'].item(), res['MCE'].item()
+
+    def classwise(self):
+        """Returns mACE, mECE, mMCE, the calibration errors averaged over classes"""
+
+        res = calibration_errors_from_statistics(self.calibration_statistics())
+        return self.classwise_ace(), torch.mean(res['classwise_ECE']).item(), torch.mean(res['classwise_MCE']).item()
+
+    def cooccurrence_calibration(self):
+        """Returns pair-ECE, the mean calibration of class j given class i is present, see `compute_cooccurrence_calibration`"""
+
+        return compute_cooccurrence_calibration(self.probs, self.targets, self.bins)['mean']
 
 def ComputeAccuracy(output, target, topK=(1,)):
     """Compute precision@k for the specific value of k"""
@@ -272,33 +678,97 @@ def ComputeAP_VOC(recall, precision):
     index = np.where(rec[1:]!=rec[:-1])[0]
     return np.sum((rec[index+1]-rec[index]) * prec[index+1])
 
-def Compute_mAP_VOC2012(prediction, classNum, seenIndex=None, unseenIndex=None):
-    """Compute mAP with VOC2012 standard"""
+def ComputeAP_VOC_batch(recall, precision):
+    """Compute AP with VOC standard for every column of (N, classNum) recall/precision"""
 
-    #with open(filePath, 'r') as f:
-    #    lines = f.readlines()
-    #seg = np.array([line.strip().split(' ') for line in lines]).astype(float)
+    zeros, ones = np.zeros((1, recall.shape[1])), np.ones((1, recall.shape[1]))
+    rec, prec = np.concatenate((zeros, recall, ones)), np.concatenate((zeros, precision, zeros))
 
-    Confidence, GroundTruth = prediction[:, :classNum], prediction[:, classNum:].astype(np.int32)
-    APs, TP, FP = [], np.zeros(GroundTruth.shape[0]), np.zeros(GroundTruth.shape[0])
+    # Precision envelope, running maximum from the end of the ranking
+    prec = np.maximum.accumulate(prec[::-1], axis=0)[::-1]
 
-    for classId in range(classNum):
+    # Recall steps of zero width contribute nothing, so no need to look for the change points
+    return np.sum((rec[1:] - rec[:-1]) * prec[1:], axis=0)
 
-        sortedLabel = [GroundTruth[index][classId] for index in np.argsort(-Confidence[:, classId])]
-        for index in range(GroundTruth.shape[0]):
-            TP[index], FP[index] = (sortedLabel[index]>0), (sortedLabel[index]<=0)
+def Compute_mAP_VOC2012(prediction, classNum, seenIndex=None, unseenIndex=None):
+    """Compute mAP with VOC2012 standard"""
 
-        objectNum, TP, FP = sum(TP), np.cumsum(TP), np.cumsum(FP)
-        recall, precision = TP / float(objectNum), TP / np.maximum(TP + FP, np.finfo(np.float64).eps)
-        APs += [ComputeAP_VOC(recall, precision)]
+    Confidence, GroundTruth = prediction[:, :classNum], prediction[:, classNum:].astype(np.int32)
 
-    np.set_printoptions(precision=3, suppress=True)
-    APs = np.array(APs)
+    # Rank the samples of every class in one argsort
+    sortedIndex = np.argsort(-Confidence, axis=0)
+    APs = Compute_AP_VOC2012_sorted(np.take_along_axis(GroundTruth, sortedIndex, axis=0))
 
-    if seenIndex==None and unseenIndex==None:
+    if seenIndex is None and unseenIndex is None:
         return np.mean(APs) # mAP for all
     return np.mean(APs[seenIndex]), np.mean(APs[unseenIndex]), np.mean(APs) # mAP for base, mAP for novel, mAP for all
 
+def Compute_AP_VOC2012_sorted(sortedLabel):
+    """Compute per-class AP with VOC2012 standard from labels ranked by descending confidence"""
+
+    TP, FP = np.cumsum(sortedLabel > 0, axis=0), np.cumsum(sortedLabel <= 0, axis=0)
+    objectNum = TP[-1].astype(np.float64)
+
+    recall, precision = TP / objectNum, TP / np.maximum(TP + FP, np.finfo(np.float64).eps)
+    return ComputeAP_VOC_batch(recall, precision)
+
+def compute_overall(scores, targets):
+    """OP, OR, OF1, CP, CR, CF1 with every score >= 0 taken as positive"""
+
+    return evaluation(scores, targets)
+
+def compute_overall_topk(scores, targets, k):
+    """
+    OP, OR, OF1, CP, CR, CF1 with only the top-k scores (>= 0) of each sample
+    taken as positive. `k` may be a list, then one tuple is returned per k and
+    all of them come from a single topk(max(k)) call.
+    """
+
+    ks = [k] if isinstance(k, int) else list(k)
+
+    scores = torch.as_tensor(scores)
+    indexs = scores.topk(max(ks), 1, True, True)[1]
+    positive = scores >= 0
+
+    res = []
+    for k_ in ks:
+        predict = torch.zeros_like(positive).scatter_(1, indexs[:, :k_], True) & positive
+        res.append(evaluation_from_prediction(predict.numpy(), targets))
+
+    return res[0] if isinstance(k, int) else res
+
+def evaluation(scores_, targets_):
+
+    return evaluation_from_prediction(scores_ >= 0, targets_)
+
+def evaluation_from_prediction(predict, targets_):
+    """Overall and per-class precision/recall of a boolean (sampleNum, classNum) prediction"""
+
+    sampleNum, classNum = predict.shape
+    targets = np.where(targets_ == -1, 0, targets_)
+
+    Ng = np.sum(targets == 1, axis=0).astype(np.float64)
+    Np = np.sum(predict, axis=0).astype(np.float64)
+    Nc = np.sum(targets * predict, axis=0).astype(np.float64)
+
+    return evaluation_from_counts(Ng, Np, Nc)
+
+def evaluation_from_counts(Ng, Np, Nc):
+    """OP, OR, OF1, CP, CR, CF1 from the per-class numbers of labels, predictions and correct predictions"""
+
+    classNum = len(Ng)
+    Np = np.where(Np == 0, 1, Np)
+
+    OP = np.sum(Nc) / np.sum(Np)
+    OR = np.sum(Nc) / np.sum(Ng)
+    OF1 = (2 * OP * OR) / (OP + OR)
+
+    CP = np.sum(Nc / Np) / classNum
+    CR = np.sum(Nc / Ng) / classNum
+    CF1 = (2 * CP * CR) / (CP + CR)
+
+    return OP, OR, OF1, CP, CR, CF1
+
 
 def getConcatIndex(classNum):
     res = [[], []]
@@ -331,36 +801,42 @@ def compute_pseudo_label_accuracy(meter, pseudoLabel, groundTruth, margin=0.5):
     meter['FN'].update(np.sum((pseudoLabel==-1) * (groundTruth==1)), groundTruth.shape[0] * groundTruth.shape[1])
 
 
+@functools.lru_cache(maxsize=None)
+def getTriuMask(size, device='cpu'):
+    """(size, size) bool mask of the pairs i < j, in the order of getConcatIndex, built once per size"""
+
+    return torch.ones(size, size, dtype=torch.bool, device=device).triu(diagonal=1)
+
 def compute_intra_cooccurrence_accuracy(meter, coOccurrence, target):
     """
     Shape of coOccurrence : (BatchSize, \sum_{i=1}^{classNum-1}{i})
     Shape of target : (BatchSize, classNum)
     """
 
-    coOccurrence, target = torch.sigmoid(coOccurrence).cpu().data.numpy(), target.cpu().data.numpy()
-    coOccurrence[coOccurrence >= 0.5] = 1
-    coOccurrence[coOccurrence < 0.5] = 0
-
-    concatIndex = getConcatIndex(target.shape[1])
-    target1, target2 = target[:, concatIndex[0]], target[:, concatIndex[1]]
-    target1, target2 = (target1 > 0).astype(np.float), (target2 > 0).astype(np.float)
-    target = target1 * target2
+    coOccurrence = (torch.sigmoid(coOccurrence.detach()) >= 0.5).cpu().numpy()
+    target = (target.detach() > 0).cpu()
 
-    meter['accuracy'].update(np.sum(coOccurrence == target), target.shape[0] * target.shape[1])
-    meter['precision'].update(np.sum((coOccurrence == 1).astype(np.float) * (target == 1).astype(np.float)), np.sum(coOccurrence == 1))
-    meter['recall'].update(np.sum((coOccurrence == 1).astype(np.float) * (target == 1).astype(np.float)), np.sum(target == 1))
+    # Outer product of the labels, read at the pairs i < j
+    triuMask = getTriuMask(target.size(1))
+    target1 = target[:, :, None].expand(-1, -1, target.size(1))[:, triuMask].numpy()
+    target2 = target[:, None, :].expand(-1, target.size(1), -1)[:, triuMask].numpy()
+    target = target1 & target2
 
     totalNum = 1.0 * coOccurrence.shape[0] * coOccurrence.shape[1]
 
+    meter['accuracy'].update(np.sum(coOccurrence == target), totalNum)
+    meter['precision'].update(np.sum(coOccurrence & target), np.sum(coOccurrence))
+    meter['recall'].update(np.sum(coOccurrence & target), np.sum(target))
+
     # Confuse Matrix
-    meter['TP'].update(np.sum((coOccurrence == 1) * (target == 1)), totalNum)
-    meter['TN'].update(np.sum((coOccurrence == 0) * (target == 0)), totalNum)
-    meter['FP'].update(np.sum((coOccurrence == 1) * (target == 0)), totalNum)
-    meter['FN'].update(np.sum((coOccurrence == 0) * (target == 1)), totalNum)
+    meter['TP'].update(np.sum(coOccurrence & target), totalNum)
+    meter['TN'].update(np.sum(~coOccurrence & ~target), totalNum)
+    meter['FP'].update(np.sum(coOccurrence & ~target), totalNum)
+    meter['FN'].update(np.sum(~coOccurrence & target), totalNum)
 
     # Log FP
-    meter['FP_oneExist'].update((np.sum((coOccurrence == 1) * (target1 == 1) * (target2 == 0)) + np.sum((coOccurrence == 1) * (target1 == 0) * (target2 == 1))), totalNum)
-    meter['FP_noneExist'].update(np.sum((coOccurrence == 1) * (target1 == 0) * (target2 == 0)), totalNum)
+    meter['FP_oneExist'].update(np.sum(coOccurrence & (target1 != target2)), totalNum)
+    meter['FP_noneExist'].update(np.sum(coOccurrence & ~target1 & ~target2), totalNum)
 
 
 def compute_inter_feature_distance(meter, feature, target):
@@ -369,28 +845,23 @@ def compute_inter_feature_distance(meter, feature, target):
     Shape of target : (BatchSize, classNum)
     """
 
-    concatIndex = getConcatIndex(target.size(0))
-
-    target_ = target.detach().clone()
-    target_[target_ != 1] = 0
-    pos2posTarget = target_[concatIndex[0]] * target_[concatIndex[1]]
+    # (classNum, BatchSize, BatchSize) cosine similarity of every sample pair, per class
+    feature = torch.nn.functional.normalize(feature.detach(), dim=2, eps=1e-9).transpose(0, 1)
+    distance = torch.bmm(feature, feature.transpose(1, 2))
 
-    target_ = -1 * target.detach().clone()
-    target_[target_ != 1] = 0
-    neg2negTarget = target_[concatIndex[0]] * target_[concatIndex[1]]
+    triuMask = getTriuMask(target.size(0), feature.device)
+    pos, neg = (target.detach() == 1).t(), (target.detach() == -1).t()
 
-    pos2negTarget = 1 - pos2posTarget
-    pos2negTarget[(target[concatIndex[0]] == 0) | (target[concatIndex[1]] == 0)] = 0
-    pos2negTarget[(target[concatIndex[0]] == -1) & (target[concatIndex[1]] == -1)] = 0
-
-    distance = torch.nn.CosineSimilarity(dim=2, eps=1e-9)(feature[concatIndex[0]], feature[concatIndex[1]])
+    pos2posTarget = pos[:, :, None] & pos[:, None, :] & triuMask
+    neg2negTarget = neg[:, :, None] & neg[:, None, :] & triuMask
+    pos2negTarget = ((pos[:, :, None] & neg[:, None, :]) | (neg[:, :, None] & pos[:, None, :])) & triuMask
 
     if torch.sum(pos2posTarget) > 0:
-        meter['pos2pos'].update(torch.mean(distance[pos2posTarget == 1]).item())
+        meter['pos2pos'].update(torch.mean(distance[pos2posTarget]).item())
     if torch.sum(pos2negTarget) > 0:
-        meter['pos2neg'].update(torch.mean(distance[pos2negTarget == 1]).item())
+        meter['pos2neg'].update(torch.mean(distance[pos2negTarget]).item())
     if torch.sum(neg2negTarget) > 0:
-        meter['neg2neg'].update(torch.mean(distance[neg2negTarget == 1]).item())
+        meter['neg2neg'].update(torch.mean(distance[neg2negTarget]).item())
 
 def compute_confidence_cruve_backup(logits, labels, bins=15):
     logits = torch.sigmoid(logits)
@@ -434,104 +905,15 @@ def compute_confidence_cruve_backup(logits, labels, bins=15):
     plt.tight_layout()
     plt.savefig('confidence.jpg')
 
-def compute_confidence_cruve(logits, labels, bins=15):
+def compute_confidence_cruve(logits, labels, bins=15, class_names=None, output_dir='output_pic', single_figure=False):
     """
-    logits: (batch, 80)
-    labels: (batch, 80)
+    logits: (batch, classNum)
+    labels: (batch, classNum)
+    class_names (list): names in label order, e.g. `utils.reliability.get_class_names(dataset)`
     """
-    logits = torch.sigmoid(logits)
-    class_name = {
-        0 : 'person',
-        1 : 'bicycle',
-        2 : 'car',
-        3 : 'motorcycle',
-        4 : 'airplane',
-        5 : 'bus',
-        6 : 'train',
-        7 : 'truck',
-        8 : 'boat',
-        9 : 'traffic light',
-        10 : 'fire hydrant',
-        11 : 'stop sign',
-        12 : 'parking meter',
-        13 : 'bench',
-        14 : 'bird',
-        15 : 'cat',
-        16 : 'dog',
-        17 : 'horse',
-        18 : 'sheep',
-        19 : 'cow',
-        20 : 'elephant',
-        21 : 'bear',
-        22 : 'zebra',
-        23 : 'giraffe',
-        24 : 'backpack',
-        25 : 'umbrella',
-        26 : 'handbag',
-        27 : 'tie',
-        28 : 'suitcase',
-        29 : 'frisbee',
-        30 : 'skis',
-        31 : 'snowboard',
-        32 : 'sports ball',
-        33 : 'kite',
-        34 : 'baseball bat',
-        35 : 'baseball glove',
-        36 : 'skateboard',
-        37 : 'surfboard',
-        38 : 'tennis racket',
-        39 : 'bottle',
-        40 : 'wine glass',
-        41 : 'cup',
-        42 : 'fork',
-        43 : 'knife',
-        44 : 'spoon',
-        45 : 'bowl',
-        46 : 'banana',
-        47 : 'apple',
-        48 : 'sandwich',
-        49 : 'orange',
-        50 : 'broccoli',
-        51 : 'carrot',
-        52 : 'hot dog',
-    }
-
-    for classId in range(0, 53):
-        classwise_logits = logits[:,classId]
-        classwise_labels = labels[:,classId]
-        confidence = np.linspace(0, 1, 15)
-        accuracy = []
-        bin_boundaries = torch.linspace(0, 1, bins + 1)
-        bin_lowers = bin_boundaries[:-1]
-        bin_uppers = bin_boundaries[1:]
-
-        for bin_lower, bin_upper in zip(bin_lowers, bin_uppers):
-            in_bin = classwise_logits.gt(bin_lower.item()) * classwise_logits.le(bin_upper.item())
-            prop_in_bin = in_bin.float().mean()
-
-            if prop_in_bin.item() > 0.0:
-                labels_in_bin = classwise_labels[in_bin]
-                accuracy_in_bin = labels_in_bin.float().sum() / len(labels_in_bin)
-                accuracy.append(accuracy_in_bin.item())
-            else:
-                accuracy.append(0)
-        
-        fig, ax = plt.subplots(figsize=(5, 5))
-        width = 1.0 / (len(confidence) - 1)
-        ax.bar(confidence, accuracy, width=width, label='Outputs', color='#B2DFDB', edgecolor='black', align='center')
-        ax.plot([-0.05, 1.05], [0, 1], color="#000000", linestyle="--")
-        ax.set_title(f'Class: {class_name[classId]}')
-        ax.set_xlabel('Confidence')
-        ax.set_ylabel('Accuracy')
-        ax.set_xticks([0.0, 0.5, 1.0])
-        ax.set_yticks(np.arange(0, 1.1, 0.1))
-        ax.grid(True, which='both', linestyle='--', linewidth=0.5, color='#BDBDBD')
-        ax.spines['right'].set_visible(False)
-        ax.spines['top'].set_visible(False)
-        ax.margins(0)
-
-        plt.tight_layout()
-        plt.savefig(f'output_pic/confidence_{class_name[classId]}.jpg')
+    from utils.reliability import plot_reliability_diagrams
+
+    return plot_reliability_diagrams(logits, labels, class_names, output_dir, bins, single_figure)
 
 def compute_ace_multi(logits, labels, bins=15):
     """
@@ -540,130 +922,282 @@ def compute_ace_multi(logits, labels, bins=15):
     """
     sorted_logits = logits.flatten().sort()
 
-    logits_ = sorted_logits.values
-    labels_ = labels.flatten()[sorted_logits.indices]
+    logits_ = sorted_logits.values.unsqueeze(1)
+    labels_ = labels.flatten()[sorted_logits.indices].unsqueeze(1)
+
+    return compute_classwise_ace_sorted(logits_, labels_, bins).item()
 
-    count = logits_.size()[0]
-    bin_size = int(count / bins)
+def compute_classwise_ace_multi(logits, labels, bins=15):
+    """
+    softmax: (batch, 80)
+    label: (batch, 80)
+    """
 
-    logits_ = logits_.split(bin_size)
-    labels_ = labels_.split(bin_size)
+    sorted_logits = logits.sort(dim=0)
 
-    ace = torch.zeros(1)
+    return compute_classwise_ace_sorted(sorted_logits.values, labels.gather(0, sorted_logits.indices), bins)
 
-    for labels_in_bin, confidence_in_bin in zip(labels_, logits_):
-        accuracy_in_bin = (torch.abs(confidence_in_bin - labels_in_bin) <= 0.5).float().mean()
-        confidence_in_bin[confidence_in_bin < 0.5] = 1 - confidence_in_bin[confidence_in_bin < 0.5]
-        avg_confidence_in_bin = confidence_in_bin.mean()
+def compute_classwise_ace_sorted(logits, labels, bins=15, reduce=True):
+    """
+    Same as `compute_classwise_ace_multi` for probabilities that are already
+    sorted ascending within every column, all classes are binned at once.
+    softmax: (batch, 80), sorted along batch
+    label: (batch, 80), in the same order
+    reduce: mean over classes, otherwise the ACE of every class
+    """
 
-        ace += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * labels_in_bin.size()[0] / count
+    count = logits.size(0)
+    bin_size = max(int(count / bins), 1)
+    binNum = math.ceil(count / bin_size)
 
-    return ace.item()
+    # Equal-mass bins follow the position in the ranking, the last one may be smaller
+    binIndex = torch.arange(count, device=logits.device) // bin_size
+    binCount = torch.bincount(binIndex, minlength=binNum).double().unsqueeze(1)
 
-def compute_classwise_ace_multi(logits, labels, bins=15):
+    accuracy = (torch.abs(logits - labels) <= 0.5).double()
+    confidence = torch.where(logits < 0.5, 1 - logits, logits).double()
+
+    accuracy_in_bin = torch.zeros(binNum, logits.size(1), dtype=torch.float64, device=logits.device).index_add_(0, binIndex, accuracy) / binCount
+    confidence_in_bin = torch.zeros(binNum, logits.size(1), dtype=torch.float64, device=logits.device).index_add_(0, binIndex, confidence) / binCount
+
+    classwise_ace = torch.sum(torch.abs(confidence_in_bin - accuracy_in_bin) * binCount / count, dim=0).float()
+
+    return torch.mean(classwise_ace) if reduce else classwise_ace
+
+def compute_classwise_ece_multi(logits, labels, bins=15):
     """
     softmax: (batch, 80)
     label: (batch, 80)
     """
 
-    classwise_ace = []
-    for i in range(logits.shape[1]):
+    statistics = compute_calibration_statistics(logits, labels, bins)
+    return torch.mean(calibration_errors_from_statistics(statistics)['classwise_ECE']).item()
 
-        classwise_logits = logits[:,i]
-        classwise_labels = labels[:,i]
+def compute_classwise_mce_multi(logits, labels, bins=15):
+    """
+    softmax: (batch, 80)
+    label: (batch, 80)
+    """
 
-        sorted_logits = classwise_logits.flatten().sort()
+    statistics = compute_calibration_statistics(logits, labels, bins)
+    return torch.mean(calibration_errors_from_statistics(statistics)['classwise_MCE']).item()
 
-        logits_ = sorted_logits.values
-        labels_ = classwise_labels.flatten()[sorted_logits.indices]
+def compute_calibration_statistics(probs, labels, bins=15, chunk_size=4096):
+    """
+    Per-(class, bin) sufficient statistics of the calibration metrics, every
+    prediction is assigned to its bins with `torch.bucketize` and each sum is
+    accumulated with one `bincount` over the shared slot index, in chunks of
+    `chunk_size` samples so that the float64 copies stay O(chunk_size * classNum).
+    probs: (batch, classNum), probabilities
+    labels: (batch, classNum), 1 for positive and 0 for negative
+
+    Two binning conventions are kept side by side:
+        count / conf / acc (classNum, bins + 1): the torchmetrics
+            `BinaryCalibrationError` bins [lower, upper) on the probability and
+            the label frequency, the extra last bin holds probability 1.
+        top_count / top_conf / top_acc (classNum, bins): the class-wise bins
+            (lower, upper] on the probability p, accumulating the confidence
+            max(p, 1 - p) and the correctness of the predicted label.
+        num (classNum,): number of predictions of every class.
+    """
 
-        count = logits_.size()[0]
-        bin_size = int(count / bins)
+    batchSize, classNum = probs.shape
+    device = probs.device
 
-        logits_ = logits_.split(bin_size)
-        labels_ = labels_.split(bin_size)
+    # Float32 edges as torchmetrics and the class-wise loops, so predictions on an edge fall into the same bin
+    bin_boundaries = torch.linspace(0, 1, bins + 1, device=device).double()
+    slotNum = 2 * (bins + 1)
+    size = classNum * slotNum
+    offset = torch.arange(classNum, device=device) * slotNum
 
-        ace = torch.zeros(1)
+    count, conf, acc = [torch.zeros(size, dtype=torch.float64, device=device) for _ in range(3)]
+    for start in range(0, batchSize, chunk_size):
+        chunkProbs = probs[start:start + chunk_size].double().contiguous()
+        chunkLabels = labels[start:start + chunk_size].to(device).double()
 
-        for labels_in_bin, confidence_in_bin in zip(labels_, logits_):
-            accuracy_in_bin = (torch.abs(confidence_in_bin - labels_in_bin) <= 0.5).float().mean()
-            confidence_in_bin[confidence_in_bin < 0.5] = 1 - confidence_in_bin[confidence_in_bin < 0.5]
-            avg_confidence_in_bin = confidence_in_bin.mean()
+        # Slots [0, bins] of a class follow torchmetrics, slots [bins + 1, 2 * bins + 1] the class-wise bins,
+        # probability 0 has no class-wise bin and falls into the unused last slot
+        index = (torch.bucketize(chunkProbs, bin_boundaries, right=True) - 1 + offset).flatten()
+        top_index = torch.bucketize(chunkProbs, bin_boundaries, right=False) - 1
+        top_index = (top_index.masked_fill(top_index < 0, bins) + bins + 1 + offset).flatten()
 
-            ace += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * labels_in_bin.size()[0] / count
-        
-        classwise_ace.append(ace.item())
+        top_acc = (torch.abs(chunkProbs - chunkLabels) <= 0.5).double()
+        top_conf = torch.where(chunkProbs < 0.5, 1 - chunkProbs, chunkProbs)
 
-    return torch.mean(torch.tensor(classwise_ace))
+        count += torch.bincount(index, minlength=size) + torch.bincount(top_index, minlength=size)
+        conf += torch.bincount(index, weights=chunkProbs.flatten(), minlength=size) + torch.bincount(top_index, weights=top_conf.flatten(), minlength=size)
+        acc += torch.bincount(index, weights=chunkLabels.flatten(), minlength=size) + torch.bincount(top_index, weights=top_acc.flatten(), minlength=size)
 
-def compute_classwise_ece_multi(logits, labels, bins=15):
+    count, conf, acc = count.view(classNum, slotNum), conf.view(classNum, slotNum), acc.view(classNum, slotNum)
+
+    return {'count': count[:, :bins + 1], 'conf': conf[:, :bins + 1], 'acc': acc[:, :bins + 1],
+            'top_count': count[:, bins + 1:-1], 'top_conf': conf[:, bins + 1:-1], 'top_acc': acc[:, bins + 1:-1],
+            'num': torch.full((classNum,), float(batchSize), dtype=torch.float64, device=device)}
+
+def calibration_errors_from_statistics(statistics):
     """
-    softmax: (batch, 80)
-    label: (batch, 80)
+    ECE, MCE over all predictions and the per-class ECE, MCE from the
+    statistics of `compute_calibration_statistics`.
     """
-    bin_boundaries = torch.linspace(0, 1, bins + 1)
-    bin_lowers = bin_boundaries[:-1]
-    bin_uppers = bin_boundaries[1:]
 
-    classwise_ece = []
-    for i in range(logits.shape[1]):
-        classwise_logits = logits[:,i]
-        classwise_labels = labels[:,i]
+    # Over all predictions, the classes share the same bins
+    count, conf, acc = statistics['count'].sum(0), statistics['conf'].sum(0), statistics['acc'].sum(0)
+    gap = torch.abs(torch.nan_to_num(acc / count) - torch.nan_to_num(conf / count))
+
+    ece = torch.sum(gap * count / count.sum())
+    mce = torch.max(gap)
 
-        ece = torch.zeros(1)
+    # Per class, empty bins are skipped
+    count, conf, acc = statistics['top_count'], statistics['top_conf'], statistics['top_acc']
+    gap = torch.where(count > 0, (conf - acc) / count.clamp(min=1), torch.zeros_like(count))
 
-        for bin_lower, bin_upper in zip(bin_lowers, bin_uppers):
-            # 取大于lower小于upper的
-            in_bin = classwise_logits.gt(bin_lower.item()) * classwise_logits.le(bin_upper.item())
-            prop_in_bin = in_bin.float().mean()
+    classwise_ece = torch.sum(torch.abs(gap) * count, dim=1) / statistics['num']
+    classwise_mce = torch.max(gap, dim=1)[0].clamp(min=0)
 
-            if prop_in_bin.item() > 0.0:
-                labels_in_bin = classwise_labels[in_bin]
-                confidence_in_bin = classwise_logits[in_bin]
-                accuracy_in_bin = (torch.abs(confidence_in_bin - labels_in_bin) <= 0.5).float().mean()
+    return {'ECE': ece, 'MCE': mce, 'classwise_ECE': classwise_ece, 'classwise_MCE': classwise_mce}
 
-                # 置信度小于0.5说明预测为neg样本，求对neg样本的置信度（neg置信度 = 1 - pos置信度）
-                confidence_in_bin[confidence_in_bin < 0.5] = 1 - confidence_in_bin[confidence_in_bin < 0.5]
-                avg_confidence_in_bin = confidence_in_bin.mean()
+def compute_calibration_metrics(logits, labels, bins=15, device=None):
+    """
+    Every calibration metric of `Validate` in one pass: ACE, ECE, MCE over all
+    predictions and the class-wise ACE, ECE, MCE with their means (mACE, mECE,
+    mMCE). Logits are turned into probabilities unless they already are.
+    logits: (batch, classNum)
+    labels: (batch, classNum), values > 0 are positive
+    device: where to compute, defaults to the device of the logits
+    """
 
-                ece += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
-        
-        classwise_ece.append(ece.item())
+    if device is not None:
+        logits, labels = logits.to(device), labels.to(device)
 
-    return torch.mean(torch.tensor(classwise_ece)).item()
+    probs = torch.sigmoid(logits) if logits.max() >= 1 or logits.min() <= 0 else logits
+    labels = (labels > 0).to(probs.dtype)
 
-def compute_classwise_mce_multi(logits, labels, bins=15):
+    res = calibration_errors_from_statistics(compute_calibration_statistics(probs, labels, bins))
+
+    sorted_probs = probs.sort(dim=0)
+    res['classwise_ACE'] = compute_classwise_ace_sorted(sorted_probs.values, labels.gather(0, sorted_probs.indices), bins, reduce=False)
+    res['ACE'] = compute_ace_multi(probs, labels, bins)
+
+    res['ECE'], res['MCE'] = res['ECE'].item(), res['MCE'].item()
+    res['mACE'], res['mECE'], res['mMCE'] = [torch.mean(res[key]).item() for key in ('classwise_ACE', 'classwise_ECE', 'classwise_MCE')]
+
+    return res
+
+def compute_cooccurrence_calibration(logits, labels, bins=15, min_count=1, chunk_size=4096):
     """
-    softmax: (batch, 80)
-    label: (batch, 80)
+    Calibration of class j conditioned on the presence of class i, for all
+    (i, j) label pairs. pair_ECE[i, j] is the torchmetrics ECE (as in
+    `compute_calibration_error`) of the class j predictions over the samples
+    where class i is positive.
+    Pair counts come from one matmul of the targets, the per-(i, j, bin)
+    sums from one bincount over (positive class i, class j, bin of p_j) of
+    every sample, in chunks of `chunk_size` samples.
+    logits: (batch, classNum), logits or probabilities
+    labels: (batch, classNum), values > 0 are positive
+    min_count (int): pairs whose conditioning class has fewer positives are nan
+
+    Return:
+        res (dict): 'pair_ECE' (classNum, classNum), 'cooccurrence'
+            (classNum, classNum) the number of samples with both classes, and
+            'mean', the mean pair_ECE over the valid pairs with i != j
     """
-    bin_boundaries = torch.linspace(0, 1, bins + 1)
-    bin_lowers = bin_boundaries[:-1]
-    bin_uppers = bin_boundaries[1:]
-    
-    classwise_mce = []
-    for i in range(logits.shape[1]):
-        classwise_logits = logits[:,i]
-        classwise_labels = labels[:,i]
 
-        mce = torch.zeros(1)
+    probs = torch.sigmoid(logits) if logits.max() >= 1 or logits.min() <= 0 else logits
+    probs, labels = probs.detach().double(), (labels.detach() > 0).to(probs.device)
+    classNum = probs.size(1)
+    slots = bins + 1
+
+    # Bin i holds [b_i, b_{i+1}), the extra last bin holds probability 1
+    bin_boundaries = torch.linspace(0, 1, bins + 1, dtype=torch.float64, device=probs.device)
+    binIndex = torch.bucketize(probs, bin_boundaries, right=True) - 1
+
+    cooccurrence = torch.matmul(labels.double().t(), labels.double())
 
-        for bin_lower, bin_upper in zip(bin_lowers, bin_uppers):
-            # 取大于lower小于upper的
-            in_bin = classwise_logits.gt(bin_lower.item()) * classwise_logits.le(bin_upper.item())
-            prop_in_bin = in_bin.float().mean()
+    count, conf, acc = [torch.zeros(classNum * classNum * slots, dtype=torch.float64, device=probs.device) for _ in range(3)]
+    classOffset = torch.arange(classNum, device=probs.device) * slots
+    for start in range(0, probs.size(0), chunk_size):
+        chunkLabels = labels[start:start + chunk_size]
+        sampleIndex, conditionIndex = torch.nonzero(chunkLabels, as_tuple=True)
+        sampleIndex = sampleIndex + start
 
-            if prop_in_bin.item() > 0.0:
-                labels_in_bin = classwise_labels[in_bin]
-                confidence_in_bin = classwise_logits[in_bin]
-                accuracy_in_bin = (torch.abs(confidence_in_bin - labels_in_bin) <= 0.5).float().mean()
+        # (positives, classNum) flat index of (i, j, bin of p_j)
+        index = (conditionIndex[:, None] * classNum * slots + classOffset[None, :] + binIndex[sampleIndex]).flatten()
+        count += torch.bincount(index, minlength=count.numel()).double()
+        conf += torch.bincount(index, weights=probs[sampleIndex].flatten(), minlength=conf.numel())
+        acc += torch.bincount(index, weights=labels[sampleIndex].double().flatten(), minlength=acc.numel())
 
-                # 置信度小于0.5说明预测为neg样本，求对neg样本的置信度（neg置信度 = 1 - pos置信度）
-                confidence_in_bin[confidence_in_bin < 0.5] = 1 - confidence_in_bin[confidence_in_bin < 0.5]
-                avg_confidence_in_bin = confidence_in_bin.mean()
+    count, conf, acc = [value.view(classNum, classNum, slots) for value in (count, conf, acc)]
+    gap = torch.abs(torch.nan_to_num(acc / count) - torch.nan_to_num(conf / count))
 
-                mce = torch.max(avg_confidence_in_bin - accuracy_in_bin, mce)
-        
-        classwise_mce.append(mce.item())
+    support = torch.diagonal(cooccurrence)
+    pair_ECE = torch.sum(gap * count, dim=2) / support[:, None]
+    pair_ECE[support < max(min_count, 1)] = float('nan')
+
+    offDiagonal = pair_ECE[~torch.eye(classNum, dtype=torch.bool, device=probs.device)]
+    return {'pair_ECE': pair_ECE, 'cooccurrence': cooccurrence, 'mean': torch.nanmean(offDiagonal).item()}
+
+def compute_calibration_sweep(logits, labels, bin_counts=(10, 15, 20, 50, 100), schemes=('width', 'mass')):
+    """
+    Calibration errors for many bin counts and both binning schemes from one
+    sort of all predictions, O(N log N + sum(bin_counts)).
+    logits: (batch, classNum), logits or probabilities
+    labels: (batch, classNum), values > 0 are positive
+
+    'width' rows follow `compute_calibration_error` (torchmetrics equal-width
+    bins on the probability against the label frequency) and give ECE / MCE.
+    'mass' rows follow `compute_ace_multi` (equal-mass bins on the confidence
+    of the predicted label against its correctness) and give ACE / MCE.
+
+    Return:
+        table (list): one dict per (scheme, bins), with keys
+            'scheme', 'bins', 'metric' ('ECE' or 'ACE'), 'CE' and 'MCE'
+    """
 
-    return torch.mean(torch.tensor(classwise_mce)).item()
\ No newline at end of file
+    probs = torch.sigmoid(logits) if logits.max() >= 1 or logits.min() <= 0 else logits
+    sorted_probs = probs.flatten().sort()
+
+    confidence = sorted_probs.values.double()
+    labels = (labels.flatten()[sorted_probs.indices] > 0).double()
+    count = confidence.numel()
+
+    def prefix(values):
+        return torch.cat((torch.zeros(1, dtype=torch.float64, device=values.device), torch.cumsum(values, dim=0)))
+
+    def bin_errors(edges, conf_prefix, acc_prefix):
+        binCount = (edges[1:] - edges[:-1]).double()
+        conf_in_bin = torch.nan_to_num((conf_prefix[edges[1:]] - conf_prefix[edges[:-1]]) / binCount)
+        acc_in_bin = torch.nan_to_num((acc_prefix[edges[1:]] - acc_prefix[edges[:-1]]) / binCount)
+        gap = torch.abs(conf_in_bin - acc_in_bin)
+        return torch.sum(gap * binCount / count).item(), torch.max(gap).item()
+
+    table = []
+
+    if 'width' in schemes:
+        conf_prefix, acc_prefix = prefix(confidence), prefix(labels)
+        for bins in bin_counts:
+            # Bin i holds [b_i, b_{i+1}), the extra last bin holds probability 1
+            boundaries = torch.linspace(0, 1, bins + 1, dtype=torch.float64, device=confidence.device)
+            edges = torch.searchsorted(confidence, boundaries, right=False)
+            edges = torch.cat((edges, torch.tensor([count], device=edges.device)))
+            ece, mce = bin_errors(edges, conf_prefix, acc_prefix)
+            table.append({'scheme': 'width', 'bins': bins, 'metric': 'ECE', 'CE': ece, 'MCE': mce})
+
+    if 'mass' in schemes:
+        top_conf = torch.where(confidence < 0.5, 1 - confidence, confidence)
+        top_acc = (torch.abs(confidence - labels) <= 0.5).double()
+        conf_prefix, acc_prefix = prefix(top_conf), prefix(top_acc)
+        for bins in bin_counts:
+            # Same split as compute_ace_multi, the last bin may be smaller
+            bin_size = max(int(count / bins), 1)
+            edges = torch.cat((torch.arange(0, count, bin_size, device=confidence.device), torch.tensor([count], device=confidence.device)))
+            ace, mce = bin_errors(edges, conf_prefix, acc_prefix)
+            table.append({'scheme': 'mass', 'bins': bins, 'metric': 'ACE', 'CE': ace, 'MCE': mce})
+
+    return table
+
+def log_calibration_sweep(writer, table, epoch):
+    """Write a `compute_calibration_sweep` table to a tensorboardX SummaryWriter"""
+
+    for row in table:
+        writer.add_scalar(f"Calibration/{row['metric']}_{row['bins']}", row['CE'], epoch)
+        writer.add_scalar(f"Calibration/MCE_{row['scheme']}_{row['bins']}", row['MCE'], epoch)
@@ -0,0 +1,134 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import torch
+from matplotlib.figure import Figure
+
+def get_class_names(dataset):
+    """
+    Class names in label order, from the dataset's category map.
+    COCO: names of `dataset.coco` placed by `dataset.category_map`
+    (COCO category id -> 1-based label index). Datasets without names
+    fall back to the label index.
+    """
+
+    # torch.utils.data.Subset and similar wrappers
+    while not hasattr(dataset, 'labels') and hasattr(dataset, 'dataset'):
+        dataset = dataset.dataset
+
+    classNum = np.asarray(dataset.labels).shape[1]
+    class_names = [str(classId) for classId in range(classNum)]
+
+    if hasattr(dataset, 'coco') and hasattr(dataset, 'category_map'):
+        for category in dataset.coco.loadCats(dataset.coco.getCatIds()):
+            if str(category['id']) in dataset.category_map:
+                class_names[dataset.category_map[str(category['id'])] - 1] = category['name']
+
+    return class_names
+
+def compute_reliability_statistics(logits, labels, bins=15):
+    """
+    Per-class reliability statistics of all classes in one pass.
+    Bins are (lower, upper] as in `compute_confidence_cruve_backup`, a
+    probability of exactly zero falls in no bin.
+    logits: (batch, classNum)
+    labels: (batch, classNum), values > 0 are positive
+
+    Return:
+        res (dict): numpy arrays 'count', 'confidence', 'accuracy' of shape
+            (classNum, bins), mean confidence and accuracy are 0 in empty
+            bins, and 'bin_boundaries' (bins+1,)
+    """
+
+    probs = torch.sigmoid(logits.detach().float()).t().contiguous().cpu().double()
+    labels = (labels.detach().t().contiguous().cpu() > 0).double()
+    classNum = probs.size(0)
+
+    # bucketize(right=False) gives lower < p <= upper, slot 0 collects p == 0
+    bin_boundaries = torch.linspace(0, 1, bins + 1, dtype=torch.float64)
+    binIndex = torch.bucketize(probs, bin_boundaries)
+
+    statistics = torch.zeros(3, classNum, bins + 1, dtype=torch.float64)
+    for i, src in enumerate((torch.ones_like(probs), probs, labels)):
+        statistics[i].scatter_add_(1, binIndex, src)
+    count, confidence, accuracy = statistics[:, :, 1:]
+
+    return {'count': count.numpy(),
+            'confidence': torch.nan_to_num(confidence / count).numpy(),
+            'accuracy': torch.nan_to_num(accuracy / count).numpy(),
+            'bin_boundaries': bin_boundaries.numpy()}
+
+def plot_reliability_diagrams(logits, labels, class_names=None, output_dir='output_pic', bins=15,
+                              single_figure=False, workers=None, classIds=None):
+    """
+    Reliability diagrams of every class.
+    Statistics come from `compute_reliability_statistics`, figures are drawn
+    with the non-interactive Agg canvas, one file per class in a process pool
+    ({output_dir}/confidence_{name}.jpg), or all classes as panels of a
+    single figure ({output_dir}/confidence_all.jpg).
+    class_names (list): names in label order, see `get_class_names`
+    classIds (list): classes to draw, all by default
+
+    Return:
+        paths (list): saved figures
+    """
+
+    statistics = compute_reliability_statistics(logits, labels, bins)
+    classNum = statistics['count'].shape[0]
+
+    class_names = class_names if class_names is not None else [str(classId) for classId in range(classNum)]
+    classIds = classIds if classIds is not None else range(classNum)
+
+    os.makedirs(output_dir, exist_ok=True)
+    bin_boundaries = statistics['bin_boundaries']
+    panels = [(class_names[classId], statistics['accuracy'][classId], bin_boundaries) for classId in classIds]
+
+    if single_figure:
+        path = os.path.join(output_dir, 'confidence_all.jpg')
+        _plot_panels(panels, path)
+        return [path]
+
+    tasks = [panel + (os.path.join(output_dir, 'confidence_{}.jpg'.format(panel[0].replace('/', '_'))),) for panel in panels]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_plot_class, tasks, chunksize=max(1, len(tasks) // (4 * (workers or os.cpu_count() or 1)))))
+
+def _draw_reliability(ax, name, accuracy, bin_boundaries):
+
+    centers = (bin_boundaries[:-1] + bin_boundaries[1:]) / 2
+    ax.bar(centers, accuracy, width=bin_boundaries[1] - bin_boundaries[0], label='Outputs', color='#B2DFDB', edgecolor='black', align='center')
+    ax.plot([0, 1], [0, 1], color="#000000", linestyle="--")
+    ax.set_title(f'Class: {name}')
+    ax.set_xlabel('Confidence')
+    ax.set_ylabel('Accuracy')
+    ax.set_xticks([0.0, 0.5, 1.0])
+    ax.set_yticks(np.arange(0, 1.1, 0.1))
+    ax.grid(True, which='both', linestyle='--', linewidth=0.5, color='#BDBDBD')
+    ax.spines['right'].set_visible(False)
+    ax.spines['top'].set_visible(False)
+    ax.margins(0)
+
+def _plot_class(task):
+
+    name, accuracy, bin_boundaries, path = task
+
+    fig = Figure(figsize=(5, 5))
+    _draw_reliability(fig.add_subplot(), name, accuracy, bin_boundaries)
+    fig.tight_layout()
+    fig.savefig(path)
+
+    return path
+
+def _plot_panels(panels, path, ncols=10):
+
+    nrows = (len(panels) + ncols - 1) // ncols
+
+    fig = Figure(figsize=(3 * ncols, 3 * nrows))
+    axes = fig.subplots(nrows, ncols, squeeze=False).flatten()
+    for ax, panel in zip(axes, panels):
+        _draw_reliability(ax, *panel)
+    for ax in axes[len(panels):]:
+        ax.set_visible(False)
+    fig.tight_layout()
+    fig.savefig(path)
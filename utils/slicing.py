@@ -0,0 +1,155 @@
+import numpy as np
+
+import torch
+
+def cardinality_groups(targets, edges=(1, 2, 4)):
+    """
+    Row group of every image by its number of positive labels, with the
+    default edges: 0 -> '1', 1 -> '2-3', 2 -> '4+', images without positive
+    label get -1 and only appear in the 'all' slice.
+
+    Return:
+        groups (LongTensor): (batch,)
+        names (list): name of every group
+    """
+
+    if not torch.is_tensor(targets):
+        targets = torch.from_numpy(np.asarray(targets))
+
+    positiveNum = (targets > 0).sum(1)
+    groups = torch.bucketize(positiveNum, torch.tensor(edges[1:]), right=True)
+    groups[positiveNum < edges[0]] = -1
+
+    names = ['{}-{}'.format(lower, upper - 1) if upper - 1 > lower else str(lower) for lower, upper in zip(edges[:-1], edges[1:])]
+    return groups, names + ['{}+'.format(edges[-1])]
+
+def frequency_groups(class_counts, names=('head', 'medium', 'tail')):
+    """
+    Column group of every class by its training label count, classes sorted
+    by decreasing count are split into len(names) parts of (almost) equal size.
+
+    Return:
+        groups (LongTensor): (classNum,)
+        names (list): name of every group
+    """
+
+    order = np.argsort(-np.asarray(class_counts), kind='stable')
+    groups = torch.empty(len(order), dtype=torch.long)
+    for groupId, classIds in enumerate(np.array_split(order, len(names))):
+        groups[torch.from_numpy(classIds)] = groupId
+
+    return groups, list(names)
+
+def class_counts_from_dataset(dataset):
+    """Number of positive labels of every class in a training dataset"""
+
+    while not hasattr(dataset, 'labels') and hasattr(dataset, 'dataset'):
+        dataset = dataset.dataset
+    return np.sum(np.asarray(dataset.labels) > 0, axis=0)
+
+def compute_sliced_metrics(scores, targets, row_groups, row_names, col_groups, col_names, bins=15):
+    """
+    mAP (VOC2012), ECE and MCE (as in `compute_calibration_error`) of every
+    (row slice, column slice), 'all' included on both sides, in one pass:
+        AP: one sort per class over all images, the AP of a row group is
+            read from cumulative sums weighted by group membership.
+        ECE / MCE: one bincount over (row group, class, bin), summed over
+            the classes of every column group.
+    scores: (batch, classNum), logits or probabilities
+    targets: (batch, classNum), values > 0 are positive
+    row_groups: (batch,) group id of every image, -1 for none
+    col_groups: (classNum,) group id of every class, -1 for none
+
+    Return:
+        table (list): one dict per slice with keys 'rows', 'classes',
+            'images', 'classNum', 'positives', 'mAP', 'ECE', 'MCE'
+    """
+
+    if not torch.is_tensor(scores):
+        scores = torch.from_numpy(np.asarray(scores))
+    if not torch.is_tensor(targets):
+        targets = torch.from_numpy(np.asarray(targets))
+
+    scores, labels = scores.detach().float().cpu(), (targets.detach().cpu() > 0).float()
+    row_groups, col_groups = torch.as_tensor(row_groups).long().cpu(), torch.as_tensor(col_groups).long().cpu()
+    sampleNum, classNum = scores.shape
+
+    # Group ids with 'all' appended as the last group on both sides
+    rowNum, colNum = len(row_names) + 1, len(col_names) + 1
+    rowMembership = torch.zeros(rowNum, sampleNum)
+    rowMembership[row_groups[row_groups >= 0], torch.nonzero(row_groups >= 0).flatten()] = 1
+    rowMembership[-1] = 1
+    colMembership = torch.zeros(colNum, classNum, dtype=torch.float64)
+    colMembership[col_groups[col_groups >= 0], torch.nonzero(col_groups >= 0).flatten()] = 1
+    colMembership[-1] = 1
+
+    APs = grouped_average_precision(scores, labels, rowMembership)
+
+    # mAP over the classes of every column group, classes without positive in the slice are left out
+    valid = ~torch.isnan(APs)
+    mAP = torch.matmul(torch.nan_to_num(APs), colMembership.t()) / torch.matmul(valid.double(), colMembership.t())
+
+    # Calibration statistics of every (row group, class, bin), bins as in compute_calibration_error
+    probs = torch.sigmoid(scores) if scores.max() >= 1 or scores.min() <= 0 else scores
+    binIndex = torch.bucketize(probs.double(), torch.linspace(0, 1, bins + 1, dtype=torch.float64), right=True) - 1
+
+    member = row_groups >= 0
+    index = torch.cat(((row_groups[member, None] * classNum + torch.arange(classNum)) * (bins + 1) + binIndex[member],
+                       ((rowNum - 1) * classNum + torch.arange(classNum)) * (bins + 1) + binIndex)).flatten()
+    size = rowNum * classNum * (bins + 1)
+    count = torch.bincount(index, minlength=size).double()
+    conf = torch.bincount(index, weights=torch.cat((probs[member], probs)).double().flatten(), minlength=size)
+    acc = torch.bincount(index, weights=torch.cat((labels[member], labels)).double().flatten(), minlength=size)
+
+    # Sum the classes of every column group, (rowNum, colNum, bins + 1)
+    count, conf, acc = [torch.einsum('rcb,kc->rkb', value.view(rowNum, classNum, bins + 1), colMembership) for value in (count, conf, acc)]
+    gap = torch.abs(torch.nan_to_num(acc / count) - torch.nan_to_num(conf / count))
+    ECE = torch.sum(gap * count, dim=2) / count.sum(2)
+    MCE = torch.max(gap, dim=2)[0]
+
+    imageNum, positiveNum = rowMembership.sum(1), torch.matmul(torch.matmul(rowMembership.double(), labels.double()), colMembership.t())
+    row_names, col_names = list(row_names) + ['all'], list(col_names) + ['all']
+
+    table = []
+    for r in range(rowNum):
+        for k in range(colNum):
+            table.append({'rows': row_names[r], 'classes': col_names[k],
+                          'images': int(imageNum[r]), 'classNum': int(colMembership[k].sum()), 'positives': int(positiveNum[r, k]),
+                          'mAP': mAP[r, k].item(), 'ECE': ECE[r, k].item(), 'MCE': MCE[r, k].item()})
+    return table
+
+def grouped_average_precision(scores, labels, membership, max_elements=2 ** 24):
+    """
+    VOC2012 AP of every (group, class) from one sort per class. Images out of
+    a group get weight zero in its cumulative sums, so they repeat the
+    previous precision and leave the envelope unchanged. Classes are
+    processed in chunks of at most `max_elements` (group, class, image) entries.
+    scores, labels: (batch, classNum)
+    membership: (groupNum, batch), 1 for the images of every group
+
+    Return:
+        APs (groupNum, classNum), nan where a group has no positive of a class
+    """
+
+    groupNum, sampleNum = membership.shape
+    chunk = max(1, max_elements // (groupNum * sampleNum))
+
+    APs = []
+    for classScores, classLabels in zip(scores.t().split(chunk), labels.t().split(chunk)):
+        # (groupNum, chunk, sampleNum) ranked by score
+        sortedIndex = torch.sort(classScores, dim=1, descending=True)[1]
+        weights = membership[:, sortedIndex]
+        hits = weights * classLabels.gather(1, sortedIndex)
+
+        TP, D = torch.cumsum(hits, dim=2), torch.cumsum(weights, dim=2)
+        envelope = torch.cummax((TP / D.clamp(min=1)).flip(2), dim=2)[0].flip(2)
+        APs.append(torch.sum(hits * envelope, dim=2) / TP[:, :, -1])
+
+    return torch.cat(APs, dim=1).double()
+
+def compute_default_slices(scores, targets, class_counts, bins=15):
+    """Slices by label cardinality (1, 2-3, 4+) and class frequency tercile (head, medium, tail)"""
+
+    row_groups, row_names = cardinality_groups(targets)
+    col_groups, col_names = frequency_groups(class_counts)
+    return compute_sliced_metrics(scores, targets, row_groups, row_names, col_groups, col_names, bins)
@@ -0,0 +1,92 @@
+import json
+
+import numpy as np
+
+from utils.metrics import evaluation
+
+def search_thresholds(scores, targets, target_precision=None):
+    """
+    Per-class decision thresholds from one sort of every class.
+    Precision and recall at every candidate threshold come from cumulative
+    sums over the ranked samples, a candidate sits at the end of every run of
+    tied scores and the threshold is placed halfway to the next lower score.
+    scores: (batch, classNum), numpy array or tensor
+    targets: (batch, classNum), 1 positive, 0 / -1 negative
+    target_precision (float): if given, the threshold with the highest recall
+        whose precision reaches it, instead of the one with the highest F1;
+        classes that never reach it (or without positives) predict nothing
+
+    Return:
+        res (dict): 'thresholds' (classNum,), class-wise 'precision', 'recall'
+            and 'F1' at the thresholds, and 'overall', the
+            (OP, OR, OF1, CP, CR, CF1) of `evaluation` with the thresholds
+    """
+
+    scores, targets = _to_numpy(scores).astype(np.float64), _to_numpy(targets)
+    targets = np.where(targets == -1, 0, targets) > 0
+    sampleNum, classNum = scores.shape
+
+    sortedIndex = np.argsort(-scores, axis=0, kind='stable')
+    sortedScores = np.take_along_axis(scores, sortedIndex, axis=0)
+    sortedLabels = np.take_along_axis(targets, sortedIndex, axis=0)
+
+    # Predicting the top i+1 samples of every class
+    TP = np.cumsum(sortedLabels, axis=0, dtype=np.float64)
+    Np = np.arange(1, sampleNum + 1, dtype=np.float64)[:, None]
+    Ng = TP[-1]
+
+    precision = TP / Np
+    recall = TP / np.maximum(Ng, 1)
+    F1 = 2 * TP / (Np + Ng)
+
+    # Only the last sample of tied scores can be a cut
+    valid = np.ones_like(sortedLabels)
+    valid[:-1] = sortedScores[:-1] != sortedScores[1:]
+
+    if target_precision is None:
+        valid &= Ng > 0
+        cut = np.argmax(np.where(valid, F1, -1), axis=0)
+    else:
+        valid &= (precision >= target_precision) & (Ng > 0)
+        cut = sampleNum - 1 - np.argmax(valid[::-1], axis=0)
+    found = valid[cut, np.arange(classNum)]
+
+    nextScores = np.append(sortedScores, sortedScores[-1:] - 1, axis=0)
+    thresholds = (sortedScores[cut, np.arange(classNum)] + nextScores[cut + 1, np.arange(classNum)]) / 2
+    thresholds[~found] = np.inf
+
+    res = {'thresholds': thresholds}
+    for key, value in (('precision', precision), ('recall', recall), ('F1', F1)):
+        res[key] = np.where(found, value[cut, np.arange(classNum)], 0)
+    res['overall'] = evaluation(scores - thresholds, targets.astype(np.int64))
+
+    return res
+
+def apply_thresholds(scores, thresholds):
+    """Boolean (batch, classNum) prediction with per-class thresholds"""
+
+    return _to_numpy(scores) >= np.asarray(thresholds)
+
+def save_thresholds(path, thresholds):
+    """Save per-class thresholds as .npy or .json (by the file suffix)"""
+
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    if path.endswith('.json'):
+        with open(path, 'w') as f:
+            json.dump(thresholds.tolist(), f)
+    else:
+        np.save(path, thresholds)
+
+def load_thresholds(path):
+    """Load per-class thresholds saved by `save_thresholds`"""
+
+    if path.endswith('.json'):
+        with open(path, 'r') as f:
+            return np.asarray(json.load(f), dtype=np.float64)
+    return np.load(path)
+
+def _to_numpy(array):
+
+    if hasattr(array, 'detach'):
+        return array.detach().cpu().numpy()
+    return np.asarray(array)